@@ -0,0 +1,71 @@
+import numpy as np
+
+# Binned statistics for the evaluation plots in one pass over the data: every value is assigned its bin once with
+# searchsorted and the per-bin sums are taken with np.bincount, instead of one boolean mask over all values per bin.
+# The bin conventions are those of np.digitize (bin_stats) and np.histogram/np.histogram2d (histogram, histogram2d).
+
+def digitize(x, edges):
+    # same as np.digitize(x, edges) for increasing edges: i with edges[i-1] <= x < edges[i], 0 below and len(edges) above
+    return np.searchsorted(edges, x, side = 'right')
+
+def bin_stats(x, y, edges):
+    # mean, population std and count of y in the bins of x, i.e. y[np.digitize(x, edges) == i] for i in 1..len(edges)-1
+    # returns means, stds, counts with dim: (len(edges)-1,) each; means and stds of empty bins are nan
+    idx = digitize(x, edges)
+    nbins = len(edges) + 1
+    counts = np.bincount(idx, minlength = nbins)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        means = np.bincount(idx, weights = y, minlength = nbins) / counts
+        # two passes as np.std, the sum of squares alone loses precision for values far from 0
+        stds = np.sqrt(np.bincount(idx, weights = (y - means[idx])**2, minlength = nbins) / counts)
+    return means[1:-1], stds[1:-1], counts[1:-1]
+
+def cdf(x, points):
+    # fraction of x <= p for every p in points, i.e. np.sum(x <= p) / len(x), from one sort of x
+    return np.searchsorted(np.sort(x), points, side = 'right') / len(x)
+
+def histogram_index(x, edges):
+    # bin of every x as in np.histogram: edges[i] <= x < edges[i+1], the last bin closed on the right,
+    # and -1 for values outside [edges[0], edges[-1]] or nan
+    n = len(edges) - 1
+    width = (edges[-1] - edges[0]) / n
+    if not np.allclose(np.diff(edges), width, rtol = 1e-6, atol = 0):
+        idx = np.searchsorted(edges, x, side = 'right') - 1
+        idx[x == edges[-1]] = n - 1
+        idx[(idx < 0) | (idx > n - 1) | np.isnan(x)] = -1
+        return idx
+    # uniform bins: computed bin, moved by one where rounding put x on the wrong side of an edge (as np.histogram does)
+    keep = (x >= edges[0]) & (x <= edges[-1])
+    with np.errstate(invalid = 'ignore'):
+        idx = ((x - edges[0]) / width).astype(np.intp)
+    np.clip(idx, 0, n - 1, out = idx)
+    idx -= x < edges[idx]
+    idx += (x >= edges[np.minimum(idx + 1, n)]) & (idx != n - 1)
+    idx[~keep] = -1
+    return idx
+
+def histogram(x, edges):
+    # counts with dim: (len(edges)-1,), as np.histogram(x, edges)[0]
+    idx = histogram_index(x, edges)
+    return np.bincount(idx[idx >= 0], minlength = len(edges) - 1)
+
+def histogram2d(x, y, xedges, yedges):
+    # counts with dim: (len(xedges)-1, len(yedges)-1), as np.histogram2d(x, y, [xedges, yedges])[0]
+    ix, iy = histogram_index(x, xedges), histogram_index(y, yedges)
+    keep = (ix >= 0) & (iy >= 0)
+    ny = len(yedges) - 1
+    counts = np.bincount(ix[keep] * ny + iy[keep], minlength = (len(xedges) - 1) * ny)
+    return counts.reshape(len(xedges) - 1, ny)
+
+def centers(edges):
+    return (edges[1:] + edges[:-1]) / 2
+
+def plot_hist(ax, x, bins, **kwargs):
+    # ax.hist(x, bins, ...) drawn from the bincount histogram: one weighted entry per bin
+    return ax.hist(centers(bins), bins = bins, weights = histogram(x, bins), **kwargs)
+
+def plot_hist2d(ax, x, y, bins, **kwargs):
+    # ax.hist2d(x, y, bins, ...) drawn from the bincount histogram; returns the same (counts, xedges, yedges, image)
+    xedges, yedges = bins
+    X, Y = np.meshgrid(centers(xedges), centers(yedges), indexing = 'ij')
+    return ax.hist2d(X.ravel(), Y.ravel(), bins = [xedges, yedges], weights = histogram2d(x, y, xedges, yedges).ravel(), **kwargs)
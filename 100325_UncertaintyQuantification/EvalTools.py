@@ -4,14 +4,15 @@ from torch.utils.data import Dataset
 from tqdm import tqdm
 import numpy as np
 import torch.nn as nn
-import argparse, os, json, sys
+import argparse, os, json, sys, hashlib
 import h5py
 sys.path.append("../model")
-from PFINDataset import PFINDataset, JetClassData
-from UQPFIN import UQPFIN as Model
+from PFINDataset import PFINDataset, LazyPFINDataset, JetClassData, JetSelection, batch_loader, get_manifest
+from UQPFIN import UQPFIN as Model, UQPFINEnsemble, ActivationCache, amp_autocast
 import glob
 from collections import OrderedDict
 import matplotlib.pyplot as plt
+from BinnedStats import bin_stats, cdf, centers, plot_hist, plot_hist2d
 
 def getprobs(outs):
     alphas = outs + 1
@@ -25,12 +26,24 @@ def index_logic(logic, v1, v2, a):
         keep = (a < min(v1, v2)) | (a > max(v1, v2))
     return keep
 
+# results of an evaluator in the order evaluate() returns them, followed by the optional ones (aug, latents, ...)
+result_names = ["labels", "preds", "maxprobs", "probs", "sums", "oods", "uncs"]
+
+def model_dict_path(model_path):
+    # JSON written by train.py next to the checkpoint, in trained_model_dicts/ instead of trained_models/
+    return model_path.replace("_best","").replace("_best","").replace("trained_models/", "trained_model_dicts/") + ".json"
+
 
 class ModelEvaluator:
-    def __init__(self, model_path, evalMode = True):
+    def __init__(self, model_path, evalMode = True, amp = "off", compile = False, cache = None):
+        """amp: "off", "bf16" or "fp16" autocast for the forward pass; compile: run the model through torch.compile;
+        cache: optional EvalCache, evaluate() then returns the stored results if model, data and settings are unchanged"""
         self.model_path = model_path
+        self.amp = amp
+        self.compile = compile
+        self.cache = cache
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model_dict_path = model_path.replace("_best","").replace("_best","").replace("trained_models/", "trained_model_dicts/") + ".json"
+        self.model_dict_path = model_dict_path(model_path)
         self.model_dict = json.load(open(self.model_dict_path))
         self.phi_nodes = list(map(int, self.model_dict["phi_nodes"].strip().split(',')))
         self.f_nodes = list(map(int, self.model_dict["f_nodes"].strip().split(',')))
@@ -50,6 +63,14 @@ class ModelEvaluator:
             self.use_dropout = self.model_dict["use_dropout"]
         except:
             self.use_dropout = False
+        try:
+            self.pair_mode = self.model_dict["pair_mode"]
+        except:
+            self.pair_mode = 'matmul'
+        try:
+            self.use_p4 = self.model_dict["use_p4"]
+        except:
+            self.use_p4 = False
         self.m_logic, (self.m1, self.m2) = self.massrange.strip().split(':')[0], list(map(float, self.massrange.strip().split(':')[1].split(',')))
         self.pt_logic,(self.pt1, self.pt2) = self.ptrange.strip().split(':')[0], list(map(float, self.ptrange.strip().split(':')[1].split(',')))
         self.eta_logic, (self.eta1, self.eta2) = self.etarange.strip().split(':')[0], list(map(float, self.etarange.strip().split(':')[1].split(',')))
@@ -93,6 +114,7 @@ class ModelEvaluator:
             self.label_indices = [i for i in range(4) if i not in self.skip_labels]
             self.data_path = "../datasets/JNqgmerged/test.h5"
             
+        self.selection = JetSelection(self.massrange, self.ptrange, self.etarange, self.skip_labels)
         self.model = Model(particle_feats = features,
                            n_consts = Np,
                            num_classes = self.num_classes,
@@ -101,13 +123,15 @@ class ModelEvaluator:
                            interaction_mode = self.x_mode,
                            use_softmax = self.use_softmax,
                            use_dropout = self.use_dropout,
+                           pair_mode = self.pair_mode,
+                           use_p4 = self.use_p4,
                            Phi_sizes = self.phi_nodes,
                            F_sizes   = self.f_nodes).to(self.device)
         state_dict = torch.load(self.model_path, map_location=self.device)
         
         new_state_dict = OrderedDict()
         for k, v in state_dict.items():
-            if "module" in k:
+            if k.startswith("module."):
                 name = k[7:] # remove `module.`
             else:
                 name = k
@@ -119,29 +143,54 @@ class ModelEvaluator:
             self.model.eval()
         else:
             self.model.train()
-        
+        self.fwd_model = torch.compile(self.model) if compile else self.model
+        self.fwd_latent = torch.compile(self.model.forward_with_latent) if compile else self.model.forward_with_latent
 
         
     def index_groomer(self, a, y):
-        keep_masses = index_logic(self.m_logic,   self.m1,   self.m2,   a[:, 1])
-        keep_pts    = index_logic(self.pt_logic,  self.pt1,  self.pt2,  a[:, 2])
-        keep_etas   = index_logic(self.eta_logic, self.eta1, self.eta2, a[:, 3])
-        
-        keep_labels = torch.tensor(np.isin(np.argmax(y.cpu().numpy(), 1), self.skip_labels, invert=True)).bool()
-        
-        return (keep_masses & keep_pts & keep_etas & keep_labels).bool()
+        # jets failing the training cuts are kept and marked as OOD by the caller
+        return self.selection.keep(a, y)
+
+    def particle_inputs(self, x):
+        # expected x dim: (Nb, Np, Nx), or (Nb, Np, Nx+4) from a test set read with use_p4
+        # return the particle features this model was trained on: the p4 columns are dropped if it was trained without --use-p4
+        if x.shape[-1] == self.model.Nx:
+            if self.use_p4:
+                raise ValueError("{} was trained with --use-p4, read the test set with use_p4 (evaluate_model.py --use-p4)".format(self.model_path))
+            return x
+        return x if self.use_p4 else x[:, :, :self.model.Nx]
     
-    def evaluate(self, data_loader = None, latent = False, aug = False, batchmode = False):
+    def evaluate(self, data_loader = None, latent = False, aug = False, batchmode = False, writer = None):
+        """data_loader: loader of (x, m, a, y) batches, or a JetClassData whose batches are generated here;
+        writer: optional ResultsWriter; every batch is then written to it under the keys evaluate_model.py stores
+        (labels, preds, maxprobs, probs, oods, sums, uncs, latents, aug) instead of being collected, and nothing is returned"""
         if not data_loader:
             if self.data_type == 'topdata' or self.data_type == 'jetnet' or self.data_type == "JNqgmerged":
-                test_set = PFINDataset(self.data_path)
-                testloader = DataLoader(test_set, shuffle=False, batch_size=512, num_workers=2, pin_memory=True, persistent_workers=True)
+                test_set = PFINDataset(self.data_path, use_p4 = self.use_p4)
+                testloader = batch_loader(test_set, 512, num_workers=2, pin_memory=True, persistent_workers=True)
             elif self.data_type == 'jetclass':
-                test_set = JetClassData(batch_size = 512)
+                test_set = JetClassData(batch_size = 512, use_p4 = self.use_p4)
                 test_set.set_file_names(file_names = self.data_path)
                 testloader = test_set.generate_data()
+        elif isinstance(data_loader, JetClassData):
+            testloader = data_loader.generate_data()
         else:
             testloader = data_loader
+        names = result_names + (["aug"] if aug else []) + (["latents"] if latent else [])
+        key = None
+        if self.cache is not None:
+            settings = {"amp": self.amp, "compile": self.compile, "train": self.model.training, "aug": aug, "latent": latent}
+            key = self.cache.key("model", [self.model_path], settings, data_loader if data_loader else test_set)
+        if key is not None:
+            if writer is not None:
+                if self.cache.write_to(key, writer):
+                    return
+            else:
+                results = self.cache.get(key, names)
+                if results is not None:
+                    return results
+        # on a miss with a writer, the batches also go to a new cache entry
+        entry = self.cache.writer(key, names) if key is not None and writer is not None else None
         labels = []
         preds = []
         maxprobs = []
@@ -153,12 +202,17 @@ class ModelEvaluator:
         aug_data = []
         with torch.no_grad():
             for x,m,a,y in tqdm(testloader, disable=batchmode):
-                x = x.cuda()
-                m = m.cuda()
-                a = a.cuda()
+                x = x.to(self.device)
+                m = m.to(self.device)
+                a = a.to(self.device)
 
-                pred = self.model(x, a, m).cpu()
-                idx2keep = self.index_groomer(a.cpu(), y).cpu().numpy()
+                with amp_autocast(self.device, self.amp):
+                    if latent:
+                        pred, latent_embeddings = self.fwd_latent(x, a, m)
+                    else:
+                        pred = self.fwd_model(x, a, m)
+                pred = pred.float().cpu()
+                idx2keep = self.index_groomer(a, y.to(a.device)).cpu().numpy()
                 if not self.use_softmax:
                     model_prob = getprobs(pred)
                 else:
@@ -169,13 +223,7 @@ class ModelEvaluator:
                 all_prob = all_prob.cpu().numpy()
                 
                 if latent:
-                    particle_embeddings = self.model.get_particle_embeddings(x, m)
-                    interaction_embeddings = self.model.get_interaction_embeddings(x, a, m)
-                    if self.model.x_mode == 'sum':
-                        latent_embeddings = particle_embeddings.sum(-1) + interaction_embeddings.sum(-1)
-                    else:
-                        latent_embeddings = torch.cat([particle_embeddings, interaction_embeddings], 1).sum(-1)
-                    latents.append(latent_embeddings.cpu().numpy())
+                    latents.append(latent_embeddings.float().cpu().numpy())
                 if aug:
                     aug_data.append(a.cpu().numpy())
                 labels.append(np.argmax(y, 1))
@@ -185,6 +233,22 @@ class ModelEvaluator:
                 oods.append(~idx2keep)
                 if not self.use_softmax:
                     sums.append((pred+1).sum(-1).cpu().numpy())
+                if writer is not None:
+                    # the batch goes to the file and the lists stay empty
+                    batch = {key: values.pop() for key, values in [("labels", labels), ("preds", preds), ("maxprobs", maxprobs), ("probs", probs),
+                             ("oods", oods), ("sums", sums), ("latents", latents), ("aug", aug_data)] if values}
+                    if "sums" in batch:
+                        batch["uncs"] = len(self.label_indices)*1.0 / batch["sums"]
+                    writer.append(**batch)
+                    if entry is not None:
+                        entry.append(**batch)
+
+        if writer is not None:
+            if entry is not None:
+                self.cache.close(entry)
+            if not data_loader:
+                del test_set, testloader
+            return
 
         labels = np.concatenate(labels, axis = None)
         preds = np.concatenate(preds, axis = None)
@@ -203,20 +267,62 @@ class ModelEvaluator:
         if not data_loader:
             del test_set, testloader
             
-        if not aug and not latent:
-            return labels, preds, maxprobs, probs, sums, oods, uncs
-        elif aug and not latent:
-            return labels, preds, maxprobs, probs, sums, oods, uncs, aug_data
-        elif not aug and latent:
-            return labels, preds, maxprobs, probs, sums, oods, uncs, latents
-        else:
-            return labels, preds, maxprobs, probs, sums, oods, uncs, aug_data, latents
+        results = (labels, preds, maxprobs, probs, sums, oods, uncs)
+        if aug:
+            results = results + (aug_data,)
+        if latent:
+            results = results + (latents,)
+        if key is not None:
+            self.cache.put(key, names, results)
+        return results
     
 
+def repeat_batch(t, n):
+    # n copies of the batch one after the other along the batch dimension
+    return t.repeat((n,) + (1,)*(t.dim() - 1))
+
+class RunningMoments(object):
+    """Mean and standard deviation over the first dimension of samples that arrive in groups, e.g. ensemble
+    members or MC dropout passes, without keeping the samples (Welford's algorithm with Chan et al.'s merge
+    of groups). std is the population standard deviation, as np.std."""
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x):
+        # expected x dim: (k, ...) => k new samples
+        k = x.shape[0]
+        x_mean = x.mean(0)
+        x_m2 = ((x - x_mean)**2).sum(0)
+        if self.n == 0:
+            self.n, self.mean, self.m2 = k, x_mean, x_m2
+            return
+        n = self.n + k
+        delta = x_mean - self.mean
+        self.mean = self.mean + delta * (k / n)
+        self.m2 = self.m2 + x_m2 + delta**2 * (self.n * k / n)
+        self.n = n
+
+    def std(self):
+        return torch.sqrt(self.m2 / self.n)
+
 class EnsembleEvaluator:
-    def __init__(self, model_paths, data_type = "jetnet"):
+    def __init__(self, model_paths, data_type = "jetnet", use_p4 = None, amp = "off", compile = False, stack = "loop", cache = None):
+        """use_p4: whether a test set read here includes the precomputed p4, by default if any member was trained with
+        --use-p4 (each member reads its own use_p4 from its JSON and gets the inputs it was trained on);
+        stack: how members with the same architecture are evaluated together, see UQPFINEnsemble;
+        cache: optional EvalCache, see ModelEvaluator"""
         self.model_paths = model_paths
+        self.cache = cache
         self.data_type = data_type
+        if use_p4 is None:
+            use_p4 = any(json.load(open(model_dict_path(model_path))).get("use_p4", False) for model_path in model_paths)
+        self.use_p4 = use_p4
+        self.amp = amp
+        self.compile = compile
+        self.stack = stack
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         if self.data_type == 'topdata':
             self.data_path = "../datasets/topdata/test.h5"
         elif self.data_type == 'jetnet':
@@ -229,56 +335,113 @@ class EnsembleEvaluator:
     def evaluate(self, test_set = None, aug = False, batchmode = False):
         if not test_set:
             if self.data_type == 'topdata' or self.data_type == 'jetnet' or self.data_type == "JNqgmerged":
-                test_set = PFINDataset(self.data_path)
-                testloader = DataLoader(test_set, shuffle=False, batch_size=512, num_workers=2, pin_memory=True, persistent_workers=True)
+                test_set = PFINDataset(self.data_path, use_p4 = self.use_p4)
+                testloader = batch_loader(test_set, 512, num_workers=2, pin_memory=True, persistent_workers=True)
             elif self.data_type == 'jetclass':
-                test_set = JetClassData(batch_size = 512)
+                test_set = JetClassData(batch_size = 512, use_p4 = self.use_p4)
                 test_set.set_file_names(file_names = self.data_path)
             delete_test_set = True
-        elif type(test_set) == PFINDataset:
-            testloader = DataLoader(test_set, shuffle=False, batch_size=512, num_workers=2, pin_memory=True, persistent_workers=True)
+        elif isinstance(test_set, (PFINDataset, LazyPFINDataset)):
+            testloader = batch_loader(test_set, 512, num_workers=2, pin_memory=True, persistent_workers=True)
             delete_test_set = False
         else:
             delete_test_set = False
             
-        preds = []
-        maxprobs = []
+        if type(test_set) == JetClassData:
+            testloader = test_set.generate_data()
+        names = result_names + (["aug"] if aug else [])
+        key = None
+        if self.cache is not None:
+            settings = {"amp": self.amp, "compile": self.compile, "stack": self.stack, "aug": aug}
+            key = self.cache.key("ensemble", self.model_paths, settings, test_set)
+            results = self.cache.get(key, names) if key is not None else None
+            if results is not None:
+                return results
+        first, groups = self.load_members()
+        labels = []
         probs = []
+        uncs = []
+        oods = []
+        aug_data = []
         sums = []
-        for ii, model_path in enumerate(self.model_paths):
-            model_evaluator = ModelEvaluator(model_path, evalMode = True)
-            if type(test_set) == JetClassData:
-                testloader = test_set.generate_data()
-            if ii == 0 and aug:
-                labels, _, _, this_probs, _, oods, _, aug_data =  model_evaluator.evaluate(testloader, aug = True, batchmode = batchmode)
-            elif ii == 0:
-                labels, _, _, this_probs, _, oods, _ =  model_evaluator.evaluate(testloader, batchmode = batchmode)
-            else:
-                _, _, _, this_probs, _, _, _ =  model_evaluator.evaluate(testloader, batchmode = batchmode)
-            probs.append(this_probs[None,:,:])
-            torch.cuda.empty_cache()
-            del model_evaluator
-                
-                
+        # every batch is read once and goes through all members; only the mean and std over the members are kept
+        with torch.no_grad():
+            for x,m,a,y in tqdm(testloader, disable=batchmode):
+                x = x.to(self.device)
+                m = m.to(self.device)
+                a = a.to(self.device)
+                moments = RunningMoments()
+                for evaluator, ensemble in groups:
+                    with amp_autocast(self.device, self.amp):
+                        pred = ensemble(evaluator.particle_inputs(x), a, m) # (K, Nb, C)
+                    pred = pred.float()
+                    if not evaluator.use_softmax:
+                        pred = getprobs(pred.reshape(-1, pred.shape[-1])).reshape(pred.shape)
+                    all_prob = torch.zeros((len(pred),) + y.shape, device=self.device)
+                    all_prob[:, :, evaluator.label_indices] = pred
+                    moments.update(all_prob)
+                idx2keep = first.index_groomer(a, y.to(a.device)).cpu().numpy()
+                labels.append(np.argmax(y.numpy(), 1))
+                probs.append(moments.mean.cpu().numpy())
+                uncs.append(moments.std().max(-1).values.cpu().numpy())
+                oods.append(~idx2keep)
+                if aug:
+                    aug_data.append(a.cpu().numpy())
+
+        labels = np.concatenate(labels, axis = None)
         probs = np.concatenate(probs, axis = 0)
-        uncs = np.std(probs, axis = 0).max(axis = 1)
-        probs = np.mean(probs, axis = 0)
+        uncs = np.concatenate(uncs, axis = None)
+        oods = np.concatenate(oods, axis = None)
         preds = np.argmax(probs, 1)
         maxprobs = probs.max(axis = 1)
+        if aug:
+            aug_data = np.concatenate(aug_data, axis = 0)
                 
         del testloader
         if delete_test_set:
             del test_set
             
+        results = (labels, preds, maxprobs, probs, sums, oods, uncs)
         if aug:
-            return labels, preds, maxprobs, probs, sums, oods, uncs, aug_data
-        else:
-            return labels, preds, maxprobs, probs, sums, oods, uncs
+            results = results + (aug_data,)
+        if key is not None:
+            self.cache.put(key, names, results)
+        return results
+
+    def load_members(self):
+        """Loads every member once. Members with the same architecture, inputs (use_p4) and labels are stacked into one
+        UQPFINEnsemble; returns the first member's ModelEvaluator (for the OOD selection) and a list of
+        (ModelEvaluator of the group's first member, group ensemble)"""
+        evaluators = [ModelEvaluator(model_path, evalMode = True, amp = self.amp) for model_path in self.model_paths]
+        groups = OrderedDict()
+        for evaluator in evaluators:
+            key = (evaluator.model.Nx, evaluator.model.Np, tuple(evaluator.phi_nodes), tuple(evaluator.f_nodes), evaluator.n_phiI, evaluator.x_mode,
+                   evaluator.use_softmax, evaluator.use_dropout, evaluator.pair_mode, evaluator.use_p4, tuple(evaluator.label_indices))
+            groups.setdefault(key, []).append(evaluator)
+        ensembles = []
+        for group in groups.values():
+            ensemble = UQPFINEnsemble([evaluator.model for evaluator in group], stack = self.stack).eval()
+            ensembles.append((group[0], torch.compile(ensemble) if self.compile else ensemble))
+        return evaluators[0], ensembles
 
 class MCDOEvaluator:
-    def __init__(self, model_path, data_type = "jetnet"):
+    def __init__(self, model_path, data_type = "jetnet", use_p4 = False, amp = "off", compile = False, samples = 10, chunk_size = 1, cache_bytes = 0,
+                 cache = None):
+        """samples: number of dropout samples per jet; chunk_size: number of samples drawn in one forward call, for which
+        each batch is repeated chunk_size times along the batch dimension so every copy gets its own dropout masks;
+        cache_bytes: budget of an ActivationCache for the layers before the first dropout, which give the same output
+        for every sample (0 turns it off, and it is not used with compile);
+        cache: optional EvalCache, see ModelEvaluator (a hit returns the stored dropout samples' moments)"""
         self.model_path = model_path
+        self.cache = cache
         self.data_type = data_type
+        self.use_p4 = use_p4
+        self.amp = amp
+        self.compile = compile
+        self.samples = samples
+        self.chunk_size = chunk_size
+        self.cache_bytes = cache_bytes
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         if self.data_type == 'topdata':
             self.data_path = "../datasets/topdata/test.h5"
         elif self.data_type == 'jetnet':
@@ -288,58 +451,381 @@ class MCDOEvaluator:
         elif self.data_type == "JNqgmerged":
             self.data_path = "../datasets/JNqgmerged/test.h5"
             
-    def evaluate(self, test_set = None, aug = False, batchmode = False):
+    def evaluate(self, test_set = None, aug = False, batchmode = False, info = False):
+        """info: also return the predictive entropy and the mutual information between the prediction and the
+        dropout masks (predictive entropy minus the mean entropy of the samples)"""
         if not test_set:
             if self.data_type == 'topdata' or self.data_type == 'jetnet' or self.data_type == "JNqgmerged":
-                test_set = PFINDataset(self.data_path)
-                testloader = DataLoader(test_set, shuffle=False, batch_size=512, num_workers=2, pin_memory=True, persistent_workers=True)
+                test_set = PFINDataset(self.data_path, use_p4 = self.use_p4)
+                testloader = batch_loader(test_set, 512, num_workers=2, pin_memory=True, persistent_workers=True)
             elif self.data_type == 'jetclass':
-                test_set = JetClassData(batch_size = 512)
+                test_set = JetClassData(batch_size = 512, use_p4 = self.use_p4)
                 test_set.set_file_names(file_names = self.data_path)
             delete_test_set = True
-        elif type(test_set) == PFINDataset:
-            testloader = DataLoader(test_set, shuffle=False, batch_size=512, num_workers=2, pin_memory=True, persistent_workers=True)
+        elif isinstance(test_set, (PFINDataset, LazyPFINDataset)):
+            testloader = batch_loader(test_set, 512, num_workers=2, pin_memory=True, persistent_workers=True)
             delete_test_set = False
         else:
             delete_test_set = False
+        if type(test_set) == JetClassData:
+            testloader = test_set.generate_data()
+        names = result_names + (["aug"] if aug else []) + (["entropy", "mutual_info"] if info else [])
+        key = None
+        if self.cache is not None:
+            settings = {"amp": self.amp, "compile": self.compile, "samples": self.samples, "chunk_size": self.chunk_size, "aug": aug, "info": info}
+            key = self.cache.key("dropout", [self.model_path], settings, test_set)
+            results = self.cache.get(key, names) if key is not None else None
+            if results is not None:
+                return results
             
-        preds = []
-        maxprobs = []
+        model_evaluator = ModelEvaluator(self.model_path, evalMode = False, amp = self.amp, compile = self.compile)
+        cache = ActivationCache(self.cache_bytes) if self.cache_bytes and not self.compile else None
+        labels = []
         probs = []
+        uncs = []
+        oods = []
+        aug_data = []
+        entropy = []
+        mutual_info = []
         sums = []
-        model_evaluator = ModelEvaluator(self.model_path, evalMode = False)
-        for ii in range(10):
-            if type(test_set) == JetClassData:
-                testloader = test_set.generate_data()
-            if ii == 0 and aug:
-                labels, _, _, this_probs, _, oods, _, aug_data =  model_evaluator.evaluate(testloader, aug = True, batchmode = batchmode)
-            elif ii == 0:
-                labels, _, _, this_probs, _, oods, _ =  model_evaluator.evaluate(testloader, batchmode = batchmode)
-            else:
-                _, _, _, this_probs, _, _, _ =  model_evaluator.evaluate(testloader, batchmode = batchmode)
-            probs.append(this_probs[None,:,:])
-            torch.cuda.empty_cache()
+        # every batch is read once; the dropout samples are drawn in chunks and only their running moments are kept
+        with torch.no_grad():
+            for x,m,a,y in tqdm(testloader, disable=batchmode):
+                x = x.to(self.device)
+                m = m.to(self.device)
+                a = a.to(self.device)
+                # hashed once per batch from the un-repeated inputs; the cached stages hold n copies of the batch,
+                # so n is part of the key (the last chunk can be smaller)
+                batch_key = cache.batch_key(x, a) if cache is not None else None
+                moments = RunningMoments()
+                sample_entropy = 0
+                for start in range(0, self.samples, self.chunk_size):
+                    n = min(self.chunk_size, self.samples - start)
+                    with amp_autocast(self.device, self.amp):
+                        if cache is not None:
+                            pred = model_evaluator.model(repeat_batch(x, n), repeat_batch(a, n), repeat_batch(m, n), cache, (batch_key, n))
+                        else:
+                            pred = model_evaluator.fwd_model(repeat_batch(x, n), repeat_batch(a, n), repeat_batch(m, n))
+                    pred = pred.float()
+                    if not model_evaluator.use_softmax:
+                        pred = getprobs(pred)
+                    # expected pred dim: (n*Nb, C) => (n, Nb, C), copy i of the batch holds sample start+i
+                    pred = pred.reshape((n, len(y), -1))
+                    all_prob = torch.zeros((n,) + y.shape, device=self.device)
+                    all_prob[:, :, model_evaluator.label_indices] = pred
+                    moments.update(all_prob)
+                    sample_entropy = sample_entropy + torch.special.entr(all_prob).sum((0, 2))
+                idx2keep = model_evaluator.index_groomer(a, y.to(a.device)).cpu().numpy()
+                labels.append(np.argmax(y.numpy(), 1))
+                probs.append(moments.mean.cpu().numpy())
+                uncs.append(moments.std().max(-1).values.cpu().numpy())
+                oods.append(~idx2keep)
+                if info:
+                    predictive_entropy = torch.special.entr(moments.mean).sum(-1)
+                    entropy.append(predictive_entropy.cpu().numpy())
+                    mutual_info.append((predictive_entropy - sample_entropy / self.samples).cpu().numpy())
+                if aug:
+                    aug_data.append(a.cpu().numpy())
         del model_evaluator
                 
-                
+        labels = np.concatenate(labels, axis = None)
         probs = np.concatenate(probs, axis = 0)
-        uncs = np.std(probs, axis = 0).max(axis = 1)
-        probs = np.mean(probs, axis = 0)
+        uncs = np.concatenate(uncs, axis = None)
+        oods = np.concatenate(oods, axis = None)
         preds = np.argmax(probs, 1)
         maxprobs = probs.max(axis = 1)
+        if info:
+            entropy = np.concatenate(entropy, axis = None)
+            mutual_info = np.concatenate(mutual_info, axis = None)
+        if aug:
+            aug_data = np.concatenate(aug_data, axis = 0)
             
         del testloader
         if delete_test_set:
             del test_set
             
+        results = (labels, preds, maxprobs, probs, sums, oods, uncs)
         if aug:
-            return labels, preds, maxprobs, probs, sums, oods, uncs, aug_data
-        else:
-            return labels, preds, maxprobs, probs, sums, oods, uncs
+            results = results + (aug_data,)
+        if info:
+            results = results + (entropy, mutual_info)
+        if key is not None:
+            self.cache.put(key, names, results)
+        return results
 
     
+class ResultsWriter(object):
+    """Writes evaluation results batch by batch to an HDF5 file with one resizable, chunked and compressed dataset per
+    key, so the full arrays are never held in memory. Rows are buffered until a whole chunk (about chunk_bytes) is
+    filled, so every compressed chunk is written once. The file is written as <filename>.tmp and moved to filename by
+    close(). Keys in keys that were never appended to (e.g. sums of softmax models) are written as empty datasets, as
+    when an empty list is stored. The file is opened by the first append, so DataLoader workers started before it
+    don't inherit its handle (and with it the HDF5 file lock)."""
+    def __init__(self, filename, keys = (), compression = "gzip", chunk_bytes = 2**20):
+        self.filename = filename
+        self.keys = list(keys)
+        self.compression = compression
+        self.chunk_bytes = chunk_bytes
+        self.h5_file = None
+        self.buffers = {}
+
+    def open(self):
+        if self.h5_file is None:
+            self.h5_file = h5py.File(self.filename + ".tmp", "w")
+        return self.h5_file
+
+    def append(self, **arrays):
+        # expected arrays: key => batch with dim: (Nb, ...), appended along the first axis
+        self.open()
+        for key, value in arrays.items():
+            value = np.asarray(value)
+            self.buffers.setdefault(key, []).append(value)
+            if sum(len(v) for v in self.buffers[key]) >= self.chunk_rows(value):
+                self.flush(key)
+
+    def chunk_rows(self, value):
+        return max(self.chunk_bytes // max(value.dtype.itemsize * int(np.prod(value.shape[1:])), 1), 1)
+
+    def flush(self, key):
+        # writes the buffered rows of key; the dataset is made by the first flush, so one that is flushed only
+        # once (by close) gets chunks of its actual length instead of a mostly empty chunk_bytes one
+        if not self.buffers[key]:
+            return
+        value = self.buffers[key][0] if len(self.buffers[key]) == 1 else np.concatenate(self.buffers[key])
+        self.buffers[key] = []
+        if key not in self.h5_file:
+            self.h5_file.create_dataset(key, shape = (0,) + value.shape[1:], maxshape = (None,) + value.shape[1:], dtype = value.dtype,
+                                        chunks = (max(min(self.chunk_rows(value), len(value)), 1),) + value.shape[1:], compression = self.compression)
+        dset = self.h5_file[key]
+        n = dset.shape[0]
+        dset.resize(n + len(value), axis = 0)
+        dset[n:] = value
+
+    def close(self):
+        self.open()
+        for key in self.buffers:
+            self.flush(key)
+        for key in self.keys:
+            if key not in self.h5_file:
+                self.h5_file.create_dataset(key, data = [])
+        self.h5_file.close()
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        elif self.h5_file is not None:
+            self.h5_file.close()
+
+def read_results(filename, keys = None, cache_dir = None, chunk_rows = 1000000):
+    """Results file as written by evaluate_model.py, as a dict of arrays (e.g. for PlotterTools). keys selects the
+    datasets to read (default: all), e.g. to leave the latents in the file. Each dataset is decompressed chunk by chunk
+    straight into its array (read_direct), without a temporary copy of the whole dataset.
+    cache_dir (opt-in, e.g. results/.results_cache, which git ignores): copy every dataset once to an uncompressed .npy
+    file there and return read-only memory maps instead, for results that are plotted again and again; this takes the
+    uncompressed size on disk. A copy older than the results file is made again."""
+    results = {}
+    with h5py.File(filename, "r") as f:
+        for key in (f.keys() if keys is None else keys):
+            if not cache_dir:
+                out = np.empty(f[key].shape, dtype = f[key].dtype)
+                if out.size:
+                    f[key].read_direct(out)
+                results[key] = out
+                continue
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            # copies are prefixed with a hash of the full path, as results of different directories share file names
+            tag = hashlib.md5(os.path.abspath(filename).encode()).hexdigest()[:8]
+            path = os.path.join(cache_dir, tag + "_" + os.path.basename(filename).replace(".h5", "") + "_" + key + ".npy")
+            if not (os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(filename)):
+                out = np.lib.format.open_memmap(path + ".tmp", mode = 'w+', dtype = f[key].dtype, shape = f[key].shape)
+                for start in range(0, len(out), chunk_rows):
+                    out[start:start+chunk_rows] = f[key][start:start+chunk_rows]
+                out.flush()
+                del out
+                os.replace(path + ".tmp", path)
+            results[key] = np.load(path, mmap_mode = 'r')
+    return results
+
+class EvalCache(object):
+    """Content-addressed on-disk cache of evaluator results, so re-running an evaluation after adding a checkpoint only
+    evaluates the new one. Entries are keyed by a hash of the checkpoints and their model JSONs, the test data (the
+    DatasetManifest entries of its files and how they are read), the evaluator type and its settings, and stored as
+    one uncompressed <key>.h5 with a dataset per result. The modification time of an entry marks its last use; entries
+    are evicted least recently used first once together they take more than max_bytes. The evaluation code is not
+    part of the key, so cache_dir has to be cleared after changing it."""
+    def __init__(self, cache_dir, max_bytes = 10*2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def data_identity(data):
+        # files of the test data (their manifest entries, which include size and mtime) and how they are read,
+        # or None if they are unknown (e.g. for a generator of batches)
+        if isinstance(data, DataLoader):
+            data = data.dataset
+        if isinstance(data, (PFINDataset, LazyPFINDataset)):
+            files, read = [data.file_path], {"rows": len(data), "shape": list(data[0:1][0].shape[1:])}
+        elif isinstance(data, JetClassData):
+            files, read = data.file_names, {"batch_size": data.batch_size, "use_p4": data.use_p4}
+        else:
+            return None
+        selection = getattr(data, "selection", None)
+        read["selection"] = None if selection is None else [selection.cuts, selection.skip_labels]
+        entries = []
+        for file_name in files:
+            # the metadata part of the manifest entry, which is the same whether or not the min/max were computed
+            entry = get_manifest(file_name).get(file_name, stats = False)
+            entries.append({"file": os.path.basename(file_name), "rows": entry["rows"], "size": entry["size"], "mtime": entry["mtime"],
+                            "datasets": {key: [d["dtype"], d["shape"]] for key, d in entry["datasets"].items()}})
+        return {"files": entries, "read": read}
+
+    def key(self, kind, model_paths, settings, data):
+        """Hex key of the results of evaluator kind with settings for the checkpoints model_paths on data (a dataset,
+        DataLoader or JetClassData), or None if the data can't be identified"""
+        identity = self.data_identity(data)
+        if identity is None:
+            return None
+        h = hashlib.blake2b(digest_size = 16)
+        h.update(json.dumps([kind, settings, identity], sort_keys = True).encode())
+        for model_path in model_paths:
+            for file_name in [model_path, model_dict_path(model_path)]:
+                with open(file_name, "rb") as f:
+                    for block in iter(lambda: f.read(2**20), b""):
+                        h.update(block)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".h5")
+
+    def open(self, key):
+        # entry of key opened for reading and marked as used, or None on a miss (or if it was just evicted)
+        try:
+            f = h5py.File(self.path(key), "r")
+        except OSError:
+            self.misses += 1
+            return None
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass
+        self.hits += 1
+        return f
+
+    def get(self, key, names):
+        # cached results in the order of names, or None on a miss; empty results are the evaluators' empty lists
+        f = self.open(key)
+        if f is None:
+            return None
+        with f:
+            return tuple(f[name][:] if len(f[name]) else [] for name in names)
+
+    def write_to(self, key, writer, chunk_rows = 100000):
+        # appends the cached results of key to a ResultsWriter in chunk_rows pieces; False on a miss
+        f = self.open(key)
+        if f is None:
+            return False
+        with f:
+            names = [name for name in f.keys() if len(f[name])]
+            for start in range(0, max(len(f[name]) for name in names), chunk_rows):
+                writer.append(**{name: f[name][start:start+chunk_rows] for name in names})
+        return True
+
+    def writer(self, key, names):
+        # ResultsWriter of a new entry, to be finished with close()
+        return ResultsWriter(self.path(key), keys = names, compression = None)
+
+    def close(self, writer):
+        writer.close()
+        self.evict(keep = writer.filename)
+
+    def put(self, key, names, results):
+        writer = self.writer(key, names)
+        writer.append(**{name: value for name, value in zip(names, results) if len(value)})
+        self.close(writer)
+
+    def evict(self, keep = None):
+        # removes the least recently used entries (except keep) until all of them take at most max_bytes
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".h5"):
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, os.path.join(self.cache_dir, name)))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+class ThresholdSweep(object):
+    """Jet counts and rates of the uncertainty-threshold curves, where jets with uncs >= u are flagged as OOD, for
+    many thresholds u at once. uncs is sorted once and the OOD, correct and correct-ID jets are counted cumulatively,
+    so every threshold is one searchsorted lookup: O(N log N + T) instead of O(N T). NaN uncertainties count as
+    neither >= u nor < u, as in the elementwise comparisons."""
+    def __init__(self, uncs, oods, labels, preds):
+        uncs = np.asarray(uncs)
+        oods = np.asarray(oods, dtype = bool)
+        correct = np.asarray(labels) == np.asarray(preds)
+        valid = ~np.isnan(uncs)
+        order = np.argsort(uncs[valid], kind = 'stable')
+        self.uncs = uncs[valid][order]
+        self.N = len(uncs)
+        self.n_ood = oods.sum()
+        self.n_id = (~oods).sum()
+        def cumulative(x):
+            return np.concatenate([[0], np.cumsum(x[valid][order])])
+        self.cum = {"all": np.arange(len(self.uncs) + 1),
+                    "ood": cumulative(oods),
+                    "correct": cumulative(correct),
+                    "id_correct": cumulative(correct & ~oods)}
+
+    def counts(self, thresholds):
+        # returns jet counts with dim: (T,) each, <name>_lo for uncs < u and <name>_hi for uncs >= u,
+        # for name in all, ood, id, correct, id_correct
+        i = np.searchsorted(self.uncs, thresholds, side = 'left')
+        counts = {}
+        for name, cum in self.cum.items():
+            counts[name + "_lo"] = cum[i]
+            counts[name + "_hi"] = cum[-1] - cum[i]
+        counts["id_lo"] = counts["all_lo"] - counts["ood_lo"]
+        counts["id_hi"] = counts["all_hi"] - counts["ood_hi"]
+        return counts
+
+    def rates(self, thresholds):
+        # returns the curves plotted by PlotterTools with dim: (T,) each
+        c = self.counts(thresholds)
+        return {"odr": c["ood_hi"] / self.n_ood,                                  # OOD detection rate
+                "ood_miss": (self.n_ood - c["ood_hi"]) / self.n_ood,              # not >= u, which includes NaN
+                "imr": c["id_hi"] / self.n_id,                                    # ID mistag rate
+                "id_keep": (self.n_id - c["id_hi"]) / self.n_id,
+                "id_err": (c["id_hi"] - c["id_correct_hi"]) / self.n_id,          # ID mistakes flagged as OOD
+                "idacc": c["id_correct_lo"] / self.n_id,
+                "acc": (c["correct_lo"] + c["ood_hi"]) / self.N,
+                "ocr": c["ood_hi"] / c["all_hi"],                                 # OOD confidence rate
+                "rar": (c["ood_hi"] + c["id_correct_lo"]) / self.N,
+                "rer": (c["ood_lo"] + c["id_hi"]) / self.N}
+
 class PlotterTools:
-    def __init__(self, model_results, tag):
+    def __init__(self, model_results, tag, thresholds = None):
+        """thresholds: uncertainty thresholds of the curves, 100 steps between the smallest and largest uncertainty
+        by default, "unique" for every distinct uncertainty, or an array"""
         self.uncs = model_results['uncs']
         self.preds = model_results['preds']
         self.labels = model_results['labels']
@@ -347,112 +833,50 @@ class PlotterTools:
         self.probs = model_results['probs']
         self.sums = model_results['sums']
         self.tag = tag
-        ul, ur = self.uncs.min(), self.uncs.max()
-        du = (ur - ul)/100
-        self.urange = np.arange(ul+du, ur-du, du)
+        if thresholds is None:
+            ul, ur = self.uncs.min(), self.uncs.max()
+            du = (ur - ul)/100
+            self.urange = np.arange(ul+du, ur-du, du)
+        elif isinstance(thresholds, str) and thresholds == "unique":
+            self.urange = np.unique(self.uncs)
+        else:
+            self.urange = np.asarray(thresholds)
+        self.rates = ThresholdSweep(self.uncs, self.oods, self.labels, self.preds).rates(self.urange)
         
     def ID_Unc(self, ax):
         # todo
-        
-        IDAccs = []
-        
-        for u in self.urange:
-            pred_id_indices = (self.uncs >= u) & (~self.oods)
-            idacc = (self.labels[pred_id_indices] != self.preds[pred_id_indices]).sum()/(~self.oods).sum()
-            IDAccs.append(idacc)
-            
-        ax.plot(self.urange, IDAccs, label=self.tag)
+        ax.plot(self.urange, self.rates["id_err"], label=self.tag)
         
     def ODR_IDAcc(self, ax):
         # plots OOD Detection Rate vs ID Accuracy for differenct unc thresholds
         # ODR = OOD_Positive / Total_OOD
         # IDAcc = Correct_ID_tag / Total_ID
-        
-        ODRs = []
-        IDAccs = []
-        
-        for u in self.urange:
-            odr = (self.oods & (self.uncs >= u)).sum()/self.oods.sum()
-            ODRs.append(odr)
-            pred_id_indices = (self.uncs < u) & (~self.oods)
-            idacc = (self.labels[pred_id_indices] == self.preds[pred_id_indices]).sum()/(~self.oods).sum()
-            IDAccs.append(idacc)
-            
-        ax.plot(IDAccs, ODRs, label=self.tag)
+        ax.plot(self.rates["idacc"], self.rates["odr"], label=self.tag)
         
     def ODR_Acc(self, ax):
         # plots OOD Detection Rate vs Accuracy for differenct unc thresholds
         # ODR = OOD_Positive / Total_OOD
         # Acc = Correct_OOD or Correctly_tagged_ID / N
-        
-        ODRs = []
-        Accs = []
-        
-        for u in self.urange:
-            odr = (self.oods & (self.uncs >= u)).sum()/self.oods.sum()
-            ODRs.append(odr)
-            pred_id_indices = self.uncs < u
-            acc = ((self.labels[pred_id_indices] == self.preds[pred_id_indices]).sum() + (self.oods & (self.uncs >= u)).sum())/len(self.labels)
-            Accs.append(acc)
-            
-        ax.plot(Accs, ODRs, label=self.tag)
+        ax.plot(self.rates["acc"], self.rates["odr"], label=self.tag)
         
     def OCR_ODR(self, ax):
         # plots OOD Detection Rate vs OOD Conf Rate for differenct unc thresholds
         # ODR = OOD_Positive / Total_OOD (like recall or True-Positive-Rate)
         # OCR = OOD_Positive / Total_Pred_OOD (like Precision)
-        
-        ODRs = []
-        OCRs = []
-        
-        for u in self.urange:
-            odr = (self.oods & (self.uncs >= u)).sum()/self.oods.sum()
-            ODRs.append(odr)
-            ocr = (self.oods & (self.uncs >= u)).sum()/(self.uncs >= u).sum()
-            OCRs.append(ocr)
-            
-        ax.plot(ODRs, OCRs, label=self.tag)
+        ax.plot(self.rates["odr"], self.rates["ocr"], label=self.tag)
         
     def ODR_IMR(self, ax):
         # plots OOD Detection Rate vs ID Mistag Rate for differenct unc thresholds (equivalent to ROC)
         # ODR = OOD_Positive / Total_OOD
         # IMR = ID_Positive / Total_ID
-        
-        ODRs = []
-        IMRs = []
-        
-        for u in self.urange:
-            odr = (self.oods & (self.uncs >= u)).sum()/self.oods.sum()
-            ODRs.append(odr)
-            pred_id_indices = (self.uncs >= u) & (~self.oods)
-            imr = pred_id_indices.sum()/(~self.oods).sum()
-            IMRs.append(imr)
-            
-        ax.plot(IMRs, ODRs, label=self.tag)
+        ax.plot(self.rates["imr"], self.rates["odr"], label=self.tag)
         
         
     def RAR_RER(self, ax):
         #plots Remaining Accuracy Rate v Remaining Error Rate [https://ceur-ws.org/Vol-2640/paper_18.pdf]
         # RAR = Correct and Confident / N = [(large unc and OOD) or (small uncertainty and correct ID)] / N
         # RER = Incorrect and Confident / N = [(large unc and ID) or (small unc and OOD) ] / N
-        
-        RARs = []
-        RERs = []
-        
-        for u in self.urange:
-            CC_ood = ((self.uncs >= u) & self.oods).sum()
-            CC_id_indices = (self.uncs < u) & (~self.oods)
-            CC_id = (self.labels[CC_id_indices] == self.preds[CC_id_indices]).sum()
-            rar = (CC_ood + CC_id)/len(self.labels)
-            
-            IC_id = ((self.uncs >= u) & ~self.oods).sum()
-            IC_ood = ((self.uncs < u) & self.oods).sum()
-            rer = (IC_ood + IC_id)/len(self.labels)
-            
-            RARs.append(rar)
-            RERs.append(rer)
-            
-        ax.plot(RERs, RARs, label=self.tag)
+        ax.plot(self.rates["rer"], self.rates["rar"], label=self.tag)
     
 
     def UNC_ENTROPY(self, ax):
@@ -469,11 +893,8 @@ class PlotterTools:
         
         ul, ur = entropy.min(), entropy.max()
         bins = np.linspace(ul, ur, 200)
-        digitized = np.digitize(entropy, bins)
-        
-        bin_means = np.array([y[digitized == i].mean() for i in range(1, len(bins))])
-        bin_stds = np.array([y[digitized == i].std() for i in range(1, len(bins))])
-        bin_centers = np.array([bins[i-1:i+1].mean() for i in range(1, len(bins))])       
+        bin_means, bin_stds, _ = bin_stats(entropy, y, bins)
+        bin_centers = centers(bins)
                         
         ax.plot(bin_centers, bin_means, label=self.tag, alpha=0.5, linewidth=3)
         ax.fill_between(bin_centers, bin_means-bin_stds, bin_means+bin_stds, alpha=0.5)
@@ -489,33 +910,16 @@ class PlotterTools:
 
         ul, ur = entropy.min(), entropy.max()
         erange = np.linspace(ul, ur, 200)
-                
-        for i in range(len(erange)):
-            
-            prob = np.sum(entropy <= erange[i]) / len(entropy)
-            ENTs.append(prob)
-        
+        ENTs = cdf(entropy, erange)
                         
         ax.plot(erange, ENTs, label=self.tag)
         
    
     def UNC_FOURPLOT(self, ax):
-        tp_rate = []
-        fp_rate = []
-        fn_rate = []
-        tn_rate = []
-        
-        for i in range(len(self.urange)):
-            f = self.uncs >= self.urange[i]
-            tp = (self.oods & f).sum()/self.oods.sum()
-            fp = (~self.oods & f).sum()/(~self.oods).sum()
-            fn = (self.oods & ~f).sum()/self.oods.sum()
-            tn = (~self.oods & ~f).sum()/(~self.oods).sum()
-
-            tp_rate.append(tp)
-            fp_rate.append(fp)
-            fn_rate.append(fn)
-            tn_rate.append(tn)
+        tp_rate = self.rates["odr"]
+        fp_rate = self.rates["imr"]
+        fn_rate = self.rates["ood_miss"]
+        tn_rate = self.rates["id_keep"]
 
         ax[0, 0].plot(self.urange, tp_rate, label=self.tag)
         ax[0, 1].plot(self.urange, fp_rate, label=self.tag)
@@ -540,9 +944,9 @@ def interaction_features(model, particle_feats, augmented_feats, mask):
     # expected mask dim: (Nb, 1, Np)
     # expected augmented feats: (Nb, 7) => jet_e, jet_m, jet_pt, jet_eta, jet_phi, jet_ptsum, jet_nconst
     # return per-particle interaction embeddings with dim: (Nb, Nz, Np)
+    particle_feats, _ = model.split_p4(particle_feats)
     particle_feats = torch.transpose(particle_feats, 1, 2).contiguous() # (Nb, Nx, Np)
-    intR = model.tmul(particle_feats, model.Rr) # (Nb, Nx, Npp)
-    intS = model.tmul(particle_feats, model.Rs) # (Nb, Nx, Npp)
+    intR, intS = model.gather_pairs(particle_feats) # (Nb, Nx, Npp), (Nb, Nx, Npp)
     E = torch.cat([intR, intS], 1) # (Nb, 2Nx, Npp)
     #print(E[:5,:,:5])
     # Get interaction features
@@ -551,26 +955,26 @@ def interaction_features(model, particle_feats, augmented_feats, mask):
     #print(E[:5,:,:-5])
     return E # Returns interaction features
 
-def interaction_embeddings_calc(model, E, particle_feats, augmented_feats, mask):
+def interaction_embeddings_calc(model, E, particle_feats, augmented_feats, mask, cache = None, key = None):
+    # optional cache: ActivationCache with the batch key of (particle_feats, augmented_feats) for the phiInt outputs
     # Now applying the Interaction MLP
+    particle_feats, _ = model.split_p4(particle_feats)
     particle_feats = torch.transpose(particle_feats, 1, 2).contiguous()
     E = torch.transpose(E, 1, 2).contiguous() #(Nb, Npp, Ni)
-    E = model.phiInt(E.view(-1, model.Ni)) # (Nb*Npp, Nz)
+    E = model.cached_mlp(model.phiInt, E.view(-1, model.Ni), cache, key, 'phiInt') # (Nb*Npp, Nz)
     # print(E.shape)
     E = E.view(-1, model.Npp, model.Nz) # (Nb, Npp, Nz)
 
     if mask is not None:
         # generating masks for interactions
-        mR = model.tmul(mask, model.Rr) # (Nb, 1, Npp)
-        mS = model.tmul(mask, model.Rs) # (Nb, 1, Npp)
+        mR, mS = model.gather_pairs(mask) # (Nb, 1, Npp), (Nb, 1, Npp)
         imask = torch.transpose(mR * mS, 1, 2).contiguous() # (Nb, Npp, 1)
         E = E * imask # (Nb, Npp, Nz) with non-existent interactions masked
 
 
     # Now returning Interactions to particle level inputs
     E = torch.transpose(E, 1, 2).contiguous() # (Nb, Nz, Npp)
-    E = ( model.tmul(E, torch.transpose(model.Rr, 0, 1).contiguous())  \
-        + model.tmul(E, torch.transpose(model.Rs, 0, 1).contiguous()) ) / augmented_feats[:,6].reshape(-1,1,1) # (Nb, Nz, Np)
+    E = model.scatter_pairs(E) / augmented_feats[:,6].reshape(-1,1,1) # (Nb, Nz, Np)
 
 
     if mask is not None:
@@ -589,8 +993,12 @@ def interaction_embeddings_calc(model, E, particle_feats, augmented_feats, mask)
     return E
         
 class PairwiseEvaluator:
-    def __init__(self, model_path, evalMode = True):
+    def __init__(self, model_path, evalMode = True, cache_bytes = 0):
+        """cache_bytes: budget of an ActivationCache for the stages that don't change between ablations, 0 (default)
+        turns it off. The entries stay on the model's device, so up to this much extra GPU memory is taken; sweep only
+        needs one batch, about 4*Nb*Np*Np*(Ni + Nz) bytes with Ni pair features and Nz latent nodes"""
         self.model_path = model_path
+        self.cache = ActivationCache(cache_bytes) if cache_bytes else None
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.model_dict_path = model_path.replace("_best","").replace("_best","").replace("trained_models/", "trained_model_dicts/") + ".json"
         self.model_dict = json.load(open(self.model_dict_path))
@@ -612,6 +1020,14 @@ class PairwiseEvaluator:
             self.use_dropout = self.model_dict["use_dropout"]
         except:
             self.use_dropout = False
+        try:
+            self.pair_mode = self.model_dict["pair_mode"]
+        except:
+            self.pair_mode = 'matmul'
+        try:
+            self.use_p4 = self.model_dict["use_p4"]
+        except:
+            self.use_p4 = False
         self.m_logic, (self.m1, self.m2) = self.massrange.strip().split(':')[0], list(map(float, self.massrange.strip().split(':')[1].split(',')))
         self.pt_logic,(self.pt1, self.pt2) = self.ptrange.strip().split(':')[0], list(map(float, self.ptrange.strip().split(':')[1].split(',')))
         self.eta_logic, (self.eta1, self.eta2) = self.etarange.strip().split(':')[0], list(map(float, self.etarange.strip().split(':')[1].split(',')))
@@ -644,6 +1060,7 @@ class PairwiseEvaluator:
             self.label_indices = [i for i in range(10) if i not in self.skip_labels]
             self.data_path = glob.glob(os.path.join("../jetclass", "test_*.h5"))
         
+        self.selection = JetSelection(self.massrange, self.ptrange, self.etarange, self.skip_labels)
         self.model = Model(particle_feats = features,
                            n_consts = Np,
                            num_classes = self.num_classes,
@@ -652,6 +1069,8 @@ class PairwiseEvaluator:
                            interaction_mode = self.x_mode,
                            use_softmax = self.use_softmax,
                            use_dropout = self.use_dropout,
+                           pair_mode = self.pair_mode,
+                           use_p4 = self.use_p4,
                            Phi_sizes = self.phi_nodes,
                            F_sizes   = self.f_nodes).to(self.device)
         
@@ -659,7 +1078,7 @@ class PairwiseEvaluator:
         
         new_state_dict = OrderedDict()
         for k, v in state_dict.items():
-            if "module" in k:
+            if k.startswith("module."):
                 name = k[7:] # remove `module.`
             else:
                 name = k
@@ -675,33 +1094,53 @@ class PairwiseEvaluator:
 
         
     def index_groomer(self, a, y):
-        keep_masses = index_logic(self.m_logic,   self.m1,   self.m2,   a[:, 1])
-        keep_pts    = index_logic(self.pt_logic,  self.pt1,  self.pt2,  a[:, 2])
-        keep_etas   = index_logic(self.eta_logic, self.eta1, self.eta2, a[:, 3])
-
-        keep_labels = torch.tensor(np.isin(np.argmax(y.cpu().numpy(), 1), self.skip_labels, invert=True)).bool()
-
-        return (keep_masses & keep_pts & keep_etas & keep_labels).bool()
+        return self.selection.keep(a, y)
     
+    def ablate(self, x, m, a, mask_index = None, key = None):
+        # expected x dim: (Nb, Np, Nx), m dim: (Nb, 1, Np), a dim: (Nb, 7)
+        # returns latent embeddings, raw pair features, pre-activation outputs and probabilities with the particles in
+        # mask_index = [i, j] (i < j) masked in the interaction stage, and the index of pair (i, j)
+        # the stages before the masking come from self.cache, so only the masked stages run again for another mask_index;
+        # key is the batch key of (x, a) in self.cache, hashed from the inputs if None
+        if self.cache is not None and key is None:
+            key = self.cache.batch_key(x, a)
+        masked_track = None
+        particle_embeddings = self.model.get_particle_embeddings(x, m, self.cache, key)
+        if self.cache is not None:
+            E = self.cache.get(key, 'pairs', lambda: interaction_features(self.model, x, a, m))
+        else:
+            E = interaction_features(self.model, x, a, m)
+        if mask_index != None and len(mask_index) == 2 and mask_index[0] < mask_index[1]:
+            masked_track = getTrackID(self.model.Np, mask_index)
+            m = m.clone()
+            m[:, :, mask_index] = 0 
+        interaction_embeddings = interaction_embeddings_calc(self.model, E, x, a, m, self.cache, key)
+                    
+        if self.model.x_mode == 'sum':
+            latent_embeddings = particle_embeddings.sum(-1) + interaction_embeddings.sum(-1)
+        else:
+            latent_embeddings = torch.cat([particle_embeddings, interaction_embeddings], 1).sum(-1)
+            
+        preprob = self.model.fc[:-1](latent_embeddings)
+        if self.use_softmax:
+            prob = torch.softmax(preprob, 1)
+        else:
+            preprob = torch.relu(preprob)
+            prob = getprobs(preprob)
+        return latent_embeddings, E, preprob, prob, masked_track
+
     def evaluate(self, data_loader = None, mask_index = None):
         if not data_loader:
             if self.data_type == 'topdata' or self.data_type == 'jetnet' or self.data_type == "JNqgmerged":
-                test_set = PFINDataset(self.data_path)
-                testloader = DataLoader(test_set, shuffle=False, batch_size=512, num_workers=2, pin_memory=True, persistent_workers=True)
+                test_set = PFINDataset(self.data_path, use_p4 = self.use_p4)
+                testloader = batch_loader(test_set, 512, num_workers=2, pin_memory=True, persistent_workers=True)
             elif self.data_type == 'jetclass':
-                test_set = JetClassData(batch_size = 512)
+                test_set = JetClassData(batch_size = 512, use_p4 = self.use_p4)
                 test_set.set_file_names(file_names = self.data_path)
                 testloader = test_set.generate_data()
         else:
             testloader = data_loader
         masked_track = None
-        
-        F_layers = [layer for layer in self.model.fc[:-1]]
-        modelFC_ps = nn.Sequential(*F_layers)
-        if self.use_softmax:
-            activation = nn.Softmax(dim=1)
-        else:
-            activation = nn.ReLU()
                 
         labels = []
         preprobs = []
@@ -712,28 +1151,11 @@ class PairwiseEvaluator:
         intfeat = []
         with torch.no_grad():
             for idx, (x,m,a,y) in enumerate(testloader):
-                x = x.cuda()
-                m = m.cuda()
-                a = a.cuda()
+                x = x.to(self.device)
+                m = m.to(self.device)
+                a = a.to(self.device)
                 
-                particle_embeddings = self.model.get_particle_embeddings(x, m)
-                E = interaction_features(self.model, x, a, m)
-                if mask_index != None and len(mask_index) == 2 and mask_index[0] < mask_index[1]:
-                    masked_track = getTrackID(self.model.Np, mask_index)
-                    m[:, :, mask_index] = 0 
-                interaction_embeddings = interaction_embeddings_calc(self.model, E, x, a, m)
-                            
-                if self.model.x_mode == 'sum':
-                    latent_embeddings = particle_embeddings.sum(-1) + interaction_embeddings.sum(-1)
-                else:
-                    latent_embeddings = torch.cat([particle_embeddings, interaction_embeddings], 1).sum(-1)
-                    
-                preprob = modelFC_ps(latent_embeddings)
-                if self.use_softmax:
-                    prob = activation(preprob)
-                else:
-                    preprob = activation(preprob)
-                    prob = getprobs(preprob)
+                latent_embeddings, E, preprob, prob, masked_track = self.ablate(x, m, a, mask_index)
 
                 latents.append(latent_embeddings.cpu().numpy())
                 labels.append(np.argmax(y, 1))
@@ -760,39 +1182,73 @@ class PairwiseEvaluator:
         
                     
         return latents, labels, intfeat, preprobs, probs, masked_track, uncs        
+
+    def sweep(self, data_loader, mask_indices, max_batches = 101):
+        """Probabilities for every mask_index in mask_indices, e.g. all pairs (i, j) with i < j. Loops over the
+        mask indices inside the loop over the batches, so a cache budget of one batch is enough for every ablation
+        after the first to reuse the unmasked stages (looping over the batches once per mask index as with evaluate
+        only hits the LRU cache when all batches fit in it). Returns labels with dim (N,), probs with dim (M, N, C)
+        and, without softmax, uncs with dim (M, N)"""
+        labels = []
+        probs = []
+        uncs = []
+        with torch.no_grad():
+            for idx, (x,m,a,y) in enumerate(data_loader):
+                if idx == max_batches:
+                    break
+                x = x.to(self.device)
+                m = m.to(self.device)
+                a = a.to(self.device)
+                key = self.cache.batch_key(x, a) if self.cache is not None else None
+                batch_probs = []
+                batch_uncs = []
+                for mask_index in mask_indices:
+                    _, _, preprob, prob, _ = self.ablate(x, m, a, mask_index, key)
+                    batch_probs.append(prob.cpu().numpy())
+                    if not self.use_softmax:
+                        batch_uncs.append(len(self.label_indices)*1.0 / (preprob+1).sum(-1).cpu().numpy())
+                labels.append(np.argmax(y.numpy(), 1))
+                probs.append(np.stack(batch_probs))
+                if not self.use_softmax:
+                    uncs.append(np.stack(batch_uncs))
+        labels = np.concatenate(labels, axis = 0)
+        probs = np.concatenate(probs, axis = 1)
+        if not self.use_softmax:
+            uncs = np.concatenate(uncs, axis = 1)
+        return labels, probs, uncs
         
         
 def uncertainty_plot(uncs, oods, maxprobs, labels, preds, key, l_max, fsize, tsize, asize, asize2):
     fig, axes = plt.subplots(2, 4, figsize=(8*5, 8*2), sharex = False, sharey = False)
     
-    axes[0, 0].hist(uncs[~oods],
-                    bins=np.arange(0.,1.01,0.04), 
-                    label=key + '(~oods)', 
-                    alpha = 0.7, 
-                    histtype = 'step', linewidth = 3)
+    plot_hist(axes[0, 0], uncs[~oods],
+              bins=np.arange(0.,1.01,0.04), 
+              label=key + '(~oods)', 
+              alpha = 0.7, 
+              histtype = 'step', linewidth = 3)
     axes[0, 0].set_xlabel("Uncertainty", fontsize=fsize)
     axes[0, 0].tick_params(axis='both', labelsize=tsize)
-    axes[1, 0].hist(uncs[oods],
-                    bins=np.arange(0.,1.01,0.04), 
-                    label=key + '(oods)', 
-                    alpha = 0.7, 
-                    histtype = 'step', linewidth = 3)
+    plot_hist(axes[1, 0], uncs[oods],
+              bins=np.arange(0.,1.01,0.04), 
+              label=key + '(oods)', 
+              alpha = 0.7, 
+              histtype = 'step', linewidth = 3)
     axes[1, 0].set_xlabel("Uncertainty", fontsize=fsize)
     axes[1, 0].tick_params(axis='both', labelsize=tsize)
     
     
-    h = axes[0, 1].hist2d(maxprobs[~oods], uncs[~oods], 
-                          cmap = 'winter',
-                          bins = [np.arange(0.,1.01,0.04), np.arange(0.,1.01,0.04)])
+    h = plot_hist2d(axes[0, 1], maxprobs[~oods], uncs[~oods], 
+                    cmap = 'winter',
+                    bins = [np.arange(0.,1.01,0.04), np.arange(0.,1.01,0.04)])
     cbar = fig.colorbar(h[3], ax=axes[0, 1])
     axes[0, 1].set_xlabel("Max. Prob.", fontsize=fsize)
     axes[0, 1].set_ylabel("Uncertainty", fontsize=fsize)
     axes[0, 1].tick_params(axis='both', labelsize=tsize)
     cbar.ax.tick_params(axis='y', labelsize=tsize)
     
-    h = axes[1, 1].hist2d(maxprobs[oods], uncs[oods], 
-                          cmap = 'winter',
-                          bins = [np.arange(0.,1.01,0.04), np.arange(0.,1.01,0.04)])
+    h = plot_hist2d(axes[1, 1], maxprobs[oods], uncs[oods], 
+                    cmap = 'winter',
+                    bins = [np.arange(0.,1.01,0.04), np.arange(0.,1.01,0.04)])
     cbar = fig.colorbar(h[3], ax=axes[1, 1])
     axes[1, 1].set_xlabel("Max. Prob.", fontsize=fsize)
     axes[1, 1].set_ylabel("Uncertainty", fontsize=fsize)
@@ -800,9 +1256,9 @@ def uncertainty_plot(uncs, oods, maxprobs, labels, preds, key, l_max, fsize, tsi
     cbar.ax.tick_params(axis='y', labelsize=tsize)
     
     
-    h = axes[0, 2].hist2d(labels[~oods], preds[~oods], 
-                          cmap = 'winter',
-                          bins = [np.arange(0.,l_max,1), np.arange(0.,l_max,1)])
+    h = plot_hist2d(axes[0, 2], labels[~oods], preds[~oods], 
+                    cmap = 'winter',
+                    bins = [np.arange(0.,l_max,1), np.arange(0.,l_max,1)])
     
     for i in range(len(h[2])-1):
         for j in range(len(h[1])-1):
@@ -815,9 +1271,9 @@ def uncertainty_plot(uncs, oods, maxprobs, labels, preds, key, l_max, fsize, tsi
     axes[0, 2].tick_params(axis='both', labelsize=tsize)
     cbar.ax.tick_params(axis='y', labelsize=tsize)
     
-    h = axes[1, 2].hist2d(labels[oods], preds[oods], 
-                          cmap = 'winter',
-                          bins = [np.arange(0.,l_max,1), np.arange(0.,l_max,1)])
+    h = plot_hist2d(axes[1, 2], labels[oods], preds[oods], 
+                    cmap = 'winter',
+                    bins = [np.arange(0.,l_max,1), np.arange(0.,l_max,1)])
     for i in range(len(h[2])-1):
         for j in range(len(h[1])-1):
             axes[1,2].text(h[1][j]+0.5,h[2][i]+0.5, int(h[0].T[i,j]), 
@@ -829,9 +1285,9 @@ def uncertainty_plot(uncs, oods, maxprobs, labels, preds, key, l_max, fsize, tsi
     cbar.ax.tick_params(axis='y', labelsize=tsize)
     
     
-    h = axes[0, 3].hist2d(labels[~oods], uncs[~oods] + preds[~oods] -1.e-4, 
-                          cmap = 'winter',
-                          bins = [np.arange(0.,l_max,1), np.arange(0.,l_max,0.2)])
+    h = plot_hist2d(axes[0, 3], labels[~oods], uncs[~oods] + preds[~oods] -1.e-4, 
+                    cmap = 'winter',
+                    bins = [np.arange(0.,l_max,1), np.arange(0.,l_max,0.2)])
     cbar = fig.colorbar(h[3], ax=axes[0, 3])
     axes[0, 3].set_xlabel("Labels", fontsize=fsize)
     axes[0, 3].set_ylabel("Pred. Label + Unc.", fontsize=fsize)
@@ -844,9 +1300,9 @@ def uncertainty_plot(uncs, oods, maxprobs, labels, preds, key, l_max, fsize, tsi
     for jj in np.arange(1,l_max,1):
         axes[0, 3].axhline(jj)
     
-    h = axes[1, 3].hist2d(labels[oods], uncs[oods] + preds[oods] -1.e-4, 
-                          cmap = 'winter',
-                          bins = [np.arange(0.,l_max,1), np.arange(0.,l_max,0.2)])
+    h = plot_hist2d(axes[1, 3], labels[oods], uncs[oods] + preds[oods] -1.e-4, 
+                    cmap = 'winter',
+                    bins = [np.arange(0.,l_max,1), np.arange(0.,l_max,0.2)])
     cbar = fig.colorbar(h[3], ax=axes[1, 3])
     axes[1, 3].set_xlabel("Labels", fontsize=fsize)
     axes[1, 3].set_ylabel("Pred. Label + Unc.", fontsize=fsize)
@@ -0,0 +1,97 @@
+import torch
+import math
+import functools
+from collections import namedtuple
+
+eps=1e-15
+
+def fp32(fn):
+    """Runs a loss with autocast disabled and half-precision tensor arguments cast to float32,
+    since lgamma/digamma and the 1 - p differences lose too much precision in fp16/bf16"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        device_type = next(a.device.type for a in args if torch.is_tensor(a))
+        with torch.autocast(device_type=device_type, enabled=False):
+            return fn(*[a.float() if torch.is_tensor(a) and a.dtype in (torch.float16, torch.bfloat16) else a for a in args], **kwargs)
+    return wrapper
+
+@fp32
+def LossCE(labels, outs):
+    # labels size: (Nb, nclasses) [true values]
+    # outs size: (Nb, nclasses) [NN predictions]
+    # return -(labels * torch.log(outs)).sum(1).mean()
+    return -(labels * torch.log(outs.clamp(min=eps, max=1-eps))).sum(1).mean()
+
+def getprobs(outs):
+    alphas = outs + 1
+    S = torch.sum(alphas, 1).reshape(-1,1)
+    return alphas / S
+    
+@fp32
+def LossCE_Bayes(labels, outs):
+    # labels size: (Nb, nclasses) [true values]
+    # outs size: (Nb, nclasses) [NN predictions]
+    alphas = outs + 1
+    S = torch.sum(alphas, 1).reshape(-1,1)
+    return (labels * (torch.log(S) - torch.log(alphas))).sum(1).mean()
+
+@fp32
+def LossCE_Gibbs(labels, outs):
+    # labels size: (Nb, nclasses) [true values]
+    # outs size: (Nb, nclasses) [NN predictions]
+    alphas = outs + 1
+    S = torch.sum(alphas, 1).reshape(-1,1)
+    return (labels * (torch.digamma(S) - torch.digamma(alphas))).sum(1).mean()
+
+@fp32
+def LossMSE(labels, outs):
+    # labels size: (Nb, nclasses) [true values]
+    # outs size: (Nb, nclasses) [NN predictions]
+    alphas = outs + 1
+    S = torch.sum(alphas, 1).reshape(-1,1)
+    probs = alphas / S
+    return ((labels - probs)**2 + probs * (1 - probs) / (1 + S)).sum(1).mean()
+
+def fgamma(x):
+    return torch.exp(torch.lgamma(x))
+
+@fp32
+def KLDiv(labels, outs):
+    K = torch.tensor(labels.shape[-1]).float()
+    alphas = outs + 1
+    _alphas = labels + (1-labels)*alphas
+    _S = torch.sum(_alphas, 1).reshape(-1,1)
+    lognum = torch.lgamma(_S)
+    logden = torch.lgamma(K*1.0) + torch.lgamma(_alphas).sum(1).reshape(-1,1)
+    t2 = ((_alphas - 1) * (torch.digamma(_alphas) - torch.digamma(_S) )).sum(1).reshape(-1,1)
+    return (lognum - logden + t2).mean()
+
+EDLLoss = namedtuple("EDLLoss", ["loss", "mse", "kl"])
+
+@fp32
+def edl_loss(labels, outs, kl_coef = 1.0, kind = "mse"):
+    """Evidential loss of one batch with its components, computing the Dirichlet parameters once.
+    kind selects the data term: "mse" (LossMSE), "bayes" (LossCE_Bayes) or "gibbs" (LossCE_Gibbs).
+    Returns EDLLoss(loss = data term + kl_coef * KL, mse = data term, kl = KLDiv); with kl_coef = 0
+    the loss is the data term alone, as in train.py before the KL term is switched on."""
+    # labels size: (Nb, nclasses) [true values]
+    # outs size: (Nb, nclasses) [NN predictions]
+    alphas = outs + 1
+    S = torch.sum(alphas, 1, keepdim=True)
+    if kind == "mse":
+        probs = alphas / S
+        data = ((labels - probs)**2 + probs * (1 - probs) / (1 + S)).sum(1).mean()
+    elif kind == "bayes":
+        data = (labels * (torch.log(S) - torch.log(alphas))).sum(1).mean()
+    elif kind == "gibbs":
+        data = (labels * (torch.digamma(S) - torch.digamma(alphas))).sum(1).mean()
+    else:
+        raise ValueError("Unknown EDL loss kind '{}'".format(kind))
+    # KL divergence of the Dirichlet with the true-class evidence removed from the uniform Dirichlet
+    _alphas = labels + (1 - labels) * alphas
+    _S = torch.sum(_alphas, 1, keepdim=True)
+    t2 = ((_alphas - 1) * (torch.digamma(_alphas) - torch.digamma(_S))).sum(1, keepdim=True)
+    kl = (torch.lgamma(_S) - math.lgamma(labels.shape[-1]) - torch.lgamma(_alphas).sum(1, keepdim=True) + t2).mean()
+    loss = data + kl_coef * kl if kl_coef != 0 else data
+    return EDLLoss(loss, data, kl)
+
@@ -1,82 +1,580 @@
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import h5py
 import numpy as np
 from torch.utils.data import DataLoader
 import sys,os
+import hashlib, json
+import queue, threading, time
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
+def temp_path(path):
+    # temporary file next to path, unique to this process and thread, to write path with os.replace while other
+    # processes (DDP ranks, evaluate_model.py --workers, DataLoader workers) may write it at the same time
+    return "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+
+class DatasetManifest(object):
+    """JSON sidecar (manifest.json) describing the processed HDF5 files of one directory, so their sizes are known
+    without opening them. Entries are keyed by file name and store the file size and mtime they were made from;
+    a file whose size or mtime changed is described again on the next access.
+    Each entry holds the number of rows and, for every dataset, its dtype and shape. The min/max along the last axis
+    of every dataset take a full read of the file, so they are only added (with "stats": true) once get() asks for
+    them; rows() never does. If the directory is not writable the manifest is only kept in memory."""
+    file_name = "manifest.json"
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, self.file_name)
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        # entries other processes wrote since this one read the manifest are kept, unless this one has the same file
+        tmp = temp_path(self.path)
+        try:
+            try:
+                with open(self.path) as f:
+                    entries = json.load(f)
+            except (OSError, ValueError):
+                entries = {}
+            entries.update(self.entries)
+            with open(tmp, "w") as f:
+                json.dump(entries, f, indent=1)
+            os.replace(tmp, self.path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def get(self, file_path, stats = True):
+        """Returns the entry of file_path, describing the file first if it is new or changed, or if stats are asked
+        for and the entry has none yet"""
+        st = os.stat(file_path)
+        key = os.path.basename(file_path)
+        entry = self.entries.get(key)
+        if entry is None or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime_ns or (stats and not entry.get("stats")):
+            entry = self.describe(file_path, stats = stats)
+            entry["size"], entry["mtime"] = st.st_size, st.st_mtime_ns
+            self.entries[key] = entry
+            self.save()
+        return entry
+
+    def rows(self, file_path):
+        return self.get(file_path, stats = False)["rows"]
+
+    @staticmethod
+    def describe(file_path, stats = True, chunk_size = 100000):
+        # without stats only the HDF5 metadata is read
+        datasets = {}
+        with h5py.File(file_path, "r") as f:
+            for key in f.keys():
+                d = f[key]
+                if hasattr(d, "keys"):
+                    continue
+                datasets[key] = {"dtype": str(d.dtype), "shape": list(d.shape)}
+                if not stats:
+                    continue
+                lo, hi = None, None
+                for start in range(0, len(d), chunk_size):
+                    block = d[start:start+chunk_size].reshape(-1, d.shape[-1]) if d.ndim > 1 else d[start:start+chunk_size]
+                    lo = block.min(0) if lo is None else np.minimum(lo, block.min(0))
+                    hi = block.max(0) if hi is None else np.maximum(hi, block.max(0))
+                datasets[key]["min"] = np.atleast_1d(lo).tolist() if lo is not None else None
+                datasets[key]["max"] = np.atleast_1d(hi).tolist() if hi is not None else None
+        rows = datasets["particles"]["shape"][0] if "particles" in datasets else datasets[list(datasets)[0]]["shape"][0]
+        return {"rows": rows, "datasets": datasets, "stats": stats}
+
+_manifests = {}
+
+def get_manifest(file_path):
+    """Returns the DatasetManifest of the directory of file_path, loaded once per process"""
+    directory = os.path.dirname(os.path.abspath(file_path))
+    if directory not in _manifests:
+        _manifests[directory] = DatasetManifest(directory)
+    return _manifests[directory]
+
+class JetSelection(object):
+    """Jet-level cuts of the --mass-range, --pt-range, --eta-range and --skip-labels options, applied to aug_data
+    (columns 1, 2, 3 = mass, pt, eta) and the one-hot labels. A range 'AND:v1,v2' keeps v1 < x < v2, any other
+    logic keeps x < v1 or x > v2. keep() works on numpy arrays and on torch tensors on any device; indices()
+    turns the cuts into the rows of a file that pass them, so loaders can drop the others before batching."""
+    columns = [1, 2, 3]
+
+    def __init__(self, massrange, ptrange, etarange, skip_labels = ()):
+        self.cuts = []
+        for col, cut in zip(self.columns, [massrange, ptrange, etarange]):
+            logic, (v1, v2) = cut.strip().split(':')[0], list(map(float, cut.strip().split(':')[1].split(',')))
+            self.cuts.append((col, logic, min(v1, v2), max(v1, v2)))
+        self.skip_labels = sorted(int(label) for label in skip_labels)
+
+    def keep(self, a, y):
+        # expected a dim: (Nb, 7), y dim: (Nb, num_classes)
+        # return boolean mask with dim: (Nb)
+        if torch.is_tensor(a):
+            keep = torch.ones(len(a), dtype=torch.bool, device=a.device)
+        else:
+            keep = np.ones(len(a), dtype=bool)
+        for col, logic, lo, hi in self.cuts:
+            v = a[:, col]
+            keep &= ((v > lo) & (v < hi)) if logic == 'AND' else ((v < lo) | (v > hi))
+        if self.skip_labels:
+            if torch.is_tensor(y):
+                keep &= ~torch.isin(y.argmax(1), torch.tensor(self.skip_labels, device=y.device))
+            else:
+                keep &= ~np.isin(y.argmax(1), self.skip_labels)
+        return keep
+
+    def indices(self, file_path, cache_dir = None, chunk_size = 1000000):
+        """Sorted int64 rows of file_path that pass the cuts. With cache_dir they are stored as a .npy file
+        named after the file path, size, mtime and the cuts, so a changed file or selection is recomputed."""
+        if cache_dir:
+            st = os.stat(file_path)
+            tag = hashlib.md5(json.dumps([os.path.abspath(file_path), st.st_size, st.st_mtime_ns, self.cuts, self.skip_labels]).encode()).hexdigest()[:16]
+            path = os.path.join(cache_dir, tag + "_" + os.path.basename(file_path).replace(".h5", "") + "_rows.npy")
+            if os.path.exists(path):
+                return np.load(path)
+        rows = []
+        with h5py.File(file_path, 'r') as f:
+            for start in range(0, len(f["aug_data"]), chunk_size):
+                keep = self.keep(f["aug_data"][start:start+chunk_size], f["labels"][start:start+chunk_size])
+                rows.append(np.nonzero(keep)[0] + start)
+        rows = np.concatenate(rows).astype(np.int64) if rows else np.zeros(0, dtype=np.int64)
+        if cache_dir:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            # every DDP rank computes the same rows, so each writes its own temp file
+            tmp = temp_path(path) + ".npy"
+            np.save(tmp, rows)
+            os.replace(tmp, path)
+        return rows
+
 class PFINDataset(Dataset):
-    def __init__(self, file_path):
-        f = h5py.File(file_path, 'r')
-        self.data = torch.from_numpy(f["particles"][:]).float()
-        self.masks = torch.from_numpy(f["masks"][:]).float()
-        #self.latents = torch.from_numpy(f["latents"][:]).float()
-        self.labels = torch.from_numpy(f["labels"][:]).float()
-        #self.preds = torch.from_numpy(f["preds"][:]).float()
-        self.aug_data = torch.from_numpy(f["aug_data"][:]).float()
-        #self.taus = torch.from_numpy(f["taus"][:]).float()
+    def __init__(self, file_path, use_p4 = False, selection = None):
+        """selection: optional JetSelection; jets failing it are dropped when the file is loaded"""
+        self.file_path = file_path
+        self.selection = selection
+        with h5py.File(file_path, 'r') as f:
+            self.data = torch.from_numpy(f["particles"][:]).float()
+            if use_p4:
+                # precomputed (E, px, py, pz) are appended to the particle features, see UQPFIN.split_p4
+                self.data = torch.cat([self.data, torch.from_numpy(f["p4"][:]).float()], -1)
+            self.masks = torch.from_numpy(f["masks"][:]).float()
+            #self.latents = torch.from_numpy(f["latents"][:]).float()
+            self.labels = torch.from_numpy(f["labels"][:]).float()
+            #self.preds = torch.from_numpy(f["preds"][:]).float()
+            self.aug_data = torch.from_numpy(f["aug_data"][:]).float()
+            #self.taus = torch.from_numpy(f["taus"][:]).float()
+        if selection is not None:
+            keep = selection.keep(self.aug_data, self.labels)
+            if not keep.all():
+                self.data, self.masks, self.labels, self.aug_data = self.data[keep], self.masks[keep], self.labels[keep], self.aug_data[keep]
         
     def __len__(self):
         return len(self.masks)
 
+    def share_memory_(self):
+        # moves the tensors to shared memory, so worker processes read the one copy instead of their own
+        for t in [self.data, self.masks, self.labels, self.aug_data]:
+            t.share_memory_()
+        return self
+
     def __getitem__(self, idx):
+        # idx can be a single index, a slice or a list/array of indices from a batch sampler, which returns a stacked batch
+        if isinstance(idx, (list, np.ndarray)):
+            idx = torch.as_tensor(idx)
         return self.data[idx], self.masks[idx], self.aug_data[idx], self.labels[idx]
 
+class LazyPFINDataset(Dataset):
+    """Same samples as PFINDataset, but read on demand instead of loaded into RAM.
+    The HDF5 file (or the .npy cache) is opened once per process, so every DataLoader worker gets its own handle.
+    Meant to be indexed with contiguous slices from ContiguousBatchSampler, which returns whole batches.
+    Attributes:
+      file_path: processed HDF5 file
+      cache_dir: optional directory for a float32 .npy copy of every dataset, which is memory-mapped so
+        all workers share the OS page cache instead of holding private copies
+    """
+    keys = ["particles", "masks", "aug_data", "labels"]
+
+    def __init__(self, file_path, use_p4 = False, cache_dir = None, selection = None):
+        """selection: optional JetSelection; only the rows passing it are indexed (their row list is
+        cached in cache_dir if given)"""
+        self.file_path = file_path
+        self.use_p4 = use_p4
+        self.cache_dir = cache_dir
+        # file_rows: rows in the file, length: rows indexed after the selection
+        self.file_rows = get_manifest(file_path).rows(file_path)
+        self.length = self.file_rows
+        self.rows = None
+        if selection is not None:
+            self.rows = selection.indices(file_path, cache_dir)
+            if len(self.rows) == self.file_rows:
+                self.rows = None
+            else:
+                self.length = len(self.rows)
+        if self.cache_dir:
+            self.build_cache()
+        self.h5_file = None
+        self.arrays = None
+        self.pid = None
+
+    def cache_path(self, key):
+        # files are prefixed with a hash of the full path, as e.g. topdata and jetnet both have a train.h5
+        tag = hashlib.md5(os.path.abspath(self.file_path).encode()).hexdigest()[:8]
+        return os.path.join(self.cache_dir, tag + "_" + os.path.basename(self.file_path).replace(".h5", "") + "_" + key + ".npy")
+
+    def build_cache(self, chunk_size = 100000):
+        """Writes every dataset to a float32 .npy file, unless an up-to-date copy already exists. All rows of the
+        file are copied, also with a selection, as self.rows index the file"""
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with h5py.File(self.file_path, 'r') as f:
+            for key in self.keys + (["p4"] if self.use_p4 else []):
+                path = self.cache_path(key)
+                if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(self.file_path):
+                    continue
+                # each process (e.g. DDP rank) that finds no copy writes its own temp file
+                tmp = temp_path(path)
+                out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=f[key].shape)
+                for start in range(0, f[key].shape[0], chunk_size):
+                    out[start:start+chunk_size] = f[key][start:start+chunk_size]
+                out.flush()
+                del out
+                os.replace(tmp, path)
+
+    def open(self):
+        """Opens the data once per process; handles are not inherited from the parent or across forks"""
+        if self.arrays is not None and self.pid == os.getpid():
+            return self.arrays
+        keys = self.keys + (["p4"] if self.use_p4 else [])
+        if self.cache_dir:
+            self.arrays = {key: np.load(self.cache_path(key), mmap_mode='r') for key in keys}
+        else:
+            self.h5_file = h5py.File(self.file_path, 'r')
+            self.arrays = {key: self.h5_file[key] for key in keys}
+        self.pid = os.getpid()
+        return self.arrays
+
+    def close(self):
+        if self.h5_file is not None and self.pid == os.getpid():
+            self.h5_file.close()
+        self.h5_file = None
+        self.arrays = None
+        self.pid = None
+
+    def __getstate__(self):
+        # open handles cannot be pickled into spawned workers; they reopen the file on first access
+        state = self.__dict__.copy()
+        state["h5_file"] = None
+        state["arrays"] = None
+        state["pid"] = None
+        return state
+
+    def __len__(self):
+        return self.length
+
+    def read(self, key, idx):
+        # float32 tensor of arrays[key][idx]; reads from the memory-mapped cache are copied so the tensor owns its memory
+        array = self.open()[key]
+        if self.rows is not None:
+            if isinstance(idx, (list, torch.Tensor)):
+                idx = np.asarray(idx)
+            rows = self.rows[idx]
+            if isinstance(idx, slice) and len(rows):
+                # one contiguous read spanning the selected rows, which are then picked in memory
+                span = array[rows[0]:rows[-1]+1]
+                return torch.from_numpy(np.asarray(span)[rows - rows[0]].astype(np.float32, copy=False))
+            idx = rows
+        if isinstance(idx, (list, np.ndarray, torch.Tensor)) and not isinstance(array, np.ndarray):
+            # h5py only reads strictly increasing indices: read them sorted and restore the requested order
+            idx, inverse = np.unique(np.asarray(idx), return_inverse=True)
+            return torch.from_numpy(array[idx][inverse].astype(np.float32, copy=False))
+        batch = array[idx]
+        return torch.from_numpy(batch.astype(np.float32, copy=isinstance(batch, np.memmap)))
+
+    def __getitem__(self, idx):
+        data = self.read("particles", idx)
+        if self.use_p4:
+            data = torch.cat([data, self.read("p4", idx)], -1)
+        return data, self.read("masks", idx), self.read("aug_data", idx), self.read("labels", idx)
+
+class ShardedSampler(Sampler):
+    """Base class of the batch samplers below, which can split each epoch between the processes of a
+    distributed run. With num_replicas > 1 every rank draws the same permutation (from seed and the epoch
+    set with set_epoch) and keeps its own share of it, so the ranks see disjoint data and the same number
+    of batches; the few samples or batches that do not divide evenly are dropped each epoch.
+    With num_replicas = 1 the samplers behave as before and shuffle with np.random.
+    """
+    def __init__(self, num_samples, batch_size, drop_last = False, num_replicas = 1, rank = 0, seed = 0):
+        if not 0 <= rank < num_replicas:
+            raise ValueError("rank {} is not in [0, {})".format(rank, num_replicas))
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        # call before iterating each epoch so a distributed run draws a new permutation
+        self.epoch = epoch
+
+    def permutation(self, n):
+        if self.num_replicas > 1:
+            return np.random.default_rng((self.seed, self.epoch)).permutation(n)
+        return np.random.permutation(n)
+
+    def count_batches(self, num_samples):
+        if self.drop_last:
+            return num_samples // self.batch_size
+        return (num_samples + self.batch_size - 1) // self.batch_size
+
+class ContiguousBatchSampler(ShardedSampler):
+    """Yields slice(start, stop) objects covering the dataset in batches.
+    Use with DataLoader(dataset, sampler=ContiguousBatchSampler(...), batch_size=None), so that each
+    batch is a single contiguous read and no per-sample collation is done.
+    With shuffle=True the order of the batches is shuffled every epoch, not the samples inside them.
+    In a distributed run the batches are dealt out to the ranks.
+    """
+    def __init__(self, num_samples, batch_size, shuffle = False, drop_last = False, num_replicas = 1, rank = 0, seed = 0):
+        super(ContiguousBatchSampler, self).__init__(num_samples, batch_size, drop_last, num_replicas, rank, seed)
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return self.count_batches(self.num_samples) // self.num_replicas
+
+    def __iter__(self):
+        starts = np.arange(self.count_batches(self.num_samples)) * self.batch_size
+        if self.shuffle:
+            starts = starts[self.permutation(len(starts))]
+        for start in starts[self.rank::self.num_replicas][:len(self)]:
+            yield slice(int(start), int(min(start + self.batch_size, self.num_samples)))
+
+class RandomBatchSampler(ShardedSampler):
+    """Yields arrays of batch_size random indices, drawn from one permutation of the dataset per epoch.
+    Use with DataLoader(dataset, sampler=RandomBatchSampler(...), batch_size=None): the dataset
+    returns the whole batch from one fancy-indexing call and default_collate is skipped.
+    In a distributed run each rank batches num_samples // num_replicas samples of the permutation.
+    """
+    def __len__(self):
+        return self.count_batches(self.num_samples // self.num_replicas)
+
+    def __iter__(self):
+        idx = self.permutation(self.num_samples)[self.rank::self.num_replicas][:self.num_samples // self.num_replicas]
+        for i in range(len(self)):
+            yield idx[i*self.batch_size:(i+1)*self.batch_size]
+
+def batch_loader(dataset, batch_size, shuffle = False, contiguous = False, num_replicas = 1, rank = 0, seed = 0, **kwargs):
+    """Returns a DataLoader that hands whole batches of indices to the dataset instead of single samples.
+    Unshuffled or contiguous loaders read slices (in the same order as DataLoader(shuffle=False));
+    shuffled ones read random index arrays. num_replicas, rank and seed shard the batches between the
+    processes of a distributed run (see ShardedSampler); call loader.sampler.set_epoch(epoch) every epoch.
+    Other keyword arguments are passed on to the DataLoader."""
+    if contiguous or not shuffle:
+        sampler = ContiguousBatchSampler(len(dataset), batch_size, shuffle = shuffle, num_replicas = num_replicas, rank = rank, seed = seed)
+    else:
+        sampler = RandomBatchSampler(len(dataset), batch_size, num_replicas = num_replicas, rank = rank, seed = seed)
+    return DataLoader(dataset, sampler = sampler, batch_size = None, **kwargs)
+
+class Batches(object):
+    """Iterator over the batches of a Data generator that also has a length (the number of batches),
+    so progress bars get a total"""
+    def __init__(self, batches, num_batches):
+        self.batches = batches
+        self.num_batches = num_batches
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.batches)
+
+    def __len__(self):
+        return self.num_batches()
+
+    def close(self):
+        self.batches.close()
+
 class Data(object):
     """Class providing an interface to the input training data. Derived classes should implement the load_data function.
     Attributes:
       file_names: list of data files to use for training
       batch_size: size of training batches
+      num_replicas, rank: processes of a distributed run and the index of this one
+      shards: in a distributed run, file name => (lo, hi) range of the file's rows read by this process
+        (positions among the rows passing the selection, if there is one); None otherwise
+      pin_memory: yield every batch in page-locked memory (default: if CUDA is available), see batch_tensor
     """
 
-    def __init__(self, batch_size):
+    def __init__(self, batch_size, num_replicas = 1, rank = 0):
         """Stores the batch size and the names of the data files to be read.
         Params:
           batch_size: batch size for training
+          num_replicas: number of processes sharing the files in a distributed run
+          rank: index of this process; it reads the rank-th of num_replicas equal row shards (see set_file_names)
         """
         self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shards = None
+        self.pin_memory = torch.cuda.is_available()
 
 
     def set_file_names(self, file_names):
         # hook to copy data in /dev/shm
-        self.file_names = file_names
+        # in a distributed run the rows of all files, one after the other, are split into num_replicas contiguous
+        # shards of equal size, so every process runs the same number of batches even with fewer files than
+        # processes; the last (total rows % num_replicas) rows are not used
+        self.shards = None
+        if self.num_replicas == 1:
+            self.file_names = file_names
+            return
+        counts = [self.file_rows(in_file_name) for in_file_name in file_names]
+        per_rank = sum(counts) // self.num_replicas
+        lo, hi = self.rank * per_rank, (self.rank + 1) * per_rank
+        self.file_names, self.shards = [], {}
+        offset = 0
+        for in_file_name, n in zip(file_names, counts):
+            start, stop = max(lo - offset, 0), min(hi - offset, n)
+            if start < stop:
+                self.file_names.append(in_file_name)
+                self.shards[in_file_name] = (start, stop)
+            offset += n
 
+    def file_rows(self, in_file_name):
+        """Number of rows of in_file_name that can be used (e.g. passing a selection).
+        Not implemented in base class; derived classes should implement this function"""
+        raise NotImplementedError
+
+
+    def generate_data(self, shuffle=False, prefetch=0):
+        """Yields batches of training data until none are left.
+        Params:
+          shuffle: shuffle the file order and the samples within each file
+          prefetch: if > 0, files are read and batches are built on a background thread, which keeps up
+            to `prefetch` batches queued and reads the next file while the current one is consumed.
+            The batch order is the same as without prefetching. Stats end up in self.prefetch_stats.
+        """
+        if prefetch > 0:
+            batches = self.prefetch_batches(self.generate_batches(shuffle=shuffle, read_ahead=True), prefetch)
+        else:
+            batches = self.generate_batches(shuffle=shuffle)
+        return Batches(batches, self.num_batches)
+
+    def num_batches(self):
+        """Number of batches yielded per epoch; the incomplete last batch is dropped"""
+        return self.count_data() // self.batch_size
 
-    def generate_data(self, shuffle=False):
-        """Yields batches of training data until none are left."""
+    def generate_batches(self, shuffle=False, read_ahead=False):
+        """Yields batches of training data until none are left.
+        With read_ahead the next file is loaded on a worker thread while the current one is sliced."""
         leftovers = None
         file_names = self.file_names.copy()
         if shuffle:
             np.random.shuffle(file_names)
-          
-        for cur_file_name in file_names:
-            data, mask, aug_data, labels = self.load_data(cur_file_name, shuffle=shuffle)
-            # concatenate any leftover data from the previous file
-            if leftovers is not None:
-                data = self.concat_data(leftovers[0], data)
-                mask = self.concat_data(leftovers[1], mask)
-                aug_data = self.concat_data(leftovers[2], aug_data)
-                labels = self.concat_data(leftovers[3], labels)
-                leftovers = None
-            num_in_file = self.get_num_samples(data)
-
-            for cur_pos in range(0, num_in_file, self.batch_size):
-                next_pos = cur_pos + self.batch_size
-                if next_pos <= num_in_file:
-                        yield (
-                            torch.from_numpy(self.get_batch(data, cur_pos, next_pos)).float(),
-                            torch.from_numpy(self.get_batch(mask, cur_pos, next_pos)).float(),
-                            torch.from_numpy(self.get_batch(aug_data, cur_pos, next_pos)).float(),
-                            torch.from_numpy(self.get_batch(labels, cur_pos, next_pos)).float(),
-                        )
+
+        pool = ThreadPoolExecutor(max_workers=1) if read_ahead else None
+        future = None
+        self.file_wait_time = 0.
+        try:
+            for ii, cur_file_name in enumerate(file_names):
+                if future is not None:
+                    start = time.perf_counter()
+                    data, mask, aug_data, labels = future.result()
+                    self.file_wait_time += time.perf_counter() - start
+                else:
+                    data, mask, aug_data, labels = self.load_data(cur_file_name, shuffle=shuffle)
+                if pool is not None and ii + 1 < len(file_names):
+                    future = pool.submit(self.load_data, file_names[ii + 1], shuffle=shuffle)
                 else:
-                    leftovers = (
-                            self.get_batch(data, cur_pos, num_in_file),
-                            self.get_batch(mask, cur_pos, num_in_file),
-                            self.get_batch(aug_data, cur_pos, num_in_file),
-                            self.get_batch(labels, cur_pos, num_in_file),
-                        )
+                    future = None
+                num_in_file = self.get_num_samples(data)
+                first_pos = 0
+                # complete the batch started by the leftover rows of the previous file
+                if leftovers is not None:
+                    need = self.batch_size - self.get_num_samples(leftovers[0])
+                    if need > num_in_file:
+                        leftovers = tuple(self.concat_data(left, d) for left, d in zip(leftovers, (data, mask, aug_data, labels)))
+                        continue
+                    yield tuple(self.batch_tensor(left, d[:need]) for left, d in zip(leftovers, (data, mask, aug_data, labels)))
+                    leftovers = None
+                    first_pos = need
+
+                for cur_pos in range(first_pos, num_in_file, self.batch_size):
+                    next_pos = cur_pos + self.batch_size
+                    if next_pos <= num_in_file:
+                            yield (
+                                self.batch_tensor(self.get_batch(data, cur_pos, next_pos)),
+                                self.batch_tensor(self.get_batch(mask, cur_pos, next_pos)),
+                                self.batch_tensor(self.get_batch(aug_data, cur_pos, next_pos)),
+                                self.batch_tensor(self.get_batch(labels, cur_pos, next_pos)),
+                            )
+                    else:
+                        leftovers = (
+                                self.get_batch(data, cur_pos, num_in_file),
+                                self.get_batch(mask, cur_pos, num_in_file),
+                                self.get_batch(aug_data, cur_pos, num_in_file),
+                                self.get_batch(labels, cur_pos, num_in_file),
+                            )
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+    def prefetch_batches(self, batches, prefetch):
+        """Runs the `batches` generator on a background thread and yields its items from a bounded queue.
+        Records in self.prefetch_stats: number of batches, time the consumer stalled on an empty queue,
+        mean/max queue depth seen by the consumer and time the producer waited for file reads."""
+        batch_queue = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            # gives up once the consumer has stopped reading, so the thread never blocks on a full queue
+            while not stop.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def producer():
+            try:
+                for batch in batches:
+                    if not put(batch):
+                        break
+                else:
+                    put(done)
+            except BaseException as e:
+                put(e)
+            finally:
+                batches.close()
+
+        self.prefetch_stats = {"batches": 0, "stall_time": 0., "mean_queue_depth": 0., "max_queue_depth": 0, "file_wait_time": 0.}
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        depth_sum = 0
+        try:
+            while True:
+                depth = batch_queue.qsize()
+                start = time.perf_counter()
+                item = batch_queue.get()
+                self.prefetch_stats["stall_time"] += time.perf_counter() - start
+                if item is done:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                depth_sum += depth
+                self.prefetch_stats["batches"] += 1
+                self.prefetch_stats["max_queue_depth"] = max(self.prefetch_stats["max_queue_depth"], depth)
+                self.prefetch_stats["mean_queue_depth"] = depth_sum / self.prefetch_stats["batches"]
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+            self.prefetch_stats["file_wait_time"] = getattr(self, "file_wait_time", 0.)
 
     def count_data(self):
         """Counts the number of data points across all files"""
@@ -97,6 +595,22 @@ class Data(object):
         else:
             return [arr[start_pos:end_pos] for arr in data]
 
+    def batch_tensor(self, *parts):
+        """Input: numpy arrays with the consecutive rows of one batch: a slice of one file, or the leftover rows
+          of a file and the first rows of the next one, which are stitched without copying the rest of that file.
+        Returns: float tensor of the rows. With self.pin_memory they are written into page-locked memory from torch's
+          caching host allocator, which hands a block out again only once the non_blocking copies from it have
+          finished; so buffers are reused across batches, but never while prefetched or in-flight batches still
+          use them. Without pinning a single part is returned without a copy."""
+        if len(parts) == 1 and not self.pin_memory:
+            return torch.from_numpy(parts[0]).float()
+        out = torch.empty((sum(len(part) for part in parts),) + parts[0].shape[1:], dtype=torch.float32, pin_memory=self.pin_memory)
+        pos = 0
+        for part in parts:
+            out[pos:pos + len(part)] = torch.from_numpy(part)
+            pos += len(part)
+        return out
+
     def concat_data(self, data1, data2):
         """Input: data1 as numpy array or list of numpy arrays.  data2 in the same format.
         Returns: numpy array or list of arrays, in which each array in data1 has been
@@ -131,19 +645,158 @@ class JetClassData(Data):
 
     def __init__(
         self,
-        batch_size):
-        super(JetClassData, self).__init__(batch_size)
+        batch_size,
+        use_p4 = False,
+        shuffle_buffer = 0,
+        chunk_size = None,
+        selection = None,
+        cache_dir = None,
+        num_replicas = 1,
+        rank = 0):
+        """shuffle_buffer: if > 0, generate_data(shuffle=True) streams chunks of chunk_size jets in random order
+        across all files through a buffer of shuffle_buffer jets instead of loading and permuting whole files.
+        chunk_size defaults to the HDF5 chunk length of the particles dataset (1000 if not chunked).
+        selection: optional JetSelection; jets failing it are dropped as files or chunks are read, so all
+        batches are full. The selected rows of each file are cached in cache_dir if given.
+        num_replicas, rank: shard the rows of the files between the processes of a distributed run (see Data)."""
+        super(JetClassData, self).__init__(batch_size, num_replicas, rank)
+        self.use_p4 = use_p4
+        self.shuffle_buffer = shuffle_buffer
+        self.chunk_size = chunk_size
+        self.selection = selection
+        self.cache_dir = cache_dir
+        self.rows = {}
+
+    def selected_rows(self, in_file_name):
+        """Rows of in_file_name passing self.selection, or None if there is no selection"""
+        if self.selection is None:
+            return None
+        if in_file_name not in self.rows:
+            self.rows[in_file_name] = self.selection.indices(in_file_name, self.cache_dir)
+        return self.rows[in_file_name]
+
+    def file_rows(self, in_file_name):
+        if self.selection is not None:
+            return len(self.selected_rows(in_file_name))
+        return get_manifest(in_file_name).rows(in_file_name)
+
+    def row_range(self, in_file_name):
+        """(start, stop, rows) of in_file_name read by this process: the file rows start:stop (stop None for the
+        end of the file) and, with a selection, the sorted rows among them passing it (None without)"""
+        rows = self.selected_rows(in_file_name)
+        if self.shards is None:
+            return 0, None, rows
+        lo, hi = self.shards[in_file_name]
+        if rows is None:
+            return lo, hi, None
+        rows = rows[lo:hi]
+        return (int(rows[0]), int(rows[-1]) + 1, rows) if len(rows) else (0, 0, rows)
+
+    def generate_batches(self, shuffle=False, read_ahead=False):
+        if shuffle and self.shuffle_buffer > 0:
+            return self.stream_batches(read_ahead=read_ahead)
+        return super(JetClassData, self).generate_batches(shuffle=shuffle, read_ahead=read_ahead)
+
+    def get_chunks(self, h5_files):
+        """Returns (file_name, start, stop) for every chunk of every file"""
+        chunks = []
+        for in_file_name in self.file_names:
+            X = h5_files[in_file_name]["particles"]
+            chunk_size = self.chunk_size or (X.chunks[0] if X.chunks is not None else 1000)
+            first, last, _ = self.row_range(in_file_name)
+            last = len(X) if last is None else last
+            chunks += [(in_file_name, start, min(start + chunk_size, last)) for start in range(first, last, chunk_size)]
+        return chunks
+
+    def load_chunk(self, in_file_name, h5_file, start, stop):
+        """Reads jets start:stop of one file as (particles, masks, aug_data, labels)"""
+        d = h5_file["particles"][start:stop]
+        if self.use_p4:
+            d = np.concatenate([d, h5_file["p4"][start:stop]], -1)
+        chunk = (d, h5_file["masks"][start:stop], h5_file["aug_data"][start:stop], h5_file["labels"][start:stop])
+        rows = self.row_range(in_file_name)[2]
+        if rows is not None:
+            rows = rows[np.searchsorted(rows, start):np.searchsorted(rows, stop)] - start
+            if len(rows) < stop - start:
+                chunk = tuple(c[rows] for c in chunk)
+        return chunk
+
+    def stream_batches(self, read_ahead=False):
+        """Yields shuffled batches while holding at most max(shuffle_buffer, batch_size) jets in memory.
+        Chunks of all files are read in random order and appended to the buffer; once it is full, each batch
+        is drawn at random from the buffer and its slots are refilled from the following chunks.
+        Every jet is used once per epoch; like generate_batches, a final incomplete batch is dropped.
+        With read_ahead the next chunk is read on a worker thread."""
+        capacity = max(self.shuffle_buffer, self.batch_size)
+        rng = np.random.default_rng(np.random.randint(2**31))
+        h5_files = {in_file_name: h5py.File(in_file_name, "r") for in_file_name in self.file_names}
+        pool = ThreadPoolExecutor(max_workers=1) if read_ahead else None
+        self.file_wait_time = 0.
+        try:
+            chunks = self.get_chunks(h5_files)
+            order = rng.permutation(len(chunks))
+            load = lambda ii: self.load_chunk(chunks[ii][0], h5_files[chunks[ii][0]], chunks[ii][1], chunks[ii][2])
+            future = pool.submit(load, order[0]) if pool is not None and len(order) else None
+            buf = None
+            n = 0
+            for jj, ii in enumerate(order):
+                if future is not None:
+                    start = time.perf_counter()
+                    chunk = future.result()
+                    self.file_wait_time += time.perf_counter() - start
+                    future = pool.submit(load, order[jj + 1]) if jj + 1 < len(order) else None
+                else:
+                    chunk = load(ii)
+                if buf is None:
+                    buf = [np.empty((capacity,) + c.shape[1:], dtype=c.dtype) for c in chunk]
+                pos = 0
+                num_in_chunk = len(chunk[0])
+                while pos < num_in_chunk:
+                    take = min(capacity - n, num_in_chunk - pos)
+                    for b, c in zip(buf, chunk):
+                        b[n:n + take] = c[pos:pos + take]
+                    n += take
+                    pos += take
+                    if n < capacity:
+                        continue
+                    # draw one batch, then move the undrawn jets at the end of the buffer into the freed slots
+                    idx = rng.choice(n, self.batch_size, replace=False)
+                    batch = tuple(self.batch_tensor(b[idx]) for b in buf)
+                    tail = np.arange(n - self.batch_size, n)
+                    holes = idx[idx < n - self.batch_size]
+                    fillers = tail[~np.isin(tail, idx)]
+                    for b in buf:
+                        b[holes] = b[fillers]
+                    n -= self.batch_size
+                    yield batch
+            # drain what is left in the buffer
+            if buf is not None:
+                idx = rng.permutation(n)
+                for cur_pos in range(0, n - self.batch_size + 1, self.batch_size):
+                    sel = idx[cur_pos:cur_pos + self.batch_size]
+                    yield tuple(self.batch_tensor(b[sel]) for b in buf)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+            for h5_file in h5_files.values():
+                h5_file.close()
 
     def load_data(self, in_file_name, shuffle = False):
         """Loads numpy arrays from H5 file.
         If the features/labels groups contain more than one dataset,
         we load them all, alphabetically by key."""
+        start, stop, rows = self.row_range(in_file_name)
         h5_file = h5py.File(in_file_name, "r")
-        d = self.load_hdf5_data(h5_file["particles"])
-        m = self.load_hdf5_data(h5_file["masks"])
-        a = self.load_hdf5_data(h5_file["aug_data"])
-        l = self.load_hdf5_data(h5_file["labels"])
+        d = self.load_hdf5_data(h5_file["particles"], start, stop)
+        if self.use_p4:
+            d = np.concatenate([d, self.load_hdf5_data(h5_file["p4"], start, stop)], -1)
+        m = self.load_hdf5_data(h5_file["masks"], start, stop)
+        a = self.load_hdf5_data(h5_file["aug_data"], start, stop)
+        l = self.load_hdf5_data(h5_file["labels"], start, stop)
         h5_file.close()
+        if rows is not None and len(rows) < len(d):
+            rows = rows - start
+            d, m, a, l = d[rows], m[rows], a[rows], l[rows]
         if shuffle:
             idx = np.arange(0, len(d))
             np.random.shuffle(idx)
@@ -153,30 +806,22 @@ class JetClassData(Data):
             l = l[idx]
         return d,m,a,l
 
-    def load_hdf5_data(self, data):
+    def load_hdf5_data(self, data, start = 0, stop = None):
         """Returns a numpy array or (possibly nested) list of numpy arrays
-        corresponding to the group structure of the input HDF5 data.
+        corresponding to the group structure of the input HDF5 data, rows start:stop.
         If a group has more than one key, we give its datasets alphabetically by key"""
         if hasattr(data, "keys"):
-            out = [self.load_hdf5_data(data[key]) for key in sorted(data.keys())]
+            out = [self.load_hdf5_data(data[key], start, stop) for key in sorted(data.keys())]
         else:
-            out = data[:]
+            out = data[start:stop]
         return out
 
     def count_data(self):
-        """This is faster than using the parent count_data
-        because the datasets do not have to be loaded
-        as numpy arrays"""
-        num_data = 0
-        for in_file_name in self.file_names:
-            h5_file = h5py.File(in_file_name, "r")
-            X = h5_file["particles"]
-            if hasattr(X, "keys"):
-                num_data += len(X[list(X.keys())[0]])
-            else:
-                num_data += len(X)
-            h5_file.close()
-        return num_data
+        """Reads the row counts from the manifest of each file's directory (see DatasetManifest),
+        so the data files are only opened when they are new or have changed"""
+        if self.shards is not None:
+            return sum(hi - lo for lo, hi in self.shards.values())
+        return sum(self.file_rows(in_file_name) for in_file_name in self.file_names)
 
     def __len__(self):
         return self.count_data()
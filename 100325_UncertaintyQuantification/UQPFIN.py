@@ -2,6 +2,78 @@ import torch
 import torch.nn as nn
 from torchinfo import summary
 import itertools
+import hashlib
+from collections import OrderedDict
+
+def pair_features(xR, xS, pR, pS, ptsum):
+    # expected xR, xS dim: (..., 3) => (pt/ptsum, eta - jet_eta, phi - jet_phi) of the receivers and senders
+    # expected pR, pS dim: (..., 4) => (e, px, py, pz) of the receivers and senders
+    # expected ptsum: jet_ptsum broadcastable to (...)
+    # return log interaction features with dim: (..., Ni=4) => (delta, kT, z, m2)
+    # only elementwise tensor ops, so it can be scripted with torch.jit.script or compiled with torch.compile
+    delta = torch.sqrt((xR[..., 1] - xS[..., 1])**2 + (xR[..., 2] - xS[..., 2])**2)
+    ptmin = torch.minimum(xR[..., 0], xS[..., 0])
+    kT = ptmin * delta * ptsum
+    z = ptmin / (xR[..., 0] + xS[..., 0] + 1e-5)
+    p = pR + pS
+    m2 = torch.abs(p[..., 0]**2 - p[..., 1]**2 - p[..., 2]**2 - p[..., 3]**2)
+    return torch.log(torch.stack([delta, kT, z, m2], -1) + 1e-5)
+
+def full_precision(x):
+    # context that disables autocast on the device of x, for the log interaction features whose
+    # inputs (differences of nearby angles, near-cancelling m2) need fp32; cast the inputs with .float()
+    return torch.autocast(device_type=x.device.type, enabled=False)
+
+def amp_autocast(device, amp = "off"):
+    # autocast context for the --amp options: "off", "bf16" or "fp16"; the pair features and the losses
+    # switch it off again for themselves (see full_precision and Losses.fp32)
+    dtype = torch.float16 if amp == "fp16" else torch.bfloat16
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype, enabled=amp != "off")
+
+class ActivationCache(object):
+    r"""LRU cache of UQPFIN stage outputs, for evaluations that run the same batch several times (pair ablations,
+    MC dropout samples). Entries are keyed by (batch key, stage) and evicted least recently used first once they
+    take more than max_bytes. Only outputs that do not depend on the mask or on dropout are stored:
+    'pairs' (raw pair features E), 'phi' and 'phiInt' (the MLP outputs before masking, or in train() mode with
+    dropout the layers before the first dropout).
+    """
+
+    def __init__(self, max_bytes = 2**30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+
+    def batch_key(self, *tensors):
+        # content hash of the stage inputs, so a key can't go stale when a data loader yields other jets; this copies
+        # the inputs to the host, so callers that run a batch several times compute it once and pass it down
+        h = hashlib.blake2b(digest_size = 16)
+        for t in tensors:
+            h.update(str((tuple(t.shape), t.dtype)).encode())
+            h.update(t.detach().cpu().contiguous().numpy().tobytes())
+        return h.hexdigest()
+
+    def get(self, key, stage, fn):
+        # cached output of stage for the batch key, computing it with fn() on a miss
+        if (key, stage) in self.entries:
+            self.hits += 1
+            self.entries.move_to_end((key, stage))
+            return self.entries[(key, stage)]
+        self.misses += 1
+        out = fn()
+        size = out.element_size() * out.nelement()
+        if size <= self.max_bytes:
+            self.entries[(key, stage)] = out
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, old = self.entries.popitem(last = False)
+                self.nbytes -= old.element_size() * old.nelement()
+        return out
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
 
 class UQPFIN(nn.Module):
     r"""Parameters
@@ -23,6 +95,8 @@ class UQPFIN(nn.Module):
                  interaction_mode='sum',
                  use_softmax = False,
                  use_dropout = False,
+                 pair_mode = 'matmul',
+                 use_p4 = False,
                  device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')):
 
         super(UQPFIN, self).__init__()
@@ -37,6 +111,8 @@ class UQPFIN(nn.Module):
         self.x_mode = interaction_mode if interaction_mode in ['sum', 'cat'] else 'sum'
         self.use_softmax = use_softmax
         self.use_dropout = use_dropout
+        self.pair_mode = pair_mode if pair_mode in ['matmul', 'index', 'packed'] else 'matmul'
+        self.use_p4 = use_p4
         #print(Phi_sizes, F_sizes)
         self.assign_matrices()
 
@@ -124,6 +200,15 @@ class UQPFIN(nn.Module):
         return torch.mm(x.reshape(-1, x_shape[2]), y).reshape(-1, x_shape[1], y_shape[1])
 
     def assign_matrices(self):
+        # Creates (receiver, sender) index tensors with shape (Npp,), ordered as itertools.product with r < s
+        self.Ir, self.Is = torch.triu_indices(self.Np, self.Np, offset=1)
+        self.Ir = (self.Ir).to(self.device)
+        self.Is = (self.Is).to(self.device)
+        if self.pair_mode != 'matmul':
+            # dense incidence matrices are O(Np^3) in memory and only needed by the matmul engine
+            self.Rr = None
+            self.Rs = None
+            return
         # Creates matrices with shape (Np, Npp)
         self.Rr = torch.zeros(self.Np, self.Npp)
         self.Rs = torch.zeros(self.Np, self.Npp)
@@ -134,12 +219,124 @@ class UQPFIN(nn.Module):
         self.Rr = (self.Rr).to(self.device)
         self.Rs = (self.Rs).to(self.device)
 
-    def get_particle_embeddings(self, features, mask):
+    def gather_pairs(self, x):
+        # expected x dim: (Nb, C, Np)
+        # return receiver and sender values with dim: (Nb, C, Npp), (Nb, C, Npp)
+        if self.pair_mode == 'matmul':
+            return self.tmul(x, self.Rr), self.tmul(x, self.Rs)
+        return x.index_select(2, self.Ir), x.index_select(2, self.Is)
+
+    def scatter_pairs(self, E):
+        # expected E dim: (Nb, C, Npp)
+        # return the sum over all pairs each particle takes part in with dim: (Nb, C, Np)
+        if self.pair_mode == 'matmul':
+            return self.tmul(E, torch.transpose(self.Rr, 0, 1).contiguous()) \
+                 + self.tmul(E, torch.transpose(self.Rs, 0, 1).contiguous())
+        out = E.new_zeros(E.shape[0], E.shape[1], self.Np)
+        return out.index_add(2, self.Ir, E).index_add(2, self.Is, E)
+
+    def pack_pairs(self, mask):
+        # expected mask dim: (Nb, 1, Np)
+        # return the flat receiver and sender indices into (Nb*Np) of all pairs of real particles, with dim: (P,), (P,)
+        # and the CSR-style offsets of each jet's pairs in the packed tensor, with dim: (Nb+1,)
+        imask = (mask[:, 0, self.Ir] * mask[:, 0, self.Is]) != 0 # (Nb, Npp)
+        b, p = imask.nonzero(as_tuple=True)
+        offsets = torch.zeros(mask.shape[0] + 1, dtype=torch.long, device=mask.device)
+        offsets[1:] = torch.cumsum(imask.sum(1), 0)
+        return b * self.Np + self.Ir[p], b * self.Np + self.Is[p], offsets
+
+    def get_particle_four_momenta(self, particle_feats, augmented_feats):
+        # expected particle_feats dim: (Nb, Np, Nx) => (pt/ptsum, eta - jet_eta, phi - jet_phi, ...)
+        # expected augmented feats: (Nb, 7) => jet_e, jet_m, jet_pt, jet_eta, jet_phi, jet_ptsum, jet_nconst
+        # return absolute (massless) four-momenta with dim: (Nb, Np, 4) => (e, px, py, pz)
+        pt = particle_feats[:, :, 0] * augmented_feats[:, 5:6]
+        eta = particle_feats[:, :, 1] + augmented_feats[:, 3:4]
+        phi = particle_feats[:, :, 2] + augmented_feats[:, 4:5]
+        return torch.stack([pt * torch.cosh(eta), pt * torch.cos(phi), pt * torch.sin(phi), pt * torch.sinh(eta)], -1)
+
+    def split_p4(self, features):
+        # expected features dim: (Nb, Np, Nx), or (Nb, Np, Nx+4) with the precomputed (e, px, py, pz) appended when use_p4 is set
+        # return particle features with dim: (Nb, Np, Nx) and four-momenta with dim: (Nb, Np, 4), or None without use_p4
+        if not self.use_p4:
+            return features, None
+        return features[:, :, :self.Nx], features[:, :, self.Nx:]
+
+    def get_fused_interaction_features(self, particle_feats, augmented_feats, p4 = None):
+        # expected particle_feats dim: (Nb, Np, Nx)
+        # expected augmented feats: (Nb, 7) => jet_e, jet_m, jet_pt, jet_eta, jet_phi, jet_ptsum, jet_nconst
+        # optional p4 dim: (Nb, Np, 4) => precomputed (e, px, py, pz), which skips the trig/hyperbolic evaluation
+        # return the same features as get_interaction_features, with dim: (Nb, Npp, Ni)
+        # four-momenta are computed once per particle (O(Np)) and only summed per pair
+        with full_precision(particle_feats):
+            x = particle_feats[:, :, :3].float()
+            augmented_feats = augmented_feats.float()
+            if p4 is None:
+                p4 = self.get_particle_four_momenta(x, augmented_feats)
+            q = torch.cat([x, p4.float()], -1) # (Nb, Np, 7)
+            qR, qS = q[:, self.Ir], q[:, self.Is] # (Nb, Npp, 7)
+            return pair_features(qR[..., :3], qS[..., :3], qR[..., 3:], qS[..., 3:], augmented_feats[:, 5:6])
+
+    def get_indexed_pair_embeddings(self, particle_feats, augmented_feats, mask, p4 = None):
+        # expected particle_feats dim: (Nb, Np, Nx)
+        # expected mask dim: (Nb, 1, Np)
+        # expected augmented feats: (Nb, 7) => jet_e, jet_m, jet_pt, jet_eta, jet_phi, jet_ptsum, jet_nconst
+        # return phiInt outputs summed onto the particles with dim: (Nb, Nz, Np)
+        Nb = particle_feats.shape[0]
+        E = self.get_fused_interaction_features(particle_feats, augmented_feats, p4) # (Nb, Npp, Ni)
+        E = self.phiInt(E.view(-1, self.Ni)).view(Nb, self.Npp, self.Nz) # (Nb, Npp, Nz)
+        if mask is not None:
+            m = mask.reshape(Nb, self.Np, 1)
+            E = E * (m[:, self.Ir] * m[:, self.Is]) # (Nb, Npp, Nz) with non-existent interactions masked
+        out = E.new_zeros(Nb, self.Np, self.Nz)
+        E = out.index_add(1, self.Ir, E).index_add(1, self.Is, E) # (Nb, Np, Nz)
+        return torch.transpose(E, 1, 2) / augmented_feats[:,6].reshape(-1,1,1)
+
+    def get_packed_pair_embeddings(self, particle_feats, augmented_feats, mask, p4 = None):
+        # expected particle_feats dim: (Nb, Np, Nx)
+        # expected mask dim: (Nb, 1, Np)
+        # expected augmented feats: (Nb, 7) => jet_e, jet_m, jet_pt, jet_eta, jet_phi, jet_ptsum, jet_nconst
+        # return phiInt outputs summed onto the particles with dim: (Nb, Nz, Np), evaluating only pairs of real particles
+        Nb = particle_feats.shape[0]
+        fR, fS, _ = self.pack_pairs(mask) # (P,), (P,)
+        with full_precision(particle_feats):
+            x = particle_feats[:, :, :3].float()
+            if p4 is None:
+                p4 = self.get_particle_four_momenta(x, augmented_feats.float())
+            q = torch.cat([x, p4.float()], -1).reshape(-1, 7) # (Nb*Np, 7)
+            qR, qS = q[fR], q[fS] # (P, 7)
+            ptsum = augmented_feats[torch.div(fR, self.Np, rounding_mode='floor'), 5].float() # (P,)
+            E = pair_features(qR[:, :3], qS[:, :3], qR[:, 3:], qS[:, 3:], ptsum) # (P, Ni)
+        E = self.phiInt(E) # (P, Nz)
+        m = mask.reshape(-1, 1)
+        E = E * (m[fR] * m[fS]) # (P, Nz)
+        out = E.new_zeros(Nb * self.Np, self.Nz)
+        E = out.index_add(0, fR, E).index_add(0, fS, E) # (Nb*Np, Nz)
+        E = torch.transpose(E.view(Nb, self.Np, self.Nz), 1, 2) # (Nb, Nz, Np)
+        return E / augmented_feats[:,6].reshape(-1,1,1)
+
+    def cached_mlp(self, mlp, x, cache = None, key = None, stage = None):
+        # expected mlp: nn.Sequential of nn.Sequential blocks, as phi and phiInt
+        # return mlp(x), with the part that gives the same output on every call (all layers in eval mode, the layers
+        # before the first dropout in train mode) taken from the activation cache under (key, stage) when one is given
+        if cache is None:
+            return mlp(x)
+        layers = [layer for block in mlp for layer in block]
+        n = len(layers)
+        if self.training:
+            n = next((i for i, layer in enumerate(layers) if isinstance(layer, nn.Dropout)), n)
+        x = cache.get(key, (stage, n), lambda: nn.Sequential(*layers[:n])(x))
+        for layer in layers[n:]:
+            x = layer(x)
+        return x
+
+    def get_particle_embeddings(self, features, mask, cache = None, key = None):
         # expected features dim: (Nb, Np, Nx)
         # expected mask dim: (Nb, 1, Np)
+        # optional cache: ActivationCache with the batch key of (features, aug)
         # return particle embeddings with dim: (Nb, Nz, Np) 
+        features, _ = self.split_p4(features)
         features = torch.flatten(features, start_dim=0, end_dim=1)
-        x = self.phi(features)
+        x = self.cached_mlp(self.phi, features, cache, key, 'phi')
         x = torch.stack(torch.split(x.permute(1, 0), self.Np, dim=1), 0)
         if mask is not None:
             x = x * mask.bool().float()
@@ -154,67 +351,84 @@ class UQPFIN(nn.Module):
         # expected augmented feats: (Nb, 7) => jet_e, jet_m, jet_pt, jet_eta, jet_phi, jet_ptsum, jet_nconst
         # return transformed interaction embeddings with dim: (Nb, Ni, Npp)
         Nx = E.shape[1] // 2
-        delta = torch.sqrt((E[:,1,:] - E[:,Nx+1,:])**2 + (E[:,2,:] - E[:,Nx+2,:])**2).view(-1,1,self.Npp)
+        Npp = E.shape[2]
+        delta = torch.sqrt((E[:,1,:] - E[:,Nx+1,:])**2 + (E[:,2,:] - E[:,Nx+2,:])**2).view(-1,1,Npp)
 
-        kT = torch.minimum(E[:,0,:], E[:,Nx,:]).view(-1,1,self.Npp)*delta
-        kT = (kT.reshape(-1,self.Npp) * augmented_feats[:,5].reshape(-1,1)).reshape(-1,1,self.Npp)
+        kT = torch.minimum(E[:,0,:], E[:,Nx,:]).view(-1,1,Npp)*delta
+        kT = (kT.reshape(-1,Npp) * augmented_feats[:,5].reshape(-1,1)).reshape(-1,1,Npp)
 
-        z = torch.minimum(E[:,0,:], E[:,Nx,:]).view(-1,1,self.Npp) / (E[:,0,:] + E[:,Nx,:] + 1e-5).view(-1,1,self.Npp)
+        z = torch.minimum(E[:,0,:], E[:,Nx,:]).view(-1,1,Npp) / (E[:,0,:] + E[:,Nx,:] + 1e-5).view(-1,1,Npp)
 
-        e = (E[:,0,:] * augmented_feats[:,5].reshape(-1,1) * torch.cosh(E[:,1,:] + augmented_feats[:,3].reshape(-1,1))).view(-1,1,self.Npp) + \
-            (E[:,Nx,:] * augmented_feats[:,5].reshape(-1,1) * torch.cosh(E[:,Nx+1,:] + augmented_feats[:,3].reshape(-1,1))).view(-1,1,self.Npp)
+        e = (E[:,0,:] * augmented_feats[:,5].reshape(-1,1) * torch.cosh(E[:,1,:] + augmented_feats[:,3].reshape(-1,1))).view(-1,1,Npp) + \
+            (E[:,Nx,:] * augmented_feats[:,5].reshape(-1,1) * torch.cosh(E[:,Nx+1,:] + augmented_feats[:,3].reshape(-1,1))).view(-1,1,Npp)
         
-        pz = (E[:,0,:] * augmented_feats[:,5].reshape(-1,1) * torch.sinh(E[:,1,:] + augmented_feats[:,3].reshape(-1,1))).view(-1,1,self.Npp) + \
-             (E[:,Nx,:] * augmented_feats[:,5].reshape(-1,1) * torch.sinh(E[:,Nx+1,:] + augmented_feats[:,3].reshape(-1,1))).view(-1,1,self.Npp)
+        pz = (E[:,0,:] * augmented_feats[:,5].reshape(-1,1) * torch.sinh(E[:,1,:] + augmented_feats[:,3].reshape(-1,1))).view(-1,1,Npp) + \
+             (E[:,Nx,:] * augmented_feats[:,5].reshape(-1,1) * torch.sinh(E[:,Nx+1,:] + augmented_feats[:,3].reshape(-1,1))).view(-1,1,Npp)
 
-        py = (E[:,0,:] * augmented_feats[:,5].reshape(-1,1) * torch.sin(E[:,2,:] + augmented_feats[:,4].reshape(-1,1))).view(-1,1,self.Npp) + \
-             (E[:,Nx,:] * augmented_feats[:,5].reshape(-1,1) * torch.sin(E[:,Nx+2,:] + augmented_feats[:,4].reshape(-1,1))).view(-1,1,self.Npp)
+        py = (E[:,0,:] * augmented_feats[:,5].reshape(-1,1) * torch.sin(E[:,2,:] + augmented_feats[:,4].reshape(-1,1))).view(-1,1,Npp) + \
+             (E[:,Nx,:] * augmented_feats[:,5].reshape(-1,1) * torch.sin(E[:,Nx+2,:] + augmented_feats[:,4].reshape(-1,1))).view(-1,1,Npp)
 
-        px = (E[:,0,:] * augmented_feats[:,5].reshape(-1,1) * torch.cos(E[:,2,:] + augmented_feats[:,4].reshape(-1,1))).view(-1,1,self.Npp) + \
-             (E[:,Nx,:] * augmented_feats[:,5].reshape(-1,1) * torch.cos(E[:,Nx+2,:] + augmented_feats[:,4].reshape(-1,1))).view(-1,1,self.Npp)
+        px = (E[:,0,:] * augmented_feats[:,5].reshape(-1,1) * torch.cos(E[:,2,:] + augmented_feats[:,4].reshape(-1,1))).view(-1,1,Npp) + \
+             (E[:,Nx,:] * augmented_feats[:,5].reshape(-1,1) * torch.cos(E[:,Nx+2,:] + augmented_feats[:,4].reshape(-1,1))).view(-1,1,Npp)
 
         m2 = torch.abs(e**2 - px**2 - py**2 - pz**2)
         #return torch.cat([delta, kT, z, m2], 1) #(Nb, Ni=4, Npp)
         return torch.cat([torch.log(delta + 1e-5), torch.log(kT + 1e-5), torch.log(z + 1e-5), torch.log(m2 + 1e-5)], 1) #(Nb, Ni=4, Npp)
 
-    def get_interaction_embeddings(self, particle_feats, augmented_feats, mask):
+    def get_pair_features(self, particle_feats, augmented_feats, p4 = None):
+        # expected particle_feats dim: (Nb, Np, Nx)
+        # expected augmented feats: (Nb, 7) => jet_e, jet_m, jet_pt, jet_eta, jet_phi, jet_ptsum, jet_nconst
+        # optional p4 dim: (Nb, Np, 4) => precomputed (e, px, py, pz), summed per pair instead of recomputing them
+        # return the interaction features of all pairs in fp32 with dim: (Nb, Ni, Npp)
+        if p4 is not None:
+            return torch.transpose(self.get_fused_interaction_features(particle_feats, augmented_feats, p4), 1, 2)
+        with full_precision(particle_feats):
+            # the gather is a matmul, which autocast would also run in reduced precision
+            intR, intS = self.gather_pairs(torch.transpose(particle_feats, 1, 2).float().contiguous()) # (Nb, Nx, Npp), (Nb, Nx, Npp)
+            E = torch.cat([intR, intS], 1) # (Nb, 2Nx, Npp)
+            return self.get_interaction_features(E, augmented_feats.float(), None) # (Nb, Ni, Npp)
+
+    def get_interaction_embeddings(self, particle_feats, augmented_feats, mask, cache = None, key = None):
         # expected particle_feats dim: (Nb, Np, Nx)
         # expected mask dim: (Nb, 1, Np)
         # expected augmented feats: (Nb, 7) => jet_e, jet_m, jet_pt, jet_eta, jet_phi, jet_ptsum, jet_nconst
+        # optional cache: ActivationCache with the batch key of (features, aug), used by the matmul engine
         # return per-particle interaction embeddings with dim: (Nb, Nz, Np)
-        particle_feats = torch.transpose(particle_feats, 1, 2).contiguous() # (Nb, Nx, Np)
-        intR = self.tmul(particle_feats, self.Rr) # (Nb, Nx, Npp)
-        intS = self.tmul(particle_feats, self.Rs) # (Nb, Nx, Npp)
-        E = torch.cat([intR, intS], 1) # (Nb, 2Nx, Npp)
-        #print(E[:5,:,:5])
-        # Get interaction features
-        E = self.get_interaction_features(E, augmented_feats, mask) # (Nb, Ni, Npp)
-        #print(E.shape)
-        #print(E[:5,:,:-5])
-        
-        # Now applying the Interaction MLP
-        E = torch.transpose(E, 1, 2).contiguous() #(Nb, Npp, Ni)
-        E = self.phiInt(E.view(-1, self.Ni)) # (Nb*Npp, Nz)
-        # print(E.shape)
-        E = E.view(-1, self.Npp, self.Nz) # (Nb, Npp, Nz)
+        particle_feats, p4 = self.split_p4(particle_feats)
+        if self.pair_mode == 'packed' and mask is not None:
+            E = self.get_packed_pair_embeddings(particle_feats, augmented_feats, mask, p4) # (Nb, Nz, Np)
+        elif self.pair_mode != 'matmul':
+            E = self.get_indexed_pair_embeddings(particle_feats, augmented_feats, mask, p4) # (Nb, Nz, Np)
+        else:
+            # Get interaction features
+            if cache is None:
+                E = self.get_pair_features(particle_feats, augmented_feats, p4) # (Nb, Ni, Npp)
+            else:
+                E = cache.get(key, 'pairs', lambda: self.get_pair_features(particle_feats, augmented_feats, p4))
+
+            # Now applying the Interaction MLP
+            E = torch.transpose(E, 1, 2).contiguous() #(Nb, Npp, Ni)
+            E = self.cached_mlp(self.phiInt, E.view(-1, self.Ni), cache, key, 'phiInt') # (Nb*Npp, Nz)
+            # print(E.shape)
+            E = E.view(-1, self.Npp, self.Nz) # (Nb, Npp, Nz)
+
+            if mask is not None:
+                # generating masks for interactions
+                mR, mS = self.gather_pairs(mask) # (Nb, 1, Npp), (Nb, 1, Npp)
+                imask = torch.transpose(mR * mS, 1, 2).contiguous() # (Nb, Npp, 1)
+                E = E * imask # (Nb, Npp, Nz) with non-existent interactions masked
+
+
+            # Now returning Interactions to particle level inputs
+            E = torch.transpose(E, 1, 2).contiguous() # (Nb, Nz, Npp)
+            E = self.scatter_pairs(E) / augmented_feats[:,6].reshape(-1,1,1) # (Nb, Nz, Np)
 
-        if mask is not None:
-            # generating masks for interactions
-            mR = self.tmul(mask, self.Rr) # (Nb, 1, Npp)
-            mS = self.tmul(mask, self.Rs) # (Nb, 1, Npp)
-            imask = torch.transpose(mR * mS, 1, 2).contiguous() # (Nb, Npp, 1)
-            E = E * imask # (Nb, Npp, Nz) with non-existent interactions masked
-        
-        
-        # Now returning Interactions to particle level inputs
-        E = torch.transpose(E, 1, 2).contiguous() # (Nb, Nz, Npp)
-        E = ( self.tmul(E, torch.transpose(self.Rr, 0, 1).contiguous())  \
-            + self.tmul(E, torch.transpose(self.Rs, 0, 1).contiguous()) ) / augmented_feats[:,6].reshape(-1,1,1) # (Nb, Nz, Np)
-        
 
         if mask is not None:
             E = E * mask.bool().float()
 
+        particle_feats = torch.transpose(particle_feats, 1, 2).contiguous() # (Nb, Nx, Np)
+
         # Now concatenaing inputs with first interaction outputs
         E = torch.cat([particle_feats, E], 1) #(Nb, Nx+Nz, Np)
         E = torch.transpose(E, 1, 2).contiguous() #(Nb, Np, Nx+Nz)
@@ -227,9 +441,19 @@ class UQPFIN(nn.Module):
         
         return E
 
-    def forward(self, features, aug, mask):
+    def forward(self, features, aug, mask, cache = None, key = None):
+        # expected features dim: (Nb, Np, Nx)
+        # expected mask dim: (Nb, 1, Np)
+        # optional cache: ActivationCache for repeated evaluations of the same batch; the cached stages don't
+        # depend on the mask, so they are shared by evaluations with different masks
+        # optional key: batch key of (features, aug) in cache, hashed from the inputs with cache.batch_key if None
+        return self.forward_with_latent(features, aug, mask, cache, key = key)[0]
+
+    def forward_with_latent(self, features, aug, mask, cache = None, embeddings = False, key = None):
         # expected features dim: (Nb, Np, Nx)
         # expected mask dim: (Nb, 1, Np)
+        # return the outputs with dim: (Nb, num_classes) and the pooled latent fed to fc with dim: (Nb, Nz), or (Nb, 2Nz)
+        # for x_mode 'cat', from one pass; with embeddings also the particle and interaction embeddings with dim: (Nb, Nz, Np)
         # # x: the feature vector initally read from the data structure, in dimension (N, C, P)
         # #features = features.permute(0,2,1)
         # features = torch.flatten(features, start_dim=0, end_dim=1)
@@ -237,16 +461,51 @@ class UQPFIN(nn.Module):
         # x = torch.stack(torch.split(x.permute(1, 0), self.Np , dim=1), 0)
         # if mask is not None:
         #     x = x * mask.bool().float()
-        particle_embeddings = self.get_particle_embeddings(features, mask)
-        interaction_embeddings = self.get_interaction_embeddings(features, aug, mask)
+        if cache is not None and key is None:
+            key = cache.batch_key(features, aug)
+        particle_embeddings = self.get_particle_embeddings(features, mask, cache, key)
+        interaction_embeddings = self.get_interaction_embeddings(features, aug, mask, cache, key)
         if self.x_mode == 'sum':
             x = particle_embeddings.sum(-1) + interaction_embeddings.sum(-1)
         else:
             x = torch.cat([particle_embeddings, interaction_embeddings], 1)
             x = x.sum(-1)
-        return self.fc(x)
+        if embeddings:
+            return self.fc(x), x, particle_embeddings, interaction_embeddings
+        return self.fc(x), x
         
 
+class UQPFINEnsemble(nn.Module):
+    r"""Parameters
+    ----------
+    members : list of UQPFIN
+        Ensemble members with the same configuration, evaluated on the same batches. Each keeps its own
+        parameters, so members[k].state_dict() is an ordinary UQPFIN checkpoint and a member can be
+        reloaded or re-initialized on its own.
+    stack : str
+        'loop' (default) calls the members one after the other, 'vmap' stacks the member parameters along a
+        new first dimension and evaluates all members in one torch.func.vmap call. Both give the same outputs;
+        the input-only work (pair features) is done once per batch with vmap, but on CPU vmap has measured
+        slower than loop (benchmark.py --test ensemble).
+    """
+
+    def __init__(self, members, stack = 'loop'):
+        super(UQPFINEnsemble, self).__init__()
+        self.members = nn.ModuleList(members)
+        self.stack = stack if stack in ['vmap', 'loop'] else 'loop'
+
+    def forward(self, features, aug, mask):
+        # expected features dim: (Nb, Np, Nx), aug dim: (Nb, 7), mask dim: (Nb, 1, Np)
+        # return the member outputs with dim: (K, Nb, num_classes)
+        if self.stack == 'loop':
+            return torch.stack([member(features, aug, mask) for member in self.members])
+        named = [dict(member.named_parameters()) for member in self.members]
+        params = {name: torch.stack([p[name] for p in named]) for name in named[0]}
+        buffers = dict(self.members[0].named_buffers())
+        def call(p, features, aug, mask):
+            return torch.func.functional_call(self.members[0], (p, buffers), (features, aug, mask))
+        return torch.func.vmap(call, in_dims = (0, None, None, None), randomness = 'different')(params, features, aug, mask)
+
 if __name__ == "__main__":
     features = 3
     n_consts = 60
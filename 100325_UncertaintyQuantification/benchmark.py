@@ -0,0 +1,1248 @@
+import torch
+import numpy as np
+import argparse, os, sys, time, json, shutil
+import subprocess
+import multiprocessing as mp
+import resource
+import h5py
+import threading
+import psutil
+from torch.utils.data import DataLoader
+from UQPFIN import UQPFIN as Model, UQPFINEnsemble, amp_autocast
+from PFINDataset import PFINDataset, LazyPFINDataset, ContiguousBatchSampler, RandomBatchSampler, JetClassData, DatasetManifest, JetSelection, batch_loader
+import glob
+import torch.distributed as dist
+from train import MetricAccumulator, count_correct, wrap_model, get_parser, data_settings
+from Losses import LossCE, LossMSE, KLDiv, LossCE_Bayes, LossCE_Gibbs, getprobs, edl_loss
+from sklearn.metrics import accuracy_score, roc_auc_score
+from EvalTools import ModelEvaluator, EnsembleEvaluator, MCDOEvaluator, PairwiseEvaluator, ThresholdSweep, ResultsWriter, read_results, PlotterTools, EvalCache
+from BinnedStats import bin_stats, cdf, histogram, histogram2d
+
+def timeit(fn, repeat = 5, warmup = 1):
+    # returns the mean wall-clock time of fn() in seconds
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+def _peak_worker(fn, setup, queue):
+    args = setup()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        fn(*args)
+        torch.cuda.synchronize()
+        queue.put(torch.cuda.max_memory_allocated() / 2**20)
+    else:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn(*args)
+        queue.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) / 2**10)
+
+def peak_memory(fn, setup):
+    # returns the peak memory in MB used by fn(*setup()), measured in a forked process so runs do not share a high-water mark
+    # on CPU this is the growth of the max. resident set size after setup, on GPU the peak allocated memory
+    ctx = mp.get_context("fork")
+    queue = ctx.Queue()
+    p = ctx.Process(target=_peak_worker, args=(fn, setup, queue))
+    p.start()
+    peak = queue.get()
+    p.join()
+    return peak
+
+def make_inputs(Nb, Np, Nx, device, fill = 1.0):
+    # random jets where the first fill*Np constituents are real and the rest are padding
+    nreal = max(2, int(round(fill * Np)))
+    x = torch.rand(Nb, Np, Nx)
+    mask = torch.zeros(Nb, 1, Np)
+    mask[:, :, :nreal] = 1.
+    x = x * mask.reshape(Nb, Np, 1)
+    aug = torch.ones(Nb, 7)
+    aug[:, 6] = nreal
+    return x.to(device), aug.to(device), mask.to(device)
+
+def bench_pairs(args):
+    # forward/backward time and peak memory of the pair engines versus the number of constituents
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print("{:>5} {:>8} {:>12} {:>12} {:>12} {:>10}".format("Np", "mode", "fwd [ms]", "fwd+bwd [ms]", "peak [MB]", "max|diff|"))
+    for Np in args.Np:
+        ref = None
+        for mode in args.modes:
+            torch.manual_seed(0)
+            model = Model(particle_feats = 3, n_consts = Np, pair_mode = mode, device = device).to(device)
+            x, a, m = make_inputs(args.batch_size, Np, 3, device)
+            def fwd():
+                with torch.no_grad():
+                    model(x, a, m)
+            def fwd_bwd():
+                model.zero_grad()
+                model(x, a, m).sum().backward()
+            t_fwd = timeit(fwd, repeat = args.repeat)
+            t_bwd = timeit(fwd_bwd, repeat = args.repeat)
+            def setup(Np = Np, mode = mode):
+                torch.manual_seed(0)
+                model = Model(particle_feats = 3, n_consts = Np, pair_mode = mode, device = device).to(device)
+                return (model,) + make_inputs(args.batch_size, Np, 3, device)
+            peak = peak_memory(lambda model, x, a, m: model(x, a, m).sum().backward(), setup)
+            with torch.no_grad():
+                out = model.get_interaction_embeddings(x, a, m)
+            if ref is None:
+                ref = out
+            diff = (out - ref).abs().max().item()
+            print("{:>5} {:>8} {:>12.2f} {:>12.2f} {:>12.1f} {:>10.2e}".format(Np, mode, 1e3*t_fwd, 1e3*t_bwd, peak, diff))
+            del model
+
+def bench_packed(args):
+    # real-pair fraction and speedup of packed pair evaluation over the dense index engine
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if args.data_path:
+        batches = []
+        for path in args.data_path.split(','):
+            with h5py.File(path, "r") as f:
+                n = min(len(f["masks"]), args.batch_size * args.nbatches)
+                x = torch.from_numpy(f["particles"][:n]).float()
+                m = torch.from_numpy(f["masks"][:n]).float()
+                a = torch.from_numpy(f["aug_data"][:n]).float()
+                nreal = f["masks"][:].reshape(len(f["masks"]), -1).sum(-1)
+            Np = m.shape[-1]
+            frac = (nreal * (nreal - 1) / 2).sum() / (len(nreal) * Np * (Np - 1) / 2)
+            print("{}: Np = {}, mean constituents = {:.1f}, real-pair fraction = {:.3f}".format(path, Np, nreal.mean(), frac))
+            batches.append((path, [(x[i:i+args.batch_size].to(device), a[i:i+args.batch_size].to(device), m[i:i+args.batch_size].to(device)) for i in range(0, n, args.batch_size)]))
+    else:
+        batches = []
+        for Np in args.Np:
+            for fill in args.fill:
+                name = "synthetic Np={} fill={}".format(Np, fill)
+                print("{}: real-pair fraction = {:.3f}".format(name, max(2, round(fill*Np))*(max(2, round(fill*Np))-1) / (Np*(Np-1))))
+                batches.append((name, [make_inputs(args.batch_size, Np, 3, device, fill = fill) for _ in range(args.nbatches)]))
+
+    print("{:>40} {:>12} {:>12} {:>10} {:>10}".format("data", "index [ms]", "packed [ms]", "speedup", "max|diff|"))
+    for name, data in batches:
+        Np, Nx = data[0][0].shape[1], data[0][0].shape[2]
+        models = {}
+        for mode in ["index", "packed"]:
+            torch.manual_seed(0)
+            models[mode] = Model(particle_feats = Nx, n_consts = Np, pair_mode = mode, device = device).to(device).eval()
+        times = {}
+        for mode, model in models.items():
+            def run():
+                with torch.no_grad():
+                    for x, a, m in data:
+                        model(x, a, m)
+            times[mode] = timeit(run, repeat = args.repeat)
+        with torch.no_grad():
+            diff = max((models["index"](x, a, m) - models["packed"](x, a, m)).abs().max().item() for x, a, m in data)
+        print("{:>40} {:>12.2f} {:>12.2f} {:>10.2f} {:>10.2e}".format(name[-40:], 1e3*times["index"], 1e3*times["packed"], times["index"]/times["packed"], diff))
+
+def bench_features(args):
+    # current get_interaction_features (with the pair gather it needs) versus the fused per-particle kernel on CPU
+    device = torch.device("cpu")
+    Np = args.Np[0]
+    model = Model(particle_feats = 3, n_consts = Np, pair_mode = "index", device = device)
+    legacy = Model(particle_feats = 3, n_consts = Np, pair_mode = "matmul", device = device)
+    fused = model.get_fused_interaction_features
+    if args.compile:
+        fused = torch.compile(fused)
+    # max|diff| covers (delta, kT, z); log(m2) suffers from cancellation for near-collinear pairs, so compiled kernels
+    # that reorder the arithmetic are compared by the fraction of pairs whose log(m2) moves by more than 1e-3
+    print("{:>6} {:>14} {:>14} {:>10} {:>10} {:>10}".format("Nb", "current [ms]", "fused [ms]", "speedup", "max|diff|", "m2 frac"))
+    for Nb in args.batch_sizes:
+        x, a, m = make_inputs(Nb, Np, 3, device, fill = 1.0)
+        a[:, 3], a[:, 4], a[:, 5] = torch.randn(Nb), torch.rand(Nb), 500 * torch.rand(Nb)
+        def current():
+            with torch.no_grad():
+                intR, intS = legacy.gather_pairs(torch.transpose(x, 1, 2).contiguous())
+                return legacy.get_interaction_features(torch.cat([intR, intS], 1), a, m)
+        def new():
+            with torch.no_grad():
+                return fused(x, a)
+        t_cur = timeit(current, repeat = args.repeat)
+        t_new = timeit(new, repeat = args.repeat)
+        diff = (current() - torch.transpose(new(), 1, 2)).abs()
+        print("{:>6} {:>14.2f} {:>14.2f} {:>10.2f} {:>10.2e} {:>10.2e}".format(Nb, 1e3*t_cur, 1e3*t_new, t_cur/t_new,
+                                                                  diff[:, :3].max().item(), (diff[:, 3] > 1e-3).float().mean().item()))
+
+def bench_p4(args):
+    # training-epoch time with the four-momenta recomputed in the model versus read from the precomputed p4 dataset,
+    # and the agreement of the two forward passes
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if args.data_path:
+        dataset = PFINDataset(args.data_path.split(',')[0], use_p4 = True)
+        n = min(len(dataset), args.batch_size * args.nbatches)
+        x, m, a, y = dataset.data[:n], dataset.masks[:n], dataset.aug_data[:n], dataset.labels[:n]
+    else:
+        Np = args.Np[0]
+        n = args.batch_size * args.nbatches
+        x, a, m = make_inputs(n, Np, 3, torch.device("cpu"), fill = 0.5)
+        a[:, 3], a[:, 4], a[:, 5] = torch.randn(n), torch.rand(n), 500 * torch.rand(n)
+        p4 = Model(particle_feats = 3, n_consts = Np, pair_mode = "index", device = torch.device("cpu")).get_particle_four_momenta(x, a)
+        x = torch.cat([x, p4], -1)
+        y = torch.nn.functional.one_hot(torch.randint(0, 2, (n,)), 2).float()
+    Np, Nx = m.shape[-1], x.shape[-1] - 4
+    batches = [(x[i:i+args.batch_size].to(device), m[i:i+args.batch_size].to(device), a[i:i+args.batch_size].to(device), y[i:i+args.batch_size].to(device))
+               for i in range(0, n, args.batch_size)]
+    # max|dout|: interaction embeddings of the same initial weights with and without the stored p4
+    print("{:>8} {:>8} {:>14} {:>12}".format("mode", "use_p4", "epoch [s]", "max|dout|"))
+    for mode in args.modes:
+        for use_p4 in [False, True]:
+            torch.manual_seed(0)
+            model = Model(particle_feats = Nx, n_consts = Np, num_classes = y.shape[1], pair_mode = mode, use_p4 = use_p4, device = device).to(device)
+            xb, mb, ab, _ = batches[0]
+            with torch.no_grad():
+                out = model.get_interaction_embeddings(xb if use_p4 else xb[:, :, :Nx], ab, mb)
+            if not use_p4:
+                ref = out
+            dout = (out - ref).abs().max().item()
+            opt = torch.optim.Adam(model.parameters(), lr = 1e-3)
+            def epoch():
+                for xb, mb, ab, yb in batches:
+                    opt.zero_grad()
+                    loss = LossMSE(yb, model(xb if use_p4 else xb[:, :, :Nx], ab, mb))
+                    loss.backward()
+                    opt.step()
+            print("{:>8} {:>8} {:>14.3f} {:>12.2e}".format(mode, str(use_p4), timeit(epoch, repeat = args.repeat), dout))
+
+class MemorySampler(threading.Thread):
+    # samples the summed RSS and USS (memory not shared with other processes) of this process and its children
+    def __init__(self, interval = 0.2):
+        super(MemorySampler, self).__init__(daemon = True)
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_uss = 0
+        self.running = True
+
+    def run(self):
+        proc = psutil.Process()
+        while self.running:
+            rss, uss = 0, 0
+            for p in [proc] + proc.children(recursive = True):
+                try:
+                    info = p.memory_full_info()
+                    rss, uss = rss + info.rss, uss + info.uss
+                except psutil.Error:
+                    pass
+            self.peak_rss, self.peak_uss = max(self.peak_rss, rss), max(self.peak_uss, uss)
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        return self.peak_rss / 2**20, self.peak_uss / 2**20
+
+def _loader_worker(backend, args, queue):
+    path = args.data_path.split(',')[0]
+    if backend == "eager":
+        dataset = PFINDataset(path)
+        loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers, persistent_workers=args.workers > 0)
+    else:
+        dataset = LazyPFINDataset(path, cache_dir = args.cache_dir if backend == "lazy+npy" else None)
+        loader = DataLoader(dataset, sampler=ContiguousBatchSampler(len(dataset), args.batch_size, shuffle=True), batch_size=None,
+                            num_workers=args.workers, persistent_workers=args.workers > 0)
+    sampler = MemorySampler()
+    sampler.start()
+    start = time.perf_counter()
+    n = 0
+    for _ in range(args.repeat):
+        for x, m, a, y in loader:
+            n += len(x)
+    elapsed = time.perf_counter() - start
+    queue.put((n / elapsed,) + sampler.stop())
+
+def bench_loader(args):
+    # loader throughput and memory of the eager PFINDataset versus the lazy HDF5 and memory-mapped .npy backends
+    if args.cache_dir:
+        LazyPFINDataset(args.data_path.split(',')[0], cache_dir = args.cache_dir)
+    ctx = mp.get_context("fork")
+    print("{:>10} {:>16} {:>14} {:>14}".format("backend", "samples/s", "peak RSS [MB]", "peak USS [MB]"))
+    for backend in ["eager", "lazy"] + (["lazy+npy"] if args.cache_dir else []):
+        queue = ctx.Queue()
+        p = ctx.Process(target=_loader_worker, args=(backend, args, queue))
+        p.start()
+        rate, rss, uss = queue.get()
+        p.join()
+        print("{:>10} {:>16.0f} {:>14.1f} {:>14.1f}".format(backend, rate, rss, uss))
+
+def bench_sampler(args):
+    # samples/s of per-sample __getitem__ + default_collate versus batch samplers at the training batch sizes
+    path = args.data_path.split(',')[0]
+    eager = PFINDataset(path)
+    lazy = LazyPFINDataset(path)
+    loaders = {
+        "per-sample": lambda bs: DataLoader(eager, batch_size=bs, shuffle=True, num_workers=args.workers),
+        "batched": lambda bs: batch_loader(eager, bs, shuffle=True, num_workers=args.workers),
+        "lazy random": lambda bs: batch_loader(lazy, bs, shuffle=True, num_workers=args.workers),
+        "lazy contiguous": lambda bs: batch_loader(lazy, bs, shuffle=True, contiguous=True, num_workers=args.workers),
+    }
+    print("{:>6} {:>16} {:>12}".format("Nb", "loader", "samples/s"))
+    for bs in args.batch_sizes:
+        for name, make in loaders.items():
+            loader = make(bs)
+            def epoch():
+                for x, m, a, y in loader:
+                    pass
+            print("{:>6} {:>16} {:>12.0f}".format(bs, name, len(eager) / timeit(epoch, repeat = args.repeat, warmup = 0)))
+
+def data_files(args):
+    # --data-path entries may be glob patterns, e.g. "datasets/jetclass/processed/train_*.h5"
+    return sorted(sum([glob.glob(p) for p in args.data_path.split(',')], []))
+
+def bench_prefetch(args):
+    # JetClassData epoch time with and without background prefetching, with a fixed per-batch compute time
+    dataset = JetClassData(batch_size = args.batch_size)
+    dataset.set_file_names(data_files(args))
+    print("{:>9} {:>12} {:>12} {:>14} {:>12}".format("prefetch", "epoch [s]", "stall [s]", "mean depth", "batches"))
+    for prefetch in args.prefetch:
+        def epoch():
+            for x, m, a, y in dataset.generate_data(shuffle = args.shuffle, prefetch = prefetch):
+                time.sleep(args.step_time)
+        t = timeit(epoch, repeat = args.repeat, warmup = 0)
+        stats = dataset.prefetch_stats if prefetch > 0 else {"stall_time": float('nan'), "mean_queue_depth": float('nan'), "batches": 0}
+        print("{:>9} {:>12.3f} {:>12.3f} {:>14.2f} {:>12}".format(prefetch, t, stats["stall_time"], stats["mean_queue_depth"], stats["batches"]))
+
+def make_jetclass_files(outdir, nfiles, njets, Np = 60, Nx = 11, nclasses = 10, chunk = 1000):
+    # synthetic JetClass-like files where aug_data[:, 0] holds the global jet index, so the sample order can be checked
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    file_names = []
+    for i in range(nfiles):
+        file_name = os.path.join(outdir, "train_{}.h5".format(i))
+        aug = np.ones((njets, 7), dtype=np.float32)
+        aug[:, 0] = np.arange(i * njets, (i + 1) * njets)
+        aug[:, 1] = np.random.uniform(0, 300, njets)
+        aug[:, 2] = np.random.uniform(300, 1200, njets)
+        aug[:, 3] = np.random.normal(0, 1, njets)
+        with h5py.File(file_name, "w") as f:
+            f.create_dataset("particles", data=np.random.rand(njets, Np, Nx).astype(np.float32), chunks=(chunk, Np, Nx))
+            f.create_dataset("masks", data=np.ones((njets, 1, Np), dtype=np.float32), chunks=(chunk, 1, Np))
+            f.create_dataset("aug_data", data=aug, chunks=(chunk, 7))
+            f.create_dataset("labels", data=np.eye(nclasses, dtype=np.float32)[np.random.randint(nclasses, size=njets)], chunks=(chunk, nclasses))
+        file_names.append(file_name)
+    return file_names
+
+def _shuffle_worker(file_names, shuffle_buffer, args, queue):
+    dataset = JetClassData(batch_size = args.batch_size, shuffle_buffer = shuffle_buffer)
+    dataset.set_file_names(file_names)
+    sampler = MemorySampler(interval = 0.05)
+    sampler.start()
+    start = time.perf_counter()
+    n = 0
+    for x, m, a, y in dataset.generate_data(shuffle = True):
+        n += len(x)
+    elapsed = time.perf_counter() - start
+    queue.put((n / elapsed,) + sampler.stop())
+
+def bench_shuffle(args):
+    # sample-order statistics, throughput and memory of whole-file shuffling versus the streaming shuffle buffer
+    file_names = data_files(args) if args.data_path else make_jetclass_files(args.outdir, args.nfiles, args.njets)
+    with h5py.File(file_names[0], "r") as f:
+        njets = len(f["aug_data"])
+    ntotal = njets * len(file_names)
+    print("{:>10} {:>8} {:>10} {:>10} {:>12} {:>12}".format("buffer", "unique", "files/b", "spearman", "|disp|/N", "batch chi2"))
+    for shuffle_buffer in [0] + args.shuffle_buffers:
+        dataset = JetClassData(batch_size = args.batch_size, shuffle_buffer = shuffle_buffer)
+        dataset.set_file_names(file_names)
+        ids, nfiles_per_batch, chi2 = [], [], []
+        for x, m, a, y in dataset.generate_data(shuffle = True):
+            ids.append(a[:, 0].numpy().astype(np.int64))
+            nfiles_per_batch.append(len(np.unique(ids[-1] // njets)))
+            # per-batch class counts against the overall class fractions
+            counts = y.sum(0).numpy()
+            expected = len(y) * np.full(len(counts), 1. / len(counts))
+            chi2.append(((counts - expected)**2 / expected).sum() / (len(counts) - 1))
+        ids = np.concatenate(ids)
+        # rank correlation between emission position and stored position: 0 for a full shuffle, 1 for no shuffle
+        spearman = np.corrcoef(np.arange(len(ids)), np.argsort(np.argsort(ids)))[0, 1]
+        disp = np.abs(np.arange(len(ids)) - np.argsort(np.argsort(ids))).mean() / len(ids)
+        assert len(np.unique(ids)) == len(ids), "a jet was emitted twice"
+        assert ntotal - len(ids) < args.batch_size * (1 if shuffle_buffer else len(file_names)), "jets were lost"
+        print("{:>10} {:>8} {:>10.2f} {:>10.3f} {:>12.3f} {:>12.2f}".format(shuffle_buffer, len(ids), np.mean(nfiles_per_batch), spearman, disp, np.mean(chi2)))
+    print("(uniform shuffle: files/batch ~ {:.2f}, spearman ~ 0, |disp|/N ~ 0.333, chi2 ~ 1)".format(
+        len(file_names) * (1 - (1 - 1. / len(file_names))**args.batch_size)))
+    ctx = mp.get_context("fork")
+    print("{:>10} {:>12} {:>14} {:>14}".format("buffer", "jets/s", "peak RSS [MB]", "peak USS [MB]"))
+    for shuffle_buffer in [0] + args.shuffle_buffers:
+        queue = ctx.Queue()
+        p = ctx.Process(target=_shuffle_worker, args=(file_names, shuffle_buffer, args, queue))
+        p.start()
+        rate, rss, uss = queue.get()
+        p.join()
+        print("{:>10} {:>12.0f} {:>14.1f} {:>14.1f}".format(shuffle_buffer, rate, rss, uss))
+
+def concat_batches(dataset):
+    # the previous Data.generate_data file loop, which prepends the leftover rows with concat_data (no shuffling)
+    leftovers = None
+    for file_name in dataset.file_names:
+        arrays = dataset.load_data(file_name)
+        if leftovers is not None:
+            arrays = [dataset.concat_data(left, d) for left, d in zip(leftovers, arrays)]
+        n = len(arrays[0])
+        for cur_pos in range(0, n, dataset.batch_size):
+            if cur_pos + dataset.batch_size <= n:
+                yield tuple(torch.from_numpy(d[cur_pos:cur_pos + dataset.batch_size]).float() for d in arrays)
+            else:
+                leftovers = [d[cur_pos:] for d in arrays]
+
+def _stitch_worker(file_names, method, args, queue):
+    dataset = JetClassData(batch_size = args.batch_size)
+    dataset.set_file_names(file_names)
+    batches = concat_batches(dataset) if method == "concat" else dataset.generate_data()
+    sampler = MemorySampler(interval = 0.02)
+    sampler.start()
+    start = time.perf_counter()
+    for x, m, a, y in batches:
+        pass
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed / len(file_names),) + sampler.stop())
+
+def bench_stitch(args):
+    # batches across file boundaries: concatenating the leftovers with the next file versus stitching one batch buffer
+    file_names = data_files(args) if args.data_path else make_jetclass_files(args.outdir, args.nfiles, args.njets)
+    dataset = JetClassData(batch_size = args.batch_size)
+    dataset.set_file_names(file_names)
+    nbatches = 0
+    for ref, new in zip(concat_batches(dataset), dataset.generate_data()):
+        assert all(torch.equal(r, n) for r, n in zip(ref, new)), "batch {} differs".format(nbatches)
+        nbatches += 1
+    print("{} identical batches".format(nbatches))
+    ctx = mp.get_context("fork")
+    print("{:>8} {:>14} {:>14} {:>14}".format("method", "time/file [s]", "peak RSS [MB]", "peak USS [MB]"))
+    for method in ["concat", "stitch"]:
+        queue = ctx.Queue()
+        p = ctx.Process(target=_stitch_worker, args=(file_names, method, args, queue))
+        p.start()
+        t, rss, uss = queue.get()
+        p.join()
+        print("{:>8} {:>14.3f} {:>14.1f} {:>14.1f}".format(method, t, rss, uss))
+
+def bench_manifest(args):
+    # JetClassData.count_data from the manifest versus opening every file, and invalidation after a file changes
+    file_names = data_files(args) if args.data_path else make_jetclass_files(args.outdir, args.nfiles, args.njets)
+    dataset = JetClassData(batch_size = args.batch_size)
+    dataset.set_file_names(file_names)
+    def count_h5():
+        n = 0
+        for file_name in file_names:
+            with h5py.File(file_name, "r") as f:
+                n += len(f["particles"])
+        return n
+    manifest_path = os.path.join(os.path.dirname(os.path.abspath(file_names[0])), DatasetManifest.file_name)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    PFINDataset_module = sys.modules[JetClassData.__module__]
+    PFINDataset_module._manifests.clear()
+    start = time.perf_counter()
+    n = dataset.count_data()
+    build = time.perf_counter() - start
+    assert n == count_h5()
+    print("{:>26} {:>12}".format("", "time [ms]"))
+    print("{:>26} {:>12.3f}".format("open every file", 1e3 * timeit(count_h5, repeat = args.repeat)))
+    print("{:>26} {:>12.3f}".format("manifest (first build)", 1e3 * build))
+    print("{:>26} {:>12.3f}".format("manifest (cached)", 1e3 * timeit(dataset.count_data, repeat = args.repeat)))
+    PFINDataset_module._manifests.clear()
+    print("{:>26} {:>12.3f}".format("manifest (new process)", 1e3 * timeit(dataset.count_data, repeat = 1, warmup = 0)))
+    # rewriting a file with a different number of jets must be picked up without deleting the manifest
+    extra = os.path.join(os.path.dirname(os.path.abspath(file_names[0])), "benchmark_extra.h5")
+    dataset.set_file_names(file_names + [extra])
+    for njets in [10, 20]:
+        with h5py.File(extra, "w") as f:
+            f.create_dataset("particles", data=np.zeros((njets, 2, 3), dtype=np.float32))
+        assert dataset.count_data() == n + njets, "manifest was not invalidated"
+    os.remove(extra)
+    dataset.set_file_names(file_names)
+    print("invalidation ok, {} jets, {} batches".format(n, len(dataset.generate_data())))
+
+def bench_cuts(args):
+    # cuts applied to every loaded batch (as train.py used to) versus a JetSelection pushed down into the datasets
+    file_names = data_files(args) if args.data_path else make_jetclass_files(args.outdir, args.nfiles, args.njets)
+    selection = JetSelection(args.massrange, args.ptrange, args.etarange, list(map(int, args.skiplabels.split(','))) if args.skiplabels else [])
+    def run(batches, mask):
+        n, nb = 0, 0
+        for x, m, a, y in batches:
+            if mask:
+                keep = selection.keep(a, y)
+                x, m, a, y = x[keep].to(device), m[keep].to(device), a[keep].to(device), y[keep].to(device)
+            else:
+                x, m, a, y = x.to(device), m.to(device), a.to(device), y.to(device)
+            n, nb = n + len(y), nb + 1
+        return n, nb
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    path = file_names[0]
+    loaders = {
+        "eager": (lambda: batch_loader(PFINDataset(path), args.batch_size), lambda: batch_loader(PFINDataset(path, selection = selection), args.batch_size)),
+        "lazy": (lambda: batch_loader(LazyPFINDataset(path), args.batch_size), lambda: batch_loader(LazyPFINDataset(path, selection = selection), args.batch_size)),
+        "jetclass": (lambda: JetClassData(args.batch_size), lambda: JetClassData(args.batch_size, selection = selection)),
+    }
+    print("{:>10} {:>10} {:>12} {:>10} {:>10} {:>14} {:>12}".format("dataset", "cuts", "open [s]", "epoch [s]", "jets", "batches", "mean batch"))
+    for name, makers in loaders.items():
+        for where, make in zip(["batch", "pushdown"], makers):
+            start = time.perf_counter()
+            loader = make()
+            if name == "jetclass":
+                loader.set_file_names(file_names)
+                len(loader)
+            t_open = time.perf_counter() - start
+            start = time.perf_counter()
+            n, nb = run(loader.generate_data() if name == "jetclass" else loader, where == "batch")
+            t = time.perf_counter() - start
+            print("{:>10} {:>10} {:>12.3f} {:>10.3f} {:>10} {:>14} {:>12.1f}".format(name, where, t_open, t, n, nb, n / nb))
+
+class HostSyncCounter:
+    # counts Tensor.item() and Tensor.numpy() calls, the points where the training loop waits for the device
+    def __enter__(self):
+        self.counts = {"item": 0, "numpy": 0}
+        self.originals = {name: getattr(torch.Tensor, name) for name in self.counts}
+        for name, original in self.originals.items():
+            def counted(tensor, *a, _name = name, _original = original, **k):
+                self.counts[_name] += 1
+                return _original(tensor, *a, **k)
+            setattr(torch.Tensor, name, counted)
+        return self
+
+    def __exit__(self, *exc):
+        for name, original in self.originals.items():
+            setattr(torch.Tensor, name, original)
+
+def bench_metrics(args):
+    # train.py step with per-batch .item()/numpy/sklearn metrics versus the device-resident MetricAccumulator
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    Np = args.Np[0]
+    x, a, m = make_inputs(args.batch_size, Np, 3, device)
+    y = torch.nn.functional.one_hot(torch.randint(0, 2, (args.batch_size,)), 2).float().to(device)
+    model = Model(particle_feats = 3, n_consts = Np, num_classes = 2, device = device).to(device)
+    opt = torch.optim.Adam(model.parameters(), lr = 1e-4)
+    def step(pred, loss, mse_loss, kldiv_loss):
+        opt.zero_grad()
+        loss.backward()
+        opt.step()
+    def host_steps():
+        totals = [0., 0., 0., 0]
+        for _ in range(args.nbatches):
+            if y.sum().int().item() != len(y):
+                sys.exit(1)
+            pred = model(x, a, m)
+            loss, mse_loss, kldiv_loss = LossMSE(y, pred) + KLDiv(y, pred), LossMSE(y, pred), KLDiv(y, pred)
+            totals[0] += loss.item()
+            totals[1] += mse_loss.item()
+            totals[2] += kldiv_loss.item()
+            with torch.no_grad():
+                totals[3] += accuracy_score(np.argmax(getprobs(pred).cpu().numpy(), 1), np.argmax(y.cpu().numpy(), 1), normalize = False)
+            step(pred, loss, mse_loss, kldiv_loss)
+        return totals
+    def no_metrics():
+        for _ in range(args.nbatches):
+            pred = model(x, a, m)
+            loss, mse_loss, kldiv_loss = LossMSE(y, pred) + KLDiv(y, pred), LossMSE(y, pred), KLDiv(y, pred)
+            step(pred, loss, mse_loss, kldiv_loss)
+    def device_steps():
+        metrics = MetricAccumulator(["loss", "mse", "kldiv", "correct", "labels"], device)
+        for _ in range(args.nbatches):
+            pred = model(x, a, m)
+            loss, mse_loss, kldiv_loss = LossMSE(y, pred) + KLDiv(y, pred), LossMSE(y, pred), KLDiv(y, pred)
+            with torch.no_grad():
+                metrics.add(loss = loss, mse = mse_loss, kldiv = kldiv_loss, correct = count_correct(getprobs(pred), y), labels = y.sum())
+            step(pred, loss, mse_loss, kldiv_loss)
+        return metrics.values()
+    # calls are counted relative to a loop without metrics, as e.g. the CPU Adam step calls item() per parameter
+    with HostSyncCounter() as counter:
+        no_metrics()
+    base = counter.counts
+    print("{:>8} {:>14} {:>14} {:>14}".format("metrics", "step [ms]", "item()/step", "numpy()/step"))
+    for name, fn in [("none", no_metrics), ("host", host_steps), ("device", device_steps)]:
+        t = timeit(fn, repeat = args.repeat)
+        with HostSyncCounter() as counter:
+            fn()
+        print("{:>8} {:>14.2f} {:>14.2f} {:>14.2f}".format(name, 1e3 * t / args.nbatches, (counter.counts["item"] - base["item"]) / args.nbatches,
+                                                    (counter.counts["numpy"] - base["numpy"]) / args.nbatches))
+
+def bench_losses(args):
+    # edl_loss against the separate LossMSE/LossCE_Bayes/LossCE_Gibbs + KLDiv calls: values, gradients and time
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    legacy = {"mse": LossMSE, "bayes": LossCE_Bayes, "gibbs": LossCE_Gibbs}
+    print("{:>6} {:>4} {:>6} {:>12} {:>12} {:>12}".format("kind", "K", "coef", "max|dloss|", "max|dcomp|", "max|dgrad|"))
+    for kind, data_fn in legacy.items():
+        for K in [2, 5, 10]:
+            for coef in [0., 0.3, 1.]:
+                torch.manual_seed(0)
+                outs = (torch.relu(torch.randn(1000, K, dtype=torch.float64)) * 5).to(device).requires_grad_()
+                y = torch.nn.functional.one_hot(torch.randint(0, K, (1000,)), K).double().to(device)
+                ref_loss = data_fn(y, outs) + coef * KLDiv(y, outs) if coef else data_fn(y, outs)
+                ref_grad, = torch.autograd.grad(ref_loss, outs)
+                new = edl_loss(y, outs, coef, kind = kind)
+                new_grad, = torch.autograd.grad(new.loss, outs)
+                dcomp = max(abs(new.mse.item() - data_fn(y, outs).item()), abs(new.kl.item() - KLDiv(y, outs).item()))
+                dgrad = (new_grad - ref_grad).abs().max().item()
+                print("{:>6} {:>4} {:>6} {:>12.2e} {:>12.2e} {:>12.2e}".format(kind, K, coef, abs(new.loss.item() - ref_loss.item()), dcomp, dgrad))
+                # KLDiv evaluates lgamma(K) in float32, which alone makes values differ by up to ~1e-7
+                assert dcomp < 1e-6 and dgrad < 1e-10, "edl_loss differs from the separate losses"
+    # forward + backward of the loss terms of one training step, as train.py computed them before and now
+    print("{:>6} {:>4} {:>16} {:>16} {:>8}".format("Nb", "K", "separate [ms]", "edl_loss [ms]", "speedup"))
+    for Nb in args.batch_sizes:
+        for K in [2, 10]:
+            outs = (torch.relu(torch.randn(Nb, K)) * 5).to(device).requires_grad_()
+            y = torch.nn.functional.one_hot(torch.randint(0, K, (Nb,)), K).float().to(device)
+            def separate():
+                loss = LossMSE(y, outs) + 0.5 * KLDiv(y, outs)
+                mse_loss, kldiv_loss = LossMSE(y, outs), KLDiv(y, outs)
+                loss.backward()
+            def combined():
+                loss, mse_loss, kldiv_loss = edl_loss(y, outs, 0.5)
+                loss.backward()
+            t_old = timeit(separate, repeat = args.repeat * 20)
+            t_new = timeit(combined, repeat = args.repeat * 20)
+            print("{:>6} {:>4} {:>16.3f} {:>16.3f} {:>8.2f}".format(Nb, K, 1e3 * t_old, 1e3 * t_new, t_old / t_new))
+
+def bench_amp(args):
+    # inference and training throughput under --amp/--compile, with the predictions compared to eager fp32
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if args.data_path:
+        dataset = PFINDataset(args.data_path.split(',')[0])
+        x, m, a, y = dataset[:]
+    else:
+        x, a, m = make_inputs(4 * args.batch_size, args.Np[0], 3, "cpu", fill = 0.5)
+        y = torch.nn.functional.one_hot(torch.randint(0, 2, (len(x),)), 2).float()
+    Np, Nx, K = x.shape[1], x.shape[2], y.shape[1]
+    torch.manual_seed(0)
+    model = Model(particle_feats = Nx, n_consts = Np, num_classes = K, pair_mode = args.modes[0], device = device).to(device)
+    if args.checkpoint:
+        model.load_state_dict(torch.load(args.checkpoint, map_location = device))
+    model.eval()
+    batches = [(x[i:i+args.batch_size].to(device), a[i:i+args.batch_size].to(device), m[i:i+args.batch_size].to(device))
+               for i in range(0, len(x), args.batch_size)]
+    labels = y.argmax(1).numpy()
+    def predict(fwd, amp):
+        with torch.no_grad():
+            outs = []
+            for xb, ab, mb in batches:
+                with amp_autocast(device, amp):
+                    pred = fwd(xb, ab, mb)
+                outs.append(getprobs(pred.float()).cpu())
+        return torch.cat(outs)
+    ref = predict(model, "off")
+    variants = [(amp, compiled) for compiled in ([False, True] if args.compile else [False]) for amp in ["off", "bf16", "fp16"]]
+    print("{:>5} {:>8} {:>12} {:>14} {:>10} {:>10} {:>10}".format("amp", "compile", "eval jets/s", "max|dprob|", "argmax=", "acc", "AUC"))
+    for amp, compiled in variants:
+        fwd = torch.compile(model) if compiled else model
+        probs = predict(fwd, amp)
+        t = timeit(lambda: predict(fwd, amp), repeat = args.repeat)
+        acc = (probs.argmax(1).numpy() == labels).mean()
+        auc = roc_auc_score(labels, probs[:, 1].numpy()) if K == 2 else roc_auc_score(labels, probs.numpy(), multi_class='ovo')
+        print("{:>5} {:>8} {:>12.0f} {:>14.2e} {:>10.4f} {:>10.4f} {:>10.4f}".format(amp, str(compiled), len(x) / t, (probs - ref).abs().max().item(),
+                                                                            (probs.argmax(1) == ref.argmax(1)).float().mean().item(), acc, auc))
+    print("{:>5} {:>8} {:>13}".format("amp", "compile", "train jets/s"))
+    for amp, compiled in variants:
+        torch.manual_seed(0)
+        train_model = Model(particle_feats = Nx, n_consts = Np, num_classes = K, pair_mode = args.modes[0], device = device).to(device)
+        fwd = torch.compile(train_model) if compiled else train_model
+        opt = torch.optim.Adam(train_model.parameters(), lr = 1e-4)
+        scaler = torch.amp.GradScaler(device.type, enabled = amp == "fp16")
+        def epoch():
+            for i, (xb, ab, mb) in enumerate(batches):
+                yb = y[i*args.batch_size:(i+1)*args.batch_size].to(device)
+                opt.zero_grad()
+                with amp_autocast(device, amp):
+                    pred = fwd(xb, ab, mb)
+                loss = edl_loss(yb, pred.float(), 0.5).loss
+                scaler.scale(loss).backward()
+                scaler.step(opt)
+                scaler.update()
+        print("{:>5} {:>8} {:>13.0f}".format(amp, str(compiled), len(x) / timeit(epoch, repeat = args.repeat)))
+
+def make_members(outdir, K, data_type = "topdata", extra = [], seed = 0):
+    # K randomly initialized members as train.py would save them: <outdir>/trained_models/UQPFIN_best_<label>_k
+    # and <outdir>/trained_model_dicts/UQPFIN_<label>_k.json; returns the checkpoint paths
+    for d in ["trained_models", "trained_model_dicts"]:
+        os.makedirs(os.path.join(outdir, d), exist_ok = True)
+    paths = []
+    for k in range(K):
+        label = "{}_bench_{}".format(data_type, k)
+        model_args = get_parser().parse_args(["--data-type", data_type, "--label", label] + extra)
+        features, Np, num_classes, _, _ = data_settings(data_type, model_args.skiplabels)
+        torch.manual_seed(seed + k)
+        model = Model(particle_feats = features, n_consts = Np, num_classes = num_classes, use_softmax = model_args.use_softmax,
+                      use_dropout = model_args.use_dropout, pair_mode = model_args.pair_mode, use_p4 = model_args.use_p4, device = "cpu")
+        path = os.path.join(outdir, "trained_models", "UQPFIN_best_" + label)
+        torch.save(model.state_dict(), path)
+        with open(os.path.join(outdir, "trained_model_dicts", "UQPFIN_{}.json".format(label)), "w") as f:
+            json.dump({k: v for k, v in vars(model_args).items() if k != "load_json"}, f, indent = 3)
+        paths.append(path)
+    return paths
+
+def ensemble_per_member(model_paths, test_set):
+    # EnsembleEvaluator.evaluate before the single-pass engine: one ModelEvaluator and one pass over the data per member,
+    # with the (K, N, C) probabilities stacked at the end
+    probs = []
+    for ii, model_path in enumerate(model_paths):
+        model_evaluator = ModelEvaluator(model_path, evalMode = True)
+        testloader = batch_loader(test_set, 512)
+        if ii == 0:
+            labels, _, _, this_probs, _, oods, _ = model_evaluator.evaluate(testloader, batchmode = True)
+        else:
+            _, _, _, this_probs, _, _, _ = model_evaluator.evaluate(testloader, batchmode = True)
+        probs.append(this_probs[None,:,:])
+        del model_evaluator
+    probs = np.concatenate(probs, axis = 0)
+    uncs = np.std(probs, axis = 0).max(axis = 1)
+    probs = np.mean(probs, axis = 0)
+    return labels, probs, uncs, oods
+
+def _ensemble_eval_worker(method, model_paths, args):
+    test_set = PFINDataset(args.data_path.split(',')[0])
+    if method == "per member":
+        return (ensemble_per_member(model_paths, test_set),)
+    evaluator = EnsembleEvaluator(model_paths, data_type = "topdata", stack = method)
+    labels, preds, maxprobs, probs, sums, oods, uncs = evaluator.evaluate(test_set = test_set, batchmode = True)
+    return ((labels, probs, uncs, oods),)
+
+def bench_ensemble_eval(args):
+    # EnsembleEvaluator's single pass (loop and vmap) against one pass per member: time, peak memory and agreement
+    print("{:>4} {:>10} {:>10} {:>14} {:>12} {:>12}".format("K", "method", "time [s]", "peak mem [MB]", "max|dprob|", "max|dunc|"))
+    for K in args.members:
+        model_paths = make_members(os.path.join(args.outdir, "ensemble_{}".format(K)), K, extra = ["--use-softmax", "--pair-mode", args.modes[0]])
+        ref = None
+        for method in ["per member", "loop", "vmap"]:
+            start = time.perf_counter()
+            labels, probs, uncs, oods = _ensemble_eval_worker(method, model_paths, args)[0]
+            t = time.perf_counter() - start
+            peak = peak_memory(_ensemble_eval_worker, lambda: (method, model_paths, args))
+            if ref is None:
+                ref = (labels, probs, uncs, oods)
+            dprob, dunc = np.abs(probs - ref[1]).max(), np.abs(uncs - ref[2]).max()
+            print("{:>4} {:>10} {:>10.2f} {:>14.1f} {:>12.2e} {:>12.2e}".format(K, method, t, peak, dprob, dunc))
+            assert (labels == ref[0]).all() and (oods == ref[3]).all() and dprob < 1e-5 and dunc < 1e-5, "single-pass ensemble differs from the per-member path"
+
+def mcdo_per_pass(model_path, test_set, samples):
+    # MCDOEvaluator.evaluate before the batched engine: one pass over the data in train() mode per dropout sample,
+    # with the (S, N, C) probabilities stacked at the end
+    probs = []
+    model_evaluator = ModelEvaluator(model_path, evalMode = False)
+    for ii in range(samples):
+        testloader = batch_loader(test_set, 512)
+        if ii == 0:
+            labels, _, _, this_probs, _, oods, _ = model_evaluator.evaluate(testloader, batchmode = True)
+        else:
+            _, _, _, this_probs, _, _, _ = model_evaluator.evaluate(testloader, batchmode = True)
+        probs.append(this_probs[None,:,:])
+    probs = np.concatenate(probs, axis = 0)
+    uncs = np.std(probs, axis = 0).max(axis = 1)
+    return labels, np.mean(probs, axis = 0), uncs, oods
+
+def bench_mcdo(args):
+    # MCDOEvaluator's batched dropout samples against one pass per sample: throughput in jet samples per second and
+    # agreement of the mean probabilities within their sampling error (the dropout masks differ between the two)
+    model_path = make_members(os.path.join(args.outdir, "mcdo"), 1, extra = ["--use-softmax", "--use-dropout", "--pair-mode", args.modes[0]])[0]
+    test_set = PFINDataset(args.data_path.split(',')[0])
+    N = len(test_set)
+    print("{:>5} {:>8} {:>10} {:>14} {:>10} {:>12} {:>12}".format("S", "chunk", "time [s]", "jet samples/s", "speedup", "max z(prob)", "mean unc"))
+    for S in args.samples:
+        start = time.perf_counter()
+        labels, probs, uncs, oods = mcdo_per_pass(model_path, test_set, S)
+        t_ref = time.perf_counter() - start
+        print("{:>5} {:>8} {:>10.2f} {:>14.0f} {:>10} {:>12} {:>12.4f}".format(S, "per pass", t_ref, N * S / t_ref, "1.00", "", uncs.mean()))
+        for chunk in args.mc_chunks:
+            evaluator = MCDOEvaluator(model_path, data_type = "topdata", samples = S, chunk_size = chunk)
+            start = time.perf_counter()
+            this_labels, _, _, this_probs, _, this_oods, this_uncs, entropy, mutual_info = evaluator.evaluate(test_set = test_set, batchmode = True, info = True)
+            t = time.perf_counter() - start
+            # the std over the samples bounds the std of every class probability, so this z is conservative
+            z = np.abs(this_probs - probs).max(-1) / np.sqrt((uncs**2 + this_uncs**2) / S + 1e-12)
+            print("{:>5} {:>8} {:>10.2f} {:>14.0f} {:>10.2f} {:>12.2f} {:>12.4f}".format(S, chunk, t, N * S / t, t_ref / t, z.max(), this_uncs.mean()))
+            assert (this_labels == labels).all() and (this_oods == oods).all(), "batched MC dropout reads different jets"
+            assert (mutual_info > -1e-5).all() and (mutual_info <= entropy + 1e-5).all(), "mutual information outside [0, entropy]"
+            assert z.max() < 6, "batched MC dropout mean differs from the per-pass mean beyond the sampling error"
+
+def bench_ablation(args):
+    # full pair-ablation sweep (every pair i < j of the Np particles masked in turn) with PairwiseEvaluator.sweep, without
+    # and with the activation cache, and MC dropout sampling without and with the cache for the layers before the first dropout
+    model_path = make_members(os.path.join(args.outdir, "ablation"), 1, extra = ["--use-softmax", "--pair-mode", args.modes[0]])[0]
+    test_set = PFINDataset(args.data_path.split(',')[0])
+    pairs = [[i, j] for i in range(test_set.masks.shape[-1]) for j in range(i + 1, test_set.masks.shape[-1])]
+    print("{:>10} {:>8} {:>10} {:>12} {:>8} {:>8} {:>12}".format("cache", "pairs", "time [s]", "ablations/s", "hits", "misses", "max|dprob|"))
+    ref = None
+    for cache_bytes in [0, 2**30]:
+        evaluator = PairwiseEvaluator(model_path, cache_bytes = cache_bytes)
+        start = time.perf_counter()
+        labels, probs, uncs = evaluator.sweep(batch_loader(test_set, args.batch_size), pairs, max_batches = args.nbatches)
+        t = time.perf_counter() - start
+        ref = probs if ref is None else ref
+        hits, misses = (evaluator.cache.hits, evaluator.cache.misses) if evaluator.cache is not None else (0, 0)
+        print("{:>10} {:>8} {:>10.2f} {:>12.1f} {:>8} {:>8} {:>12.2e}".format(cache_bytes, len(pairs), t, len(pairs) * len(labels) / args.batch_size / t,
+                                                                         hits, misses, np.abs(probs - ref).max()))
+        assert np.abs(probs - ref).max() < 1e-5, "cached ablations differ from the uncached ones"
+
+    model_path = make_members(os.path.join(args.outdir, "ablation_mcdo"), 1, extra = ["--use-softmax", "--use-dropout", "--pair-mode", args.modes[0]])[0]
+    print("{:>10} {:>8} {:>10} {:>14}".format("cache", "S", "time [s]", "jet samples/s"))
+    for S in args.samples:
+        for cache_bytes in [0, 2**30]:
+            evaluator = MCDOEvaluator(model_path, data_type = "topdata", samples = S, cache_bytes = cache_bytes)
+            start = time.perf_counter()
+            evaluator.evaluate(test_set = test_set, batchmode = True)
+            t = time.perf_counter() - start
+            print("{:>10} {:>8} {:>10.2f} {:>14.0f}".format(cache_bytes, S, t, len(test_set) * S / t))
+
+def threshold_loop(uncs, oods, labels, preds, urange):
+    # the PlotterTools curves as computed before ThresholdSweep: boolean masks over all jets for every threshold
+    rates = {name: [] for name in ["odr", "ood_miss", "imr", "id_keep", "id_err", "idacc", "acc", "ocr", "rar", "rer"]}
+    for u in urange:
+        f = uncs >= u
+        rates["odr"].append((oods & f).sum()/oods.sum())
+        rates["ood_miss"].append((oods & ~f).sum()/oods.sum())
+        rates["imr"].append((~oods & f).sum()/(~oods).sum())
+        rates["id_keep"].append((~oods & ~f).sum()/(~oods).sum())
+        pred_id_indices = (uncs >= u) & (~oods)
+        rates["id_err"].append((labels[pred_id_indices] != preds[pred_id_indices]).sum()/(~oods).sum())
+        pred_id_indices = (uncs < u) & (~oods)
+        rates["idacc"].append((labels[pred_id_indices] == preds[pred_id_indices]).sum()/(~oods).sum())
+        pred_id_indices = uncs < u
+        rates["acc"].append(((labels[pred_id_indices] == preds[pred_id_indices]).sum() + (oods & (uncs >= u)).sum())/len(labels))
+        rates["ocr"].append((oods & (uncs >= u)).sum()/(uncs >= u).sum())
+        CC_id_indices = (uncs < u) & (~oods)
+        rates["rar"].append((((uncs >= u) & oods).sum() + (labels[CC_id_indices] == preds[CC_id_indices]).sum())/len(labels))
+        rates["rer"].append((((uncs < u) & oods).sum() + ((uncs >= u) & ~oods).sum())/len(labels))
+    return {name: np.array(v) for name, v in rates.items()}
+
+def bench_sweep(args):
+    # PlotterTools threshold curves: ThresholdSweep against the per-threshold loop on synthetic results with tied and NaN
+    # uncertainties, for the default 100 thresholds and (sweep only) every unique uncertainty
+    rng = np.random.default_rng(0)
+    N = args.njets
+    uncs = np.round(rng.random(N), 4).astype(np.float32)
+    uncs[rng.random(N) < 1e-4] = np.nan
+    oods = rng.random(N) < 0.1
+    labels = rng.integers(0, 10, N)
+    preds = np.where(rng.random(N) < 0.8, labels, rng.integers(0, 10, N))
+    ul, ur = np.nanmin(uncs), np.nanmax(uncs)
+    du = (ur - ul)/100
+    urange = np.arange(ul+du, ur-du, du)
+    print("{:>10} {:>10} {:>12} {:>10} {:>12}".format("jets", "thresholds", "method", "time [s]", "max|drate|"))
+    start = time.perf_counter()
+    ref = threshold_loop(uncs, oods, labels, preds, urange)
+    t_loop = time.perf_counter() - start
+    print("{:>10} {:>10} {:>12} {:>10.3f} {:>12}".format(N, len(urange), "loop", t_loop, ""))
+    for thresholds in [urange, np.unique(uncs[~np.isnan(uncs)])]:
+        start = time.perf_counter()
+        rates = ThresholdSweep(uncs, oods, labels, preds).rates(thresholds)
+        t = time.perf_counter() - start
+        if len(thresholds) != len(urange):
+            print("{:>10} {:>10} {:>12} {:>10.3f} {:>12}".format(N, len(thresholds), "sweep", t, ""))
+        else:
+            d = max(np.nanmax(np.abs(rates[k] - ref[k])) for k in ref)
+            print("{:>10} {:>10} {:>12} {:>10.3f} {:>12.2e}".format(N, len(thresholds), "sweep", t, d))
+            assert all((np.isnan(rates[k]) == np.isnan(ref[k])).all() for k in ref) and d == 0, "ThresholdSweep differs from the loop"
+
+def bench_binned(args):
+    # BinnedStats against the per-bin loops of PlotterTools.UNC_ENTROPY/CDF_ENTROPY and np.histogram/np.histogram2d
+    # (as used by ax.hist/ax.hist2d in uncertainty_plot) on synthetic results with jetclass-like labels
+    rng = np.random.default_rng(0)
+    N = args.njets
+    entropy = (rng.random(N) * np.log(10)).astype(np.float32)
+    uncs = rng.random(N).astype(np.float32)
+    maxprobs = rng.random(N).astype(np.float32)
+    labels = rng.integers(0, 10, N)
+    preds = np.where(rng.random(N) < 0.8, labels, rng.integers(0, 10, N))
+    bins = np.linspace(entropy.min(), entropy.max(), 200)
+    ubins = np.arange(0.,1.01,0.04)
+    lbins = np.arange(0.,11,1)
+
+    def loop_stats():
+        digitized = np.digitize(entropy, bins)
+        bin_means = np.array([uncs[digitized == i].mean() for i in range(1, len(bins))])
+        bin_stds = np.array([uncs[digitized == i].std() for i in range(1, len(bins))])
+        return bin_means, bin_stds
+    def loop_cdf():
+        return np.array([np.sum(entropy <= bins[i]) / len(entropy) for i in range(len(bins))])
+    def numpy_hists():
+        return (np.histogram(uncs, ubins)[0], np.histogram2d(maxprobs, uncs, [ubins, ubins])[0],
+                np.histogram2d(labels, preds, [lbins, lbins])[0], np.histogram2d(labels, uncs + preds - 1.e-4, [lbins, np.arange(0.,11,0.2)])[0])
+    def bincount_hists():
+        return (histogram(uncs, ubins), histogram2d(maxprobs, uncs, ubins, ubins),
+                histogram2d(labels, preds, lbins, lbins), histogram2d(labels, uncs + preds - 1.e-4, lbins, np.arange(0.,11,0.2)))
+
+    print("{:>10} {:>14} {:>10} {:>10} {:>10} {:>12}".format("jets", "statistic", "loop [s]", "new [s]", "speedup", "max|diff|"))
+    for name, old, new in [("bin mean/std", loop_stats, lambda: bin_stats(entropy, uncs, bins)[:2]),
+                           ("cdf", loop_cdf, lambda: cdf(entropy, bins)),
+                           ("histograms", numpy_hists, bincount_hists)]:
+        start = time.perf_counter()
+        ref = old()
+        t_old = time.perf_counter() - start
+        start = time.perf_counter()
+        out = new()
+        t_new = time.perf_counter() - start
+        d = max(np.nanmax(np.abs(np.asarray(a, dtype = float) - np.asarray(b, dtype = float))) for a, b in zip(out, ref)) if isinstance(ref, tuple) \
+            else np.abs(out - ref).max()
+        print("{:>10} {:>14} {:>10.3f} {:>10.3f} {:>10.1f} {:>12.2e}".format(N, name, t_old, t_new, t_old / t_new, d))
+        assert d < 1e-6, "{} differs from the reference".format(name)
+
+def results_batch(i, Nb, nclasses = 10, nlatent = 64):
+    # synthetic evaluate_model.py results of batch i, the same for every call
+    rng = np.random.default_rng(i)
+    labels = rng.integers(0, nclasses, Nb)
+    probs = rng.dirichlet(np.ones(nclasses), Nb).astype(np.float32)
+    sums = (rng.random(Nb) * 100 + nclasses).astype(np.float32)
+    return {"labels": labels, "preds": probs.argmax(-1), "maxprobs": probs.max(-1), "probs": probs, "oods": labels >= nclasses - 2,
+            "sums": sums, "uncs": nclasses / sums, "latents": rng.standard_normal((Nb, nlatent)).astype(np.float32),
+            "aug": rng.random((Nb, 7)).astype(np.float32)}
+
+def bench_results(args):
+    # writing and reading evaluation results: batches collected in lists, concatenated and written in one shot (as before)
+    # against ResultsWriter streaming every batch to the file, and h5py loading against read_results, without and with
+    # its memory-mapped copies
+    N, Nb = args.njets, args.batch_size
+    nbatches = (N + Nb - 1) // Nb
+    os.makedirs(args.outdir, exist_ok = True)
+    files = {m: os.path.join(args.outdir, "RESULTS_{}.h5".format(m)) for m in ["collect", "stream"]}
+
+    def collect():
+        results = {}
+        for i in range(nbatches):
+            for key, value in results_batch(i, Nb).items():
+                results.setdefault(key, []).append(value)
+        results = {key: np.concatenate(values) for key, values in results.items()}
+        with h5py.File(files["collect"], "w") as f:
+            for key, value in results.items():
+                f.create_dataset(key, data = value)
+    def stream():
+        with ResultsWriter(files["stream"]) as writer:
+            for i in range(nbatches):
+                writer.append(**results_batch(i, Nb))
+    def load_h5():
+        with h5py.File(files["collect"], "r") as f:
+            results = {key: f[key][:] for key in f.keys()}
+        return PlotterTools(results, "h5py").rates
+    def load_read():
+        return PlotterTools(read_results(files["stream"]), "read").rates
+    def load_mmap():
+        return PlotterTools(read_results(files["stream"], cache_dir = os.path.join(args.outdir, ".results_cache")), "mmap").rates
+
+    print("{:>10} {:>10} {:>10} {:>10} {:>10}".format("jets", "method", "time [s]", "peak [MB]", "file [MB]"))
+    for name, fn in [("collect", collect), ("stream", stream)]:
+        start = time.perf_counter()
+        fn()
+        t = time.perf_counter() - start
+        peak = peak_memory(fn, lambda: ())
+        print("{:>10} {:>10} {:>10.2f} {:>10.0f} {:>10.0f}".format(N, name, t, peak, os.path.getsize(files[name]) / 2**20))
+    with h5py.File(files["collect"], "r") as a, h5py.File(files["stream"], "r") as b:
+        assert sorted(a.keys()) == sorted(b.keys()) and all(a[k].dtype == b[k].dtype and (a[k][:] == b[k][:]).all() for k in a), \
+            "streamed results differ from the collected ones"
+    shutil.rmtree(os.path.join(args.outdir, ".results_cache"), ignore_errors = True)
+    for name, fn in [("h5py", load_h5), ("read", load_read), ("mmap", load_mmap), ("mmap", load_mmap)]:
+        start = time.perf_counter()
+        rates = fn()
+        t = time.perf_counter() - start
+        # the second mmap run reads the cached copies
+        peak = peak_memory(fn, lambda: ())
+        print("{:>10} {:>10} {:>10.2f} {:>10.0f} {:>10}".format(N, name, t, peak, ""))
+        if name == "h5py":
+            ref = rates
+        else:
+            assert all(np.array_equal(rates[k], ref[k], equal_nan = True) for k in ref), "PlotterTools rates differ on read_results"
+
+def topdata_test_file(args, outdir):
+    # <outdir>/topdata/processed/test.h5 as evaluate_model.py --data-loc <outdir> reads it: a link to the first
+    # --data-path file, or args.njets synthetic top jets
+    data_dir = os.path.join(outdir, "topdata", "processed")
+    test_file = os.path.join(data_dir, "test.h5")
+    if args.data_path:
+        os.makedirs(data_dir, exist_ok = True)
+        if not os.path.exists(test_file):
+            os.symlink(os.path.abspath(args.data_path.split(',')[0]), test_file)
+    elif not os.path.exists(test_file):
+        os.replace(make_jetclass_files(data_dir, 1, args.njets, Np = 60, Nx = 3, nclasses = 2, chunk = min(1000, args.njets))[0], test_file)
+    return test_file
+
+def bench_eval_cache(args):
+    # ModelEvaluator with an EvalCache on a directory of random models: the first run evaluates every model, the run
+    # after adding one only the new one (make_members writes the old checkpoints again with the same content, which
+    # keeps their keys). Then a budget of about a quarter of the entries: only the most recently used ones are kept.
+    outdir = os.path.join(args.outdir, "eval_cache")
+    shutil.rmtree(os.path.join(outdir, "cache"), ignore_errors = True)
+    test_set = PFINDataset(topdata_test_file(args, outdir))
+    loader = batch_loader(test_set, 512)
+    def run(model_paths, cache):
+        start = time.perf_counter()
+        misses = cache.misses
+        results = [ModelEvaluator(path, cache = cache).evaluate(data_loader = loader, latent = True, aug = True, batchmode = True) for path in model_paths]
+        return results, time.perf_counter() - start, cache.misses - misses
+
+    cache = EvalCache(os.path.join(outdir, "cache"))
+    print("{:>7} {:>20} {:>10} {:>10} {:>8}".format("models", "run", "evaluated", "time [s]", "speedup"))
+    model_paths = make_members(outdir, args.models)
+    ref, t_ref, n = run(model_paths, cache)
+    print("{:>7} {:>20} {:>10} {:>10.1f} {:>8.2f}".format(len(model_paths), "cold", n, t_ref, 1.))
+    model_paths = make_members(outdir, args.models + 1)
+    results, t, n = run(model_paths, cache)
+    print("{:>7} {:>20} {:>10} {:>10.1f} {:>8.2f}".format(len(model_paths), "one model added", n, t, t_ref * len(model_paths) / len(ref) / t))
+    assert n == 1, "{} models evaluated instead of the new one".format(n)
+    for a, b in zip(ref, results):
+        assert all(np.array_equal(x, y) for x, y in zip(a, b)), "cached results differ from the evaluated ones"
+
+    entry_bytes = os.path.getsize(cache.path(cache.key("model", model_paths[:1], {"amp": "off", "compile": False, "train": False, "aug": True, "latent": True}, loader)))
+    keep = max(len(model_paths) // 4, 1)
+    cache = EvalCache(os.path.join(outdir, "cache"), max_bytes = int(entry_bytes * (keep + 0.5)))
+    cache.evict()
+    _, t, n = run(model_paths[-keep:], cache)
+    print("{:>7} {:>20} {:>10} {:>10.1f} {:>8}".format(keep, "last {} in budget".format(keep), n, t, ""))
+    assert len(os.listdir(cache.cache_dir)) == keep and n == 0, "the most recently used entries were evicted"
+
+def bench_model_sweep(args):
+    # evaluate_model.py --type edl --make-file on a directory of random models: one after the other in one process
+    # against --workers processes sharing the test data, then the re-runs with --yes once nothing and once one
+    # checkpoint changed (only that one is evaluated again)
+    outdir = os.path.join(args.outdir, "model_sweep")
+    make_members(outdir, args.models)
+    topdata_test_file(args, outdir)
+    def run(results, workers):
+        cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "evaluate_model.py"), "--data", "topdata", "--data-loc", outdir,
+               "--modeldir", os.path.join(outdir, "trained_models/"), "--modeldictdir", os.path.join(outdir, "trained_model_dicts/"),
+               "--type", "edl", "--batch-mode", "--make-file", "--yes", "--workers", str(workers), "--outdir", os.path.join(outdir, results)]
+        start = time.perf_counter()
+        out = subprocess.run(cmd, capture_output = True, text = True, check = True).stdout
+        return time.perf_counter() - start, out.count("Accuracy")
+
+    print("{:>7} {:>8} {:>16} {:>10} {:>10} {:>8}".format("models", "workers", "run", "time [s]", "evaluated", "speedup"))
+    ref = None
+    for workers in [0, args.workers]:
+        shutil.rmtree(os.path.join(outdir, "results_{}".format(workers)), ignore_errors = True)
+        t, n = run("results_{}".format(workers), workers)
+        ref = ref or t
+        print("{:>7} {:>8} {:>16} {:>10.1f} {:>10} {:>8.2f}".format(args.models, workers, "all", t, n, ref / t))
+    for name in sorted(os.listdir(os.path.join(outdir, "results_0"))):
+        if name.endswith(".h5"):
+            with h5py.File(os.path.join(outdir, "results_0", name), "r") as a, h5py.File(os.path.join(outdir, "results_{}".format(args.workers), name), "r") as b:
+                assert all((a[k][:] == b[k][:]).all() for k in a), "{} differs between the sequential and the parallel run".format(name)
+    for changed in [0, 1]:
+        if changed:
+            os.utime(os.path.join(outdir, "trained_models", "UQPFIN_best_topdata_bench_0"))
+        t, n = run("results_{}".format(args.workers), args.workers)
+        print("{:>7} {:>8} {:>16} {:>10.1f} {:>10} {:>8.2f}".format(args.models, args.workers, "re-run, {} new".format(changed), t, n, ref / t))
+        assert n == changed, "re-run evaluated {} models instead of {}".format(n, changed)
+
+def bench_ensemble(args):
+    # one training epoch of K members: K sequential runs against UQPFINEnsemble (loop and vmap) fed from the same batches;
+    # every member must end up with the weights it gets when trained alone on those batches
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if args.data_path:
+        dataset = PFINDataset(args.data_path.split(',')[0])
+    else:
+        x, a, m = make_inputs(args.nbatches * args.batch_size, args.Np[0], 3, "cpu", fill = 0.5)
+        x = x * torch.rand_like(x)
+        y = torch.nn.functional.one_hot(torch.randint(0, 2, (len(x),)), 2).float()
+        dataset = torch.utils.data.TensorDataset(x, m, a, y)
+    loader = DataLoader(dataset, batch_size = args.batch_size, shuffle = False)
+    Np, Nx, C = dataset[0][0].shape[0], dataset[0][0].shape[1], dataset[0][3].shape[0]
+    def new_models(K):
+        torch.manual_seed(0)
+        return [Model(particle_feats = Nx, n_consts = Np, num_classes = C, use_softmax = True, pair_mode = args.modes[0], device = device).to(device) for _ in range(K)]
+    def train_epoch(model):
+        # forward/backward/step over the loader, as in train.py; the model returns (Nb, C) or (K, Nb, C)
+        opt = torch.optim.Adam(model.parameters(), lr = 1e-3)
+        for x, m, a, y in loader:
+            x, m, a, y = x.to(device), m.to(device), a.to(device), y.to(device)
+            opt.zero_grad()
+            pred = model(x, a, m)
+            pred = pred if pred.dim() == 3 else pred[None]
+            torch.stack([LossCE(y, p) for p in pred]).sum().backward()
+            opt.step()
+    train_epoch(new_models(1)[0]) # warm-up
+    print("{:>4} {:>16} {:>16} {:>16} {:>10} {:>10} {:>14}".format("K", "sequential [s]", "loop [s]", "vmap [s]", "x loop", "x vmap", "max|dparam|"))
+    for K in args.members:
+        start = time.perf_counter()
+        sequential = new_models(K)
+        for model in sequential:
+            train_epoch(model)
+        t_seq = time.perf_counter() - start
+        times = {}
+        dparam = 0.
+        for stack in ["loop", "vmap"]:
+            start = time.perf_counter()
+            ensemble = UQPFINEnsemble(new_models(K), stack = stack)
+            train_epoch(ensemble)
+            times[stack] = time.perf_counter() - start
+            for member, model in zip(ensemble.members, sequential):
+                dparam = max(dparam, max((p - q).abs().max().item() for p, q in zip(member.parameters(), model.parameters())))
+        print("{:>4} {:>16.2f} {:>16.2f} {:>16.2f} {:>10.2f} {:>10.2f} {:>14.2e}".format(K, t_seq, times["loop"], times["vmap"],
+                                                                                  t_seq / times["loop"], t_seq / times["vmap"], dparam))
+        assert dparam < 1e-4, "ensemble members differ from members trained alone"
+
+def _ddp_worker(rank, world_size, init_file, inputs, queue):
+    # one training step of a DDP model on this rank's share of the batch; rank 0 returns the updated parameters
+    torch.set_num_threads(1)
+    dist.init_process_group("gloo", init_method = "file://" + init_file, rank = rank, world_size = world_size)
+    x, a, m, y = (t.chunk(world_size)[rank] for t in inputs)
+    torch.manual_seed(rank) # different initial weights, DDP starts all ranks from rank 0's
+    model = Model(particle_feats = x.shape[2], n_consts = x.shape[1], num_classes = y.shape[1], use_softmax = True, device = "cpu")
+    fwd = wrap_model(model, torch.device("cpu"))
+    opt = torch.optim.Adam(model.parameters(), lr = 1e-3)
+    loss = LossCE(y, fwd(x, a, m))
+    loss.backward()
+    opt.step()
+    metrics = MetricAccumulator(["loss", "jets"], "cpu")
+    metrics.add(loss = loss, jets = len(y))
+    metrics.all_reduce()
+    if rank == 0:
+        queue.put(({k: v.numpy().copy() for k, v in model.state_dict().items()}, metrics.values()))
+    dist.destroy_process_group()
+
+def bench_ddp(args):
+    # sharding of the samplers and JetClassData files, and one DDP step against the same step in one process
+    print("{:>12} {:>4} {:>12} {:>12} {:>10} {:>10}".format("sampler", "R", "batches/rank", "jets/rank", "disjoint", "dropped"))
+    for name, cls in [("contiguous", ContiguousBatchSampler), ("random", RandomBatchSampler)]:
+        for R in [1, 2, 3]:
+            n = 10 * args.batch_size + 7
+            kwargs = {"shuffle": True} if cls is ContiguousBatchSampler else {}
+            shards = []
+            for rank in range(R):
+                sampler = cls(n, args.batch_size, num_replicas = R, rank = rank, seed = 1, **kwargs)
+                sampler.set_epoch(3)
+                batches = list(sampler)
+                assert len(batches) == len(sampler), "sampler length does not match its batches"
+                shards.append(np.concatenate([np.arange(n)[b] for b in batches]))
+            seen = np.concatenate(shards)
+            assert len(set(len(list(cls(n, args.batch_size, num_replicas = R, rank = r, **kwargs))) for r in range(R))) == 1, "ranks run different numbers of batches"
+            disjoint = len(np.unique(seen)) == len(seen)
+            assert disjoint, "ranks share samples"
+            print("{:>12} {:>4} {:>12} {:>12} {:>10} {:>10}".format(name, R, len(shards[0]) // args.batch_size + (len(shards[0]) % args.batch_size > 0),
+                                                                   len(shards[0]), str(disjoint), n - len(seen)))
+    # JetClassData rows (aug_data[:, 0] is the global jet index), also with fewer files than ranks and a selection
+    file_names = make_jetclass_files(os.path.join(args.outdir, "ddp_files"), 2, 10 * args.batch_size + 7, Np = 8, Nx = 3, chunk = args.batch_size)
+    print("{:>12} {:>4} {:>12} {:>12} {:>10} {:>10}".format("JetClass", "R", "batches/rank", "jets/rank", "disjoint", "dropped"))
+    for name, selection, shuffle_buffer in [("files", None, 0), ("stream", None, 4 * args.batch_size),
+                                            ("selection", JetSelection("AND:0,150", "AND:0,10000", "AND:-10,10"), 0)]:
+        for R in [1, 3, 4]:
+            seen, nbatches = [], []
+            for rank in range(R):
+                data = JetClassData(batch_size = args.batch_size, shuffle_buffer = shuffle_buffer, selection = selection, num_replicas = R, rank = rank)
+                data.set_file_names(file_names)
+                batches = list(data.generate_data(shuffle = True))
+                assert len(batches) == data.num_batches(), "JetClassData length does not match its batches"
+                nbatches.append(len(batches))
+                seen.append(np.concatenate([a[:, 0].numpy() for _, _, a, _ in batches]))
+            seen = np.concatenate(seen)
+            total = JetClassData(batch_size = args.batch_size, selection = selection)
+            total.set_file_names(file_names)
+            disjoint = len(np.unique(seen)) == len(seen)
+            assert len(set(nbatches)) == 1 and disjoint, "JetClassData ranks run different numbers of batches or share jets"
+            print("{:>12} {:>4} {:>12} {:>12} {:>10} {:>10}".format(name, R, nbatches[0], len(seen) // R, str(disjoint), len(total) - len(seen)))
+
+    torch.manual_seed(0)
+    x, a, m = make_inputs(2 * args.batch_size, args.Np[0], 3, "cpu", fill = 0.5)
+    x = x * torch.rand_like(x)
+    y = torch.nn.functional.one_hot(torch.randint(0, 2, (len(x),)), 2).float()
+    # softmax outputs, so that the random model has non-zero gradients (its evidence is all zero on these inputs)
+    torch.manual_seed(0)
+    model = Model(particle_feats = 3, n_consts = args.Np[0], num_classes = 2, use_softmax = True, device = "cpu")
+    init = {k: v.clone() for k, v in model.state_dict().items()}
+    opt = torch.optim.Adam(model.parameters(), lr = 1e-3)
+    loss = LossCE(y, model(x, a, m))
+    loss.backward()
+    opt.step()
+    ctx = mp.get_context("fork")
+    queue = ctx.Queue()
+    init_file = os.path.join(args.outdir, "ddp_init")
+    os.makedirs(args.outdir, exist_ok = True)
+    if os.path.exists(init_file):
+        os.remove(init_file)
+    procs = [ctx.Process(target = _ddp_worker, args = (rank, 2, init_file, (x, a, m, y), queue)) for rank in range(2)]
+    for p in procs:
+        p.start()
+    state, metrics = queue.get()
+    for p in procs:
+        p.join()
+    dparam = max((torch.from_numpy(state[k]) - v).abs().max().item() for k, v in model.state_dict().items())
+    step = max((model.state_dict()[k] - v).abs().max().item() for k, v in init.items())
+    print("1 process vs 2 DDP processes after one step: max|dparam| = {:.2e} (step size {:.2e}), loss {:.6f} vs {:.6f}".format(dparam, step, loss.item(), metrics["loss"] / 2))
+    assert dparam < 1e-5, "DDP step differs from the single-process step"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--test", type=str, action="store", dest="test", default="pairs", choices=["pairs", "packed", "features", "p4", "loader", "sampler", "prefetch", "shuffle", "stitch", "manifest", "cuts", "metrics", "losses", "amp", "ddp", "ensemble", "ensemble-eval", "mcdo", "ablation", "sweep", "binned", "results", "model-sweep", "eval-cache"], help="Benchmark to run")
+    parser.add_argument("--Np", type=str, action="store", dest="Np", default="30,60,128,256", help="Comma-separated list of number of constituents")
+    parser.add_argument("--modes", type=str, action="store", dest="modes", default="matmul,index", help="Comma-separated list of pair engines to compare")
+    parser.add_argument("--batch-size", type=int, action="store", dest="batch_size", default=32, help="batch_size")
+    parser.add_argument("--repeat", type=int, action="store", dest="repeat", default=5, help="Number of timed repetitions")
+    parser.add_argument("--data-path", type=str, action="store", dest="data_path", default="", help="Comma-separated list of processed HDF5 files to benchmark on instead of synthetic jets")
+    parser.add_argument("--nbatches", type=int, action="store", dest="nbatches", default=4, help="Number of batches per timed repetition")
+    parser.add_argument("--fill", type=str, action="store", dest="fill", default="0.25,0.5,1.0", help="Comma-separated list of real-constituent fractions for synthetic jets")
+    parser.add_argument("--batch-sizes", type=str, action="store", dest="batch_sizes", default="250,512,1024,2048,4096", help="Comma-separated list of batch sizes")
+    parser.add_argument("--compile", action="store_true", dest="compile", default=False, help="Set this flag to torch.compile the benchmarked kernel")
+    parser.add_argument("--workers", type=int, action="store", dest="workers", default=2, help="Number of DataLoader workers, or of evaluate_model.py processes for --test model-sweep")
+    parser.add_argument("--cache-dir", type=str, action="store", dest="cache_dir", default="", help="Directory for the memory-mapped .npy cache of the lazy backend")
+    parser.add_argument("--prefetch", type=str, action="store", dest="prefetch", default="0,2,8", help="Comma-separated list of prefetch queue sizes")
+    parser.add_argument("--step-time", type=float, action="store", dest="step_time", default=0.005, help="Simulated model time per batch in seconds")
+    parser.add_argument("--shuffle", action="store_true", dest="shuffle", default=False, help="Set this flag to shuffle the data while loading")
+    parser.add_argument("--shuffle-buffers", type=str, action="store", dest="shuffle_buffers", default="10000,100000", help="Comma-separated list of JetClassData shuffle buffer sizes")
+    parser.add_argument("--nfiles", type=int, action="store", dest="nfiles", default=4, help="Number of synthetic JetClass files")
+    parser.add_argument("--njets", type=int, action="store", dest="njets", default=100000, help="Number of jets per synthetic JetClass file, or of synthetic results for --test sweep/binned/results")
+    parser.add_argument("--outdir", type=str, action="store", dest="outdir", default="/tmp/benchmark_jetclass", help="Directory for synthetic JetClass files")
+    parser.add_argument("--mass-range", type=str, action="store", dest="massrange", default="AND:100,150", help="Mass cut for --test cuts, same format as train.py")
+    parser.add_argument("--pt-range", type=str, action="store", dest="ptrange", default="AND:0,10000", help="pT cut for --test cuts, same format as train.py")
+    parser.add_argument("--eta-range", type=str, action="store", dest="etarange", default="AND:-1,1", help="eta cut for --test cuts, same format as train.py")
+    parser.add_argument("--skip-labels", type=str, action="store", dest="skiplabels", default="2,5", help="Labels skipped by --test cuts, same format as train.py")
+    parser.add_argument("--checkpoint", type=str, action="store", dest="checkpoint", default="", help="Trained UQPFIN state dict for --test amp")
+    parser.add_argument("--members", type=str, action="store", dest="members", default="2,5", help="Comma-separated list of ensemble sizes for --test ensemble/ensemble-eval")
+    parser.add_argument("--samples", type=str, action="store", dest="samples", default="10,50,100", help="Comma-separated list of MC dropout sample counts for --test mcdo/ablation")
+    parser.add_argument("--mc-chunks", type=str, action="store", dest="mc_chunks", default="1,2", help="Comma-separated list of MC dropout samples per forward call for --test mcdo")
+    parser.add_argument("--models", type=int, action="store", dest="models", default=20, help="Number of random models for --test model-sweep/eval-cache")
+    parser.add_argument("--threads", type=int, action="store", dest="threads", default=0, help="Number of torch CPU threads (0 keeps the default)")
+
+    args = parser.parse_args()
+    args.Np = list(map(int, args.Np.split(',')))
+    args.modes = args.modes.split(',')
+    args.fill = list(map(float, args.fill.split(',')))
+    args.batch_sizes = list(map(int, args.batch_sizes.split(',')))
+    args.prefetch = list(map(int, args.prefetch.split(',')))
+    args.shuffle_buffers = list(map(int, args.shuffle_buffers.split(',')))
+    args.members = list(map(int, args.members.split(',')))
+    args.samples = list(map(int, args.samples.split(',')))
+    args.mc_chunks = list(map(int, args.mc_chunks.split(',')))
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    if args.test == "pairs":
+        bench_pairs(args)
+    elif args.test == "packed":
+        bench_packed(args)
+    elif args.test == "features":
+        bench_features(args)
+    elif args.test == "p4":
+        bench_p4(args)
+    elif args.test == "loader":
+        bench_loader(args)
+    elif args.test == "sampler":
+        bench_sampler(args)
+    elif args.test == "prefetch":
+        bench_prefetch(args)
+    elif args.test == "shuffle":
+        bench_shuffle(args)
+    elif args.test == "stitch":
+        bench_stitch(args)
+    elif args.test == "manifest":
+        bench_manifest(args)
+    elif args.test == "cuts":
+        bench_cuts(args)
+    elif args.test == "metrics":
+        bench_metrics(args)
+    elif args.test == "losses":
+        bench_losses(args)
+    elif args.test == "amp":
+        bench_amp(args)
+    elif args.test == "ddp":
+        bench_ddp(args)
+    elif args.test == "ensemble":
+        bench_ensemble(args)
+    elif args.test == "ensemble-eval":
+        bench_ensemble_eval(args)
+    elif args.test == "mcdo":
+        bench_mcdo(args)
+    elif args.test == "ablation":
+        bench_ablation(args)
+    elif args.test == "sweep":
+        bench_sweep(args)
+    elif args.test == "binned":
+        bench_binned(args)
+    elif args.test == "results":
+        bench_results(args)
+    elif args.test == "model-sweep":
+        bench_model_sweep(args)
+    elif args.test == "eval-cache":
+        bench_eval_cache(args)
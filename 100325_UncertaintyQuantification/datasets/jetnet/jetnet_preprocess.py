@@ -2,9 +2,23 @@ import h5py
 import numpy as np
 import sys
 import os
+import argparse
 from sklearn.model_selection import train_test_split
 
+def get_p4(data, aug):
+    # same massless four-momenta as UQPFIN.get_particle_four_momenta, in float32 like the model inputs
+    data = data.astype('float32')
+    aug = aug.astype('float32')
+    pt = data[:, :, 0] * aug[:, 5:6]
+    eta = data[:, :, 1] + aug[:, 3:4]
+    phi = data[:, :, 2] + aug[:, 4:5]
+    return np.stack([pt * np.cosh(eta), pt * np.cos(phi), pt * np.sin(phi), pt * np.sinh(eta)], -1)
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--p4", action="store_true", dest="p4", default=False, help="Set this flag to also store the constituent four-momenta (E, px, py, pz) as the 'p4' dataset")
+    args = parser.parse_args()
+
     files = ['g.hdf5', 'q.hdf5', 't.hdf5',  'w.hdf5',  'z.hdf5']
     files = ["raw/" + f for f in files]
     nfiles = len(files)
@@ -81,6 +95,8 @@ if __name__ == "__main__":
     train.create_dataset('masks', data = train_mask)
     train.create_dataset('labels', data = train_labels)
     train.create_dataset('aug_data', data = train_aug)
+    if args.p4:
+        train.create_dataset('p4', data = get_p4(train_data, train_aug))
 
     train.close()
 
@@ -89,6 +105,8 @@ if __name__ == "__main__":
     test.create_dataset('masks', data = test_mask)
     test.create_dataset('labels', data = test_labels)
     test.create_dataset('aug_data', data = test_aug)
+    if args.p4:
+        test.create_dataset('p4', data = get_p4(test_data, test_aug))
 
     test.close()
 
@@ -98,6 +116,8 @@ if __name__ == "__main__":
     val.create_dataset('masks', data = val_mask)
     val.create_dataset('labels', data = val_labels)
     val.create_dataset('aug_data', data = val_aug)
+    if args.p4:
+        val.create_dataset('p4', data = get_p4(val_data, val_aug))
 
     val.close()
 
@@ -5,6 +5,7 @@ import glob
 import sklearn
 import sys, os
 import h5py
+import argparse
 from sklearn.metrics import roc_curve
 
 
@@ -32,12 +33,25 @@ def get_px_py_pz_v(pt, eta, phi):
     pz = pt * np.sinh(eta)
     return px, py, pz
 
+def get_p4_v(data, aug_data):
+    '''Provides per-constituent E, px, py, pz in absolute units, given the processed (pt, eta, phi) and aug_data'''
+    data = data.astype('float32')
+    aug_data = aug_data.astype('float32')
+    pt = data[:, :, 0] * aug_data[:, 5:6]
+    eta = data[:, :, 1] + aug_data[:, 3:4]
+    phi = data[:, :, 2] + aug_data[:, 4:5]
+    return np.stack([pt * np.cosh(eta), pt * np.cos(phi), pt * np.sin(phi), pt * np.sinh(eta)], -1)
+
 def rotate_v(py, pz, angle):
     '''Rotates vector by angle provided'''
     pyy = py * np.cos(angle) - pz * np.sin(angle)
     pzz = pz * np.cos(angle) + py * np.sin(angle)
     return pyy, pzz
 
+parser = argparse.ArgumentParser()
+parser.add_argument("--p4", action="store_true", dest="p4", default=False, help="Set this flag to also store the constituent four-momenta (E, px, py, pz) as the 'p4' dataset")
+args = parser.parse_args()
+
 # Train data
 # Read in hdf5 files
 # Note: you will need to repeat this processing for input_filenames train, test and val
@@ -107,5 +121,7 @@ for input_filename in ["raw/train.h5", "raw/test.h5", "raw/val.h5"]:
     new_dataset.create_dataset('masks', data = mask)
     new_dataset.create_dataset('labels', data = labels)
     new_dataset.create_dataset('aug_data', data = aug_data)
+    if args.p4:
+        new_dataset.create_dataset('p4', data = get_p4_v(data, aug_data))
 
     new_dataset.close()
\ No newline at end of file
@@ -10,10 +10,11 @@ import matplotlib.pyplot as plt
 from torch.utils.data import Dataset
 import h5py
 from EvalTools import *
-from PFINDataset import PFINDataset, JetClassData
+from PFINDataset import PFINDataset, JetClassData, batch_loader
 from UQPFIN import UQPFIN as Model
 import argparse
 import gc
+import torch.multiprocessing as mp
 # %env HDF5_USE_FILE_LOCKING=FALSE
 def query_yes_no(question, default="yes"):
     """Ask a yes/no question via raw_input() and return their answer.
@@ -45,6 +46,130 @@ def query_yes_no(question, default="yes"):
         else:
             sys.stdout.write("Please respond with 'yes' or 'no' " "(or 'y' or 'n').\n")
 
+def results_filename(args, tag):
+    if args.model_type == "dropout":
+        return os.path.join(args.outdir, "RESULTS_UQPFIN_MCDO_" + args.data_type + "_{}.h5".format(tag))
+    elif args.model_type == "ensemble":
+        return os.path.join(args.outdir, "RESULTS_UQPFIN_Ensemble_" + args.data_type + "_{}.h5".format(tag))
+    elif args.model_type == "edl":
+        return os.path.join(args.outdir, "RESULTS_{}.h5".format(tag))
+
+def checkpoints(args, all_models, tag):
+    # checkpoint files evaluated for tag
+    if args.model_type == "dropout":
+        return [os.path.join(args.modeldir, f) for f in all_models if tag in f][:1]
+    elif args.model_type == "ensemble":
+        return [os.path.join(args.modeldir, f) for f in all_models if tag in f]
+    elif args.model_type == "edl":
+        return [os.path.join(args.modeldir, tag)]
+
+def up_to_date(filename, model_files):
+    # True if the results file is newer than every checkpoint it was made from
+    return os.path.exists(filename) and os.path.getmtime(filename) >= max(os.path.getmtime(f) for f in model_files)
+
+def evaluate_tag(tag, args, all_models, test_set, testloader = None):
+    """Evaluates the model(s) of tag on test_set, prints accuracy and AUC and writes the results file if --make-file.
+    testloader: loader over test_set for --type edl; a loader without worker processes is made if not given"""
+    dataset = args.data_type
+    makeFile = args.make_file
+    model_results = {}
+    cache = EvalCache(args.cache_dir, int(args.cache_gb * 2**30)) if args.cache_dir else None
+    
+    if args.model_type == "edl":
+        if dataset == "jetclass":
+            # ModelEvaluator generates the batches, and can identify the data for the cache
+            testloader = test_set
+        elif testloader is None:
+            testloader = batch_loader(test_set, 512)
+    if makeFile:
+        filename = results_filename(args, tag)
+    #Creating Evaluator and recording
+    if args.model_type == "dropout":
+        this_file = checkpoints(args, all_models, tag)[0]
+        evaluator = MCDOEvaluator(this_file, data_type = dataset, use_p4 = args.use_p4, amp = args.amp, compile = args.compile,
+                                  samples = args.mc_samples, chunk_size = args.mc_chunk, cache = cache)
+        labels, preds, maxprobs, probs, sums, oods, uncs, aug, entropy, mutual_info = evaluator.evaluate(test_set = test_set, aug = True, info = True)
+    elif args.model_type == "ensemble":
+        this_files = checkpoints(args, all_models, tag)
+        evaluator = EnsembleEvaluator(this_files, data_type = dataset, amp = args.amp, compile = args.compile, stack = args.stack, cache = cache)
+        labels, preds, maxprobs, probs, sums, oods, uncs, aug = evaluator.evaluate(test_set = test_set, aug = True)
+    elif args.model_type == "edl":
+        this_file = checkpoints(args, all_models, tag)[0]
+        evaluator = ModelEvaluator(this_file, amp = args.amp, compile = args.compile, cache = cache)
+        if makeFile:
+            # streamed to the results file batch by batch and read back for the scores; the latents stay in the file
+            with ResultsWriter(filename, keys = ["sums", "uncs"]) as writer:
+                evaluator.evaluate(data_loader = testloader, latent=True, aug=True, writer=writer)
+            results = read_results(filename, keys = ["labels", "preds", "maxprobs", "probs", "sums", "oods", "uncs", "aug"])
+            labels, preds, maxprobs, probs, sums, oods, uncs, aug = [results[key] for key in
+                ["labels", "preds", "maxprobs", "probs", "sums", "oods", "uncs", "aug"]]
+            latents = None
+        else:
+            labels, preds, maxprobs, probs, sums, oods, uncs, aug, latents = evaluator.evaluate(data_loader = testloader, latent=True, aug=True)
+        nparams = sum(p.numel() for p in evaluator.model.parameters())
+        
+    acc = accuracy_score(labels[~oods], preds[~oods])*100
+    if dataset == "topdata":
+        probs2=probs
+    else:
+        skiplabels = np.unique(labels[oods])
+        probs2=np.delete(probs, skiplabels, 1)
+        
+    if probs2.shape[1] == 2:
+        probs2 = probs2[:, 1]
+        
+    auc = roc_auc_score(labels[~oods], probs2[~oods], multi_class='ovo')*100
+    
+    #Printing accuracy and AUC and storing into dictionary
+    if args.model_type == "edl":
+        print("{} \t\t Params: {}\t Accuracy: {:.2f}% \t AUC: {:.2f}%".format(evaluator.label, nparams, acc, auc))
+        model_results[evaluator.label] = {'labels' : labels, 
+                                          'preds': preds, 
+                                          'maxprobs': maxprobs,
+                                          'sums':sums, 
+                                          'oods':oods,
+                                          'uncs': uncs,
+                                          'probs': probs,
+                                          'latents': latents,
+                                          'aug': aug}
+    else:
+        print("{}\t\t Accuracy: {:.2f}% \t AUC: {:.2f}%".format(tag, acc, auc))
+        model_results[tag] = {'labels' : labels, 
+                                          'preds': preds, 
+                                          'maxprobs': maxprobs,
+                                          'sums':sums, 
+                                          'oods':oods,
+                                          'uncs': uncs,
+                                          'probs': probs,
+                                          'aug': aug}
+        if args.model_type == "dropout":
+            model_results[tag]['entropy'] = entropy
+            model_results[tag]['mutual_info'] = mutual_info
+    #Saving results if makeFile is True   
+    if makeFile:
+        if args.model_type != "edl":
+            # the edl results were already written while evaluating
+            with ResultsWriter(filename) as writer:
+                writer.append(**model_results[tag])
+        
+        print("Results saved to {}".format(filename))
+    sys.stdout.flush()
+    del evaluator, model_results, labels, preds, maxprobs, probs, sums, oods, uncs, aug
+    torch.cuda.empty_cache()
+    gc.collect()
+    return tag
+
+# state of the --workers processes, set once by init_worker when the pool starts
+_worker = {}
+
+def init_worker(args, all_models, test_set, threads):
+    # test_set comes through torch.multiprocessing pickling: its shared-memory tensors are passed by handle, not copied
+    torch.set_num_threads(threads)
+    _worker.update(args = args, all_models = all_models, test_set = test_set)
+
+def worker_evaluate_tag(tag):
+    return evaluate_tag(tag, _worker["args"], _worker["all_models"], _worker["test_set"])
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--outdir", type=str, action="store", dest="outdir", default="results/", help="Output directory for evaluation results" )
@@ -56,6 +181,16 @@ if __name__ == "__main__":
     parser.add_argument("--tag", type=str, action="store", dest="tag", default="", help="Optional tag to only store results of certain models with tag in the name" )
     parser.add_argument("--type", type=str, action="store", dest="model_type", default="edl", choices={"edl", "ensemble", "dropout"}, help="Type of model to evaluate" )
     parser.add_argument("--batch-mode", action="store_true", dest="batchmode", default=False, help="Set this flag when running in batch mode to suppress tqdm progress bars")
+    parser.add_argument("--yes", action="store_true", dest="yes", default=False, help="Set this flag to evaluate without asking for confirmation; with --make-file, models whose results file is newer than their checkpoints are skipped")
+    parser.add_argument("--workers", type=int, action="store", dest="workers", default=0, help="Number of processes evaluating models concurrently (0 evaluates them one after the other in this process); the test data is loaded once and shared")
+    parser.add_argument("--cache-dir", type=str, action="store", dest="cache_dir", default="", help="Directory of a cache of evaluation results keyed by checkpoint, model JSON, test data and settings; unchanged models are not evaluated again (off if empty)")
+    parser.add_argument("--cache-gb", type=float, action="store", dest="cache_gb", default=10., help="Disk budget of --cache-dir in GB, least recently used results are removed first")
+    parser.add_argument("--amp", type=str, action="store", dest="amp", default="off", choices=["off", "bf16", "fp16"], help="Mixed precision for the forward pass; pair features stay in fp32")
+    parser.add_argument("--compile", action="store_true", dest="compile", default=False, help="Set this flag to run the models through torch.compile")
+    parser.add_argument("--stack", type=str, action="store", dest="stack", default="loop", choices=["vmap", "loop"], help="Only for --type ensemble- evaluate members with the same architecture one after the other (loop) or in one torch.func.vmap call (vmap, needs about K times the activation memory of one member and has been slower than loop on CPU)")
+    parser.add_argument("--mc-samples", type=int, action="store", dest="mc_samples", default=10, help="Only for --type dropout- number of MC dropout samples per jet")
+    parser.add_argument("--mc-chunk", type=int, action="store", dest="mc_chunk", default=1, help="Only for --type dropout- number of MC dropout samples drawn in one forward call; the batch is repeated this many times")
+    parser.add_argument("--use-p4", action="store_true", dest="use_p4", default=False, help="Set this flag to read the precomputed constituent four-momenta (p4) from the test files")
     
     args = parser.parse_args()
     
@@ -96,96 +231,45 @@ if __name__ == "__main__":
         print("Tags:")
         print("\n".join(tags))
     
-    question = "Would you like to proceed with the above models for evaluation using the \033[31m{}\033[0m model on the \033[31m{}\033[0m dataset?".format(args.model_type, dataset)
-    answer = query_yes_no(question)
-    assert answer, "Stopping evaluation"
+    if not args.yes:
+        question = "Would you like to proceed with the above models for evaluation using the \033[31m{}\033[0m model on the \033[31m{}\033[0m dataset?".format(args.model_type, dataset)
+        answer = query_yes_no(question)
+        assert answer, "Stopping evaluation"
+    
+    if args.model_type == "edl":
+        tags = all_models
+    tags = sorted(tags)
+    if args.yes and makeFile:
+        todo = [tag for tag in tags if not up_to_date(results_filename(args, tag), checkpoints(args, all_models, tag))]
+        if len(todo) < len(tags):
+            print("Skipping {} of {} with up-to-date results".format(len(tags) - len(todo), len(tags)))
+        tags = todo
+    if not tags:
+        sys.exit(0)
     
+    testloader = None
     if dataset != 'jetclass':
         test_path = os.path.join(args.data_loc, dataset, "processed", "test.h5")
         #Loading testing dataset
-        test_set = PFINDataset(test_path)
-        if args.model_type == "edl":
-            testloader = DataLoader(test_set, shuffle=False, batch_size=512, num_workers=1, pin_memory=True, persistent_workers=True)
+        test_set = PFINDataset(test_path, use_p4 = args.use_p4)
+        if args.workers > 0:
+            test_set.share_memory_()
+        elif args.model_type == "edl":
+            testloader = batch_loader(test_set, 512, num_workers=1, pin_memory=True, persistent_workers=True)
     else:
+        # JetClass is streamed from its files, every process reads them on its own
         data_path = glob.glob(os.path.join(args.data_loc, "jetclass", "processed", "test_*.h5"))
-        test_set = JetClassData(batch_size = 512)
+        test_set = JetClassData(batch_size = 512, use_p4 = args.use_p4)
         test_set.set_file_names(file_names = data_path)
+        print("Test jets: {}".format(len(test_set)))
     
-    if args.model_type == "edl":
-        tags = all_models
-        
-    for tag in sorted(tags):
-        model_results = {}
-        
-        if args.model_type == "edl" and dataset == "jetclass":
-            testloader = test_set.generate_data()
-        #Creating Evaluator and recording
-        if args.model_type == "dropout":
-            this_file = [os.path.join(saved_model_loc, f) for f in all_models if tag in f][0]
-            evaluator = MCDOEvaluator(this_file, data_type = dataset)
-            labels, preds, maxprobs, probs, sums, oods, uncs, aug = evaluator.evaluate(test_set = test_set, aug = True)
-        elif args.model_type == "ensemble":
-            this_files = [os.path.join(saved_model_loc, f) for f in all_models if tag in f]
-            evaluator = EnsembleEvaluator(this_files, data_type = dataset)
-            labels, preds, maxprobs, probs, sums, oods, uncs, aug = evaluator.evaluate(test_set = test_set, aug = True)
-        elif args.model_type == "edl":
-            this_file = os.path.join(saved_model_loc, tag)
-            evaluator = ModelEvaluator(this_file)
-            labels, preds, maxprobs, probs, sums, oods, uncs, aug, latents = evaluator.evaluate(data_loader = testloader, latent=True, aug=True)
-            nparams = sum(p.numel() for p in evaluator.model.parameters())
-            
-        acc = accuracy_score(labels[~oods], preds[~oods])*100
-        if dataset == "topdata":
-            probs2=probs
-        else:
-            skiplabels = np.unique(labels[oods])
-            probs2=np.delete(probs, skiplabels, 1)
-            
-        if probs2.shape[1] == 2:
-            probs2 = probs2[:, 1]
-            
-        auc = roc_auc_score(labels[~oods], probs2[~oods], multi_class='ovo')*100
-        
-        #Printing accuracy and AUC and storing into dictionary
-        if args.model_type == "edl":
-            print("{} \t\t Params: {}\t Accuracy: {:.2f}% \t AUC: {:.2f}%".format(evaluator.label, nparams, acc, auc))
-            model_results[evaluator.label] = {'labels' : labels, 
-                                              'preds': preds, 
-                                              'maxprobs': maxprobs,
-                                              'sums':sums, 
-                                              'oods':oods,
-                                              'uncs': uncs,
-                                              'probs': probs,
-                                              'latents': latents,
-                                              'aug': aug}
-        else:
-            print("{}\t\t Accuracy: {:.2f}% \t AUC: {:.2f}%".format(tag, acc, auc))
-            model_results[tag] = {'labels' : labels, 
-                                              'preds': preds, 
-                                              'maxprobs': maxprobs,
-                                              'sums':sums, 
-                                              'oods':oods,
-                                              'uncs': uncs,
-                                              'probs': probs,
-                                              'aug': aug}
-        #Saving results if makeFile is True   
-        if makeFile:
-            if args.model_type == "dropout":
-                filename = os.path.join(args.outdir, "RESULTS_UQPFIN_MCDO_" + dataset + "_{}.h5".format(tag))
-                k = tag
-            elif args.model_type == "ensemble":
-                filename = os.path.join(args.outdir, "RESULTS_UQPFIN_Ensemble_" + dataset + "_{}.h5".format(tag))
-                k = tag
-            elif args.model_type == "edl":
-                filename = os.path.join(args.outdir, "RESULTS_{}.h5".format(tag))
-                k = evaluator.label
-            
-            f = h5py.File(filename, "w")
-            for key in model_results[k].keys():
-                f.create_dataset(key, data = model_results[k][key])
-            f.close()
-            
-            print("Results saved to {}".format(filename))
-        del evaluator, model_results, labels, preds, maxprobs, probs, sums, oods, uncs, aug
-        torch.cuda.empty_cache()
-        gc.collect()
\ No newline at end of file
+    if args.workers > 0:
+        # spawned, not forked: CUDA was already queried in this process (torch.cuda.is_available), and a forked
+        # child can't initialize it again; the CPU threads are split between the processes
+        threads = max(1, torch.get_num_threads() // args.workers)
+        with mp.get_context("spawn").Pool(args.workers, initializer = init_worker, initargs = (args, all_models, test_set, threads)) as pool:
+            for tag in pool.imap_unordered(worker_evaluate_tag, tags):
+                pass
+    else:
+        for tag in tags:
+            evaluate_tag(tag, args, all_models, test_set, testloader)
@@ -0,0 +1,32 @@
+import os, sys
+import h5py
+import numpy as np
+import pytest
+
+# the modules live next to the scripts that import them, one directory up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def write_jets(file_name, njets, Np = 10, Nx = 3, nclasses = 2, seed = 0, first = 0):
+    # processed-style HDF5 file where aug_data[:, 0] holds first + the row index, so the rows read back can be checked
+    rng = np.random.default_rng(seed)
+    aug = np.ones((njets, 7), dtype=np.float32)
+    aug[:, 0] = np.arange(first, first + njets)
+    aug[:, 1] = rng.uniform(0, 300, njets)
+    aug[:, 2] = rng.uniform(300, 1200, njets)
+    aug[:, 3] = rng.normal(0, 1, njets)
+    with h5py.File(file_name, "w") as f:
+        f.create_dataset("particles", data=rng.random((njets, Np, Nx), dtype=np.float32))
+        f.create_dataset("masks", data=np.ones((njets, 1, Np), dtype=np.float32))
+        f.create_dataset("aug_data", data=aug)
+        f.create_dataset("labels", data=np.eye(nclasses, dtype=np.float32)[rng.integers(nclasses, size=njets)])
+    return file_name
+
+@pytest.fixture
+def jet_file(tmp_path):
+    return lambda njets, **kwargs: write_jets(str(tmp_path / "test.h5"), njets, **kwargs)
+
+@pytest.fixture
+def jet_files(tmp_path):
+    # nfiles JetClass-style files whose aug_data[:, 0] numbers the jets of all files consecutively
+    return lambda nfiles, njets, **kwargs: [write_jets(str(tmp_path / "train_{}.h5".format(i)), njets, seed = i, first = i * njets, **kwargs)
+                                            for i in range(nfiles)]
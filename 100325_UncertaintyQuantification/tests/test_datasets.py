@@ -0,0 +1,83 @@
+import json, multiprocessing, os
+
+import numpy as np
+import torch
+
+from conftest import write_jets
+from PFINDataset import DatasetManifest, JetClassData, JetSelection, LazyPFINDataset, PFINDataset
+
+def test_lazy_cache_with_selection_copies_every_row(jet_file, tmp_path):
+    # the kept rows lie past the first len(rows) rows of the file, which is larger than the copy chunk
+    file_name = jet_file(1000)
+    selection = JetSelection("OR:0,150", "AND:0,1e9", "AND:-1e9,1e9")
+    ds = LazyPFINDataset(file_name, selection = selection)
+    ds.cache_dir = str(tmp_path / "cache")
+    ds.build_cache(chunk_size = 64)
+    ref = PFINDataset(file_name, selection = selection)
+    assert len(ds) == len(ref) < ds.file_rows
+    for idx in [slice(0, len(ds)), slice(len(ds) - 3, len(ds)), [len(ds) - 1, 0, 5]]:
+        for got, want in zip(ds[idx], ref[idx]):
+            assert torch.equal(got, want)
+    assert (ds[len(ds) - 3:len(ds)][2][:, 1] > 150).all()
+
+def test_batches_stitched_across_files(jet_files):
+    # batch_size 96 leaves leftover rows at the end of every 250-jet file, which start the next batch
+    dataset = JetClassData(batch_size = 96)
+    dataset.set_file_names(jet_files(4, 250))
+    batches = list(dataset.generate_data())
+    assert len(batches) == 1000 // 96
+    ids = np.concatenate([a[:, 0].numpy() for x, m, a, y in batches])
+    assert (ids == np.arange(len(batches) * 96)).all()
+    assert all(x.dtype == torch.float32 and x.shape == (96, 10, 3) for x, m, a, y in batches)
+
+def shuffled_ids(file_names, shuffle_buffer, batch_size = 64):
+    np.random.seed(0)
+    dataset = JetClassData(batch_size = batch_size, shuffle_buffer = shuffle_buffer, chunk_size = 25)
+    dataset.set_file_names(file_names)
+    return [a[:, 0].numpy().astype(np.int64) for x, m, a, y in dataset.generate_data(shuffle = True)]
+
+def test_shuffle_buffer_order_statistics(jet_files):
+    njets = 1000
+    file_names = jet_files(4, njets)
+    batches = shuffled_ids(file_names, 500)
+    ids = np.concatenate(batches)
+    # every jet once, only the final partial batch is dropped
+    assert len(np.unique(ids)) == len(ids)
+    assert 4 * njets - len(ids) < 64
+    # rank correlation between emission and stored position: 0 for a full shuffle, 1 without shuffling; the 160
+    # chunks are read in random order, so it scatters by about 1/sqrt(160) around 0
+    spearman = np.corrcoef(np.arange(len(ids)), np.argsort(np.argsort(ids)))[0, 1]
+    assert abs(spearman) < 0.25
+    # batches mix the files (a uniform shuffle gives ~4 of 4), while whole-file shuffling gives one file per batch,
+    # apart from the batches stitched across a file boundary
+    assert np.mean([len(np.unique(b // njets)) for b in batches]) > 3
+    assert np.mean([len(np.unique(b // njets)) for b in shuffled_ids(file_names, 0)]) < 1.1
+
+def test_manifest_rows_without_stats(jet_files):
+    file_name = jet_files(1, 300)[0]
+    manifest = DatasetManifest(os.path.dirname(file_name))
+    assert manifest.rows(file_name) == 300
+    assert "min" not in manifest.entries["train_0.h5"]["datasets"]["aug_data"]
+    entry = manifest.get(file_name)
+    assert entry["stats"] and entry["datasets"]["aug_data"]["max"][0] == 299
+    # a rewritten file is described again
+    write_jets(file_name, 200)
+    assert DatasetManifest(os.path.dirname(file_name)).rows(file_name) == 200
+
+def describe_all(file_names):
+    for file_name in file_names:
+        DatasetManifest(os.path.dirname(file_name)).rows(file_name)
+
+def test_manifest_concurrent_writers(jet_files):
+    # processes describing files of one directory at the same time, as DDP ranks do
+    file_names = jet_files(8, 20)
+    procs = [multiprocessing.get_context("fork").Process(target = describe_all, args = (file_names[i:] + file_names[:i],)) for i in range(4)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+        assert proc.exitcode == 0
+    directory = os.path.dirname(file_names[0])
+    with open(os.path.join(directory, DatasetManifest.file_name)) as f:
+        assert set(json.load(f)) <= {os.path.basename(file_name) for file_name in file_names}
+    assert not [name for name in os.listdir(directory) if name.endswith(".tmp")]
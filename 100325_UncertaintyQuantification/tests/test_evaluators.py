@@ -0,0 +1,30 @@
+import h5py
+import numpy as np
+import pytest
+import torch
+
+from benchmark import make_members
+from EvalTools import EnsembleEvaluator, ModelEvaluator
+from PFINDataset import PFINDataset
+
+def write_p4(file_name):
+    # appends a p4 dataset as the preprocessing scripts write it
+    with h5py.File(file_name, "a") as f:
+        f.create_dataset("p4", data=np.random.default_rng(1).random(f["particles"].shape[:2] + (4,), dtype=np.float32))
+    return file_name
+
+def test_ensemble_members_get_their_own_p4_inputs(jet_file, tmp_path):
+    file_name = write_p4(jet_file(50, Np = 60))
+    plain = make_members(str(tmp_path / "plain"), 1, extra = ["--use-softmax"])
+    p4 = make_members(str(tmp_path / "p4"), 1, extra = ["--use-softmax", "--use-p4"], seed = 1)
+    evaluator = EnsembleEvaluator(plain + p4, data_type = "topdata")
+    assert evaluator.use_p4
+    probs = evaluator.evaluate(test_set = PFINDataset(file_name, use_p4 = True), batchmode = True)[3]
+    want = []
+    for path, use_p4 in [(plain[0], False), (p4[0], True)]:
+        ds = PFINDataset(file_name, use_p4 = use_p4)
+        with torch.no_grad():
+            want.append(ModelEvaluator(path).model(ds.data, ds.aug_data, ds.masks).numpy())
+    assert np.abs(probs - np.mean(want, 0)).max() < 1e-6
+    with pytest.raises(ValueError):
+        evaluator.evaluate(test_set = PFINDataset(file_name), batchmode = True)
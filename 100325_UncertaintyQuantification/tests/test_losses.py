@@ -0,0 +1,43 @@
+import pytest
+import torch
+
+from Losses import KLDiv, LossCE_Bayes, LossCE_Gibbs, LossMSE, edl_loss
+
+reference = {"mse": LossMSE, "bayes": LossCE_Bayes, "gibbs": LossCE_Gibbs}
+
+def batch(K, Nb = 200, dtype = torch.float64):
+    torch.manual_seed(K)
+    outs = (torch.relu(torch.randn(Nb, K, dtype=dtype)) * 5).requires_grad_()
+    labels = torch.nn.functional.one_hot(torch.randint(0, K, (Nb,)), K).to(dtype)
+    return labels, outs
+
+@pytest.mark.parametrize("kind", list(reference))
+@pytest.mark.parametrize("K", [2, 5, 10])
+@pytest.mark.parametrize("kl_coef", [0., 0.3, 1.])
+def test_edl_loss_matches_separate_losses(kind, K, kl_coef):
+    labels, outs = batch(K)
+    data, kl = reference[kind](labels, outs), KLDiv(labels, outs)
+    want = data + kl_coef * kl if kl_coef else data
+    got = edl_loss(labels, outs, kl_coef, kind = kind)
+    # KLDiv evaluates lgamma(K) in float32, so the KL values only agree to ~1e-7
+    assert torch.allclose(got.mse, data, rtol = 0, atol = 1e-12)
+    assert torch.allclose(got.kl, kl, rtol = 0, atol = 1e-6)
+    assert torch.allclose(got.loss, want, rtol = 0, atol = 1e-6)
+    want_grad, = torch.autograd.grad(want, outs)
+    got_grad, = torch.autograd.grad(got.loss, outs)
+    assert torch.allclose(got_grad, want_grad, rtol = 0, atol = 1e-12)
+
+def test_edl_loss_rejects_unknown_kind():
+    with pytest.raises(ValueError):
+        edl_loss(*batch(2), kind = "hinge")
+
+def test_fp32_losses_under_autocast():
+    # half-precision outputs from an autocast region are evaluated in float32
+    labels, outs = batch(5, dtype = torch.float32)
+    want = edl_loss(labels, outs, 0.5)
+    with torch.autocast(device_type = "cpu", dtype = torch.bfloat16):
+        got = edl_loss(labels.bfloat16(), outs.bfloat16(), 0.5)
+    assert got.loss.dtype == torch.float32
+    assert torch.allclose(got.loss, want.loss, rtol = 2e-2)
+    grad, = torch.autograd.grad(got.loss, outs)
+    assert grad.dtype == torch.float32 and torch.isfinite(grad).all()
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from benchmark import threshold_loop
+from EvalTools import ThresholdSweep
+
+def results(N, seed = 0):
+    # tied (rounded) and NaN uncertainties, 10% OOD jets and 80% correct predictions
+    rng = np.random.default_rng(seed)
+    uncs = np.round(rng.random(N), 2).astype(np.float32)
+    uncs[rng.random(N) < 0.01] = np.nan
+    oods = rng.random(N) < 0.1
+    labels = rng.integers(0, 10, N)
+    preds = np.where(rng.random(N) < 0.8, labels, rng.integers(0, 10, N))
+    return uncs, oods, labels, preds
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_threshold_sweep_matches_loop(seed):
+    uncs, oods, labels, preds = results(5000, seed)
+    ul, ur = np.nanmin(uncs), np.nanmax(uncs)
+    du = (ur - ul)/100
+    # the PlotterTools range, the tied values themselves and thresholds outside the data
+    for thresholds in [np.arange(ul+du, ur-du, du), np.unique(uncs[~np.isnan(uncs)]), np.array([-1., 2.])]:
+        # rates with an empty denominator (e.g. no jet above the threshold) are NaN in both
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            want = threshold_loop(uncs, oods, labels, preds, thresholds)
+            got = ThresholdSweep(uncs, oods, labels, preds).rates(thresholds)
+        for name in want:
+            np.testing.assert_array_equal(got[name], want[name], err_msg = name)
@@ -1,13 +1,15 @@
 import torch
 from torch.utils.data import DataLoader
 from tqdm import tqdm
-from PFINDataset import PFINDataset, JetClassData
-from UQPFIN import UQPFIN as Model
+from PFINDataset import PFINDataset, LazyPFINDataset, JetClassData, JetSelection, batch_loader
+from UQPFIN import UQPFIN as Model, amp_autocast
+from Losses import eps, LossCE, getprobs, LossCE_Bayes, LossCE_Gibbs, LossMSE, fgamma, KLDiv, edl_loss
 import numpy as np
-from sklearn.metrics import accuracy_score
 from torchinfo import summary
 import torch.nn as nn
-import glob
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+import glob, itertools
 import argparse, os, json, sys
 
 try:
@@ -29,55 +31,94 @@ def seed_everything(seed: int):
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = True
 
-eps=1e-15
-
-def LossCE(labels, outs):
-    # labels size: (Nb, nclasses) [true values]
-    # outs size: (Nb, nclasses) [NN predictions]
-    # return -(labels * torch.log(outs)).sum(1).mean()
-    return -(labels * torch.log(outs.clamp(min=eps, max=1-eps))).sum(1).mean()
-
-def getprobs(outs):
-    alphas = outs + 1
-    S = torch.sum(alphas, 1).reshape(-1,1)
-    return alphas / S
-    
-def LossCE_Bayes(labels, outs):
-    # labels size: (Nb, nclasses) [true values]
-    # outs size: (Nb, nclasses) [NN predictions]
-    alphas = outs + 1
-    S = torch.sum(alphas, 1).reshape(-1,1)
-    return (labels * (torch.log(S) - torch.log(alphas))).sum(1).mean()
-
-def LossCE_Gibbs(labels, outs):
-    # labels size: (Nb, nclasses) [true values]
-    # outs size: (Nb, nclasses) [NN predictions]
-    alphas = outs + 1
-    S = torch.sum(alphas, 1).reshape(-1,1)
-    return (labels * (torch.digamma(S) - torch.digamma(alphas))).sum(1).mean()
-
-def LossMSE(labels, outs):
-    # labels size: (Nb, nclasses) [true values]
-    # outs size: (Nb, nclasses) [NN predictions]
-    alphas = outs + 1
-    S = torch.sum(alphas, 1).reshape(-1,1)
-    probs = alphas / S
-    return ((labels - probs)**2 + probs * (1 - probs) / (1 + S)).sum(1).mean()
-
-def fgamma(x):
-    return torch.exp(torch.lgamma(x))
-
-def KLDiv(labels, outs):
-    K = torch.tensor(labels.shape[-1]).float()
-    alphas = outs + 1
-    _alphas = labels + (1-labels)*alphas
-    _S = torch.sum(_alphas, 1).reshape(-1,1)
-    lognum = torch.lgamma(_S)
-    logden = torch.lgamma(K*1.0) + torch.lgamma(_alphas).sum(1).reshape(-1,1)
-    t2 = ((_alphas - 1) * (torch.digamma(_alphas) - torch.digamma(_S) )).sum(1).reshape(-1,1)
-    return (lognum - logden + t2).mean()
+class MetricAccumulator:
+    """Running sums of per-batch metrics, kept in one float64 tensor on the training device.
+    add() only queues device operations, so the loop does not wait for the GPU; values() copies
+    the sums to the host, which is the only synchronization.
+    With shape, e.g. (K,) for K ensemble members, every metric is a tensor of that shape instead of a scalar."""
+    def __init__(self, names, device, shape = ()):
+        self.names = list(names)
+        self.totals = torch.zeros((len(self.names),) + tuple(shape), dtype=torch.float64, device=device)
+
+    def add(self, **metrics):
+        # metrics are scalar tensors (or numbers) keyed by name; names not given are left unchanged
+        for name, value in metrics.items():
+            self.totals[self.names.index(name)] += value.detach() if torch.is_tensor(value) else value
+
+    def values(self):
+        # floats, or lists of floats with shape
+        return dict(zip(self.names, self.totals.tolist()))
+
+    def all_reduce(self):
+        # sums the totals over the processes of a distributed run, one collective for all metrics
+        if dist.is_initialized():
+            dist.all_reduce(self.totals)
+
+def count_correct(probs, labels):
+    # number of jets whose most probable class is the true class, computed on the device;
+    # probs may have leading dimensions, e.g. (K, Nb, C) for K ensemble members, giving counts with dim: (K,)
+    return (probs.argmax(-1) == labels.argmax(-1)).sum(-1)
+
+def setup_distributed(backend):
+    """Joins the process group when started by torchrun with more than one process (WORLD_SIZE > 1).
+    Returns (rank, world_size, local_rank); only rank 0 keeps its standard output."""
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 1, 0
+    dist.init_process_group(backend = backend)
+    rank, local_rank = dist.get_rank(), int(os.environ.get("LOCAL_RANK", 0))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+    if rank != 0:
+        sys.stdout = open(os.devnull, "w")
+    return rank, world_size, local_rank
+
+def broadcast_from_rank0(*values, device = "cpu"):
+    # rank 0's values of a few numbers or flags, so that all processes take the same branch
+    if not dist.is_initialized():
+        return values
+    t = torch.tensor([float(v) for v in values], dtype=torch.float64, device=device)
+    dist.broadcast(t, 0)
+    return tuple(t.tolist())
+
+def min_across_ranks(n, device = "cpu"):
+    # smallest n over the processes, e.g. the number of batches every rank can run in an epoch
+    if not dist.is_initialized():
+        return n
+    t = torch.tensor([n], dtype=torch.int64, device=device)
+    dist.all_reduce(t, op=dist.ReduceOp.MIN)
+    return int(t.item())
+
+def wrap_model(model, device, compile = False):
+    # module used for the forward passes: DDP in a distributed run, optionally compiled;
+    # the unwrapped model shares its parameters and is the one saved, so checkpoints have no `module.` prefix
+    if dist.is_initialized():
+        model = DDP(model, device_ids = [device.index] if device.type == "cuda" else None)
+    return torch.compile(model) if compile else model
+
+def kl_schedule(klcoef, epoch):
+    """Returns (l, kl_coef, val_kl_coef) of an epoch for the --KLcoef option klcoef: the annealing factor l
+    and the weights of the KL term in the training and validation losses.
+    The validation loss keeps a fixed --KLcoef also while l is 0."""
+    l = min(1.0, epoch/10.)
+    if "nominal" in klcoef:
+        if 'slope' in klcoef:
+            l = min(float(klcoef.split('_')[1]), epoch * float(klcoef.split('_')[3]))
+        elif '_' in klcoef:
+            l = min(float(klcoef.split('_')[1]), epoch/10.)
+        else:
+            l = min(1.0, epoch/10.)
+    if klcoef == "0":
+        val_kl_coef = 0.
+    elif "nominal" in klcoef:
+        val_kl_coef = l
+    else:
+        val_kl_coef = float(klcoef)
+    kl_coef = 0. if l == 0. else val_kl_coef
+    return l, kl_coef, val_kl_coef
 
-if __name__ == "__main__":
+def get_parser():
+    # command line options of train.py, also used by train_ensemble.py
     parser = argparse.ArgumentParser()
 
     parser.add_argument("--outdir", type=str, action="store", dest="outdir", default="./trained_models/", help="Output directory for trained model" )
@@ -89,7 +130,7 @@ if __name__ == "__main__":
     parser.add_argument("--F-nodes", type=str, action="store", dest="f_nodes", default="64,100,100", help="Comma-separated list of hidden layer nodes for F")
     parser.add_argument("--epochs", type=int, action="store", dest="epochs", default=50, help="Epochs")
     parser.add_argument("--label", type=str, action="store", dest="label", default="", help="a label for the model")
-    parser.add_argument("--batch-size", type=int, action="store", dest="batch_size", default=250, help="batch_size")
+    parser.add_argument("--batch-size", type=int, action="store", dest="batch_size", default=250, help="batch_size (per process in a distributed run)")
     parser.add_argument("--data-loc", type=str, action="store", dest="data_loc", default="../datasets/", help="Directory for data" )
     parser.add_argument("--data-type", type=str, action="store", dest="data_type", default="topdata", help="Dataset to train on" )
     parser.add_argument("--preload", action="store_true", dest="preload", default=False, help="Preload weights and biases from a pre-trained Model")
@@ -106,9 +147,23 @@ if __name__ == "__main__":
     parser.add_argument("--batch-mode", action="store_true", dest="batchmode", default=False, help="Set this flag when running in batch mode to suppress tqdm progress bars")
     parser.add_argument("--use-softmax", action="store_true", dest="use_softmax", default=False, help="Set this flag when using softmax probabilites")
     parser.add_argument("--use-dropout", action="store_true", dest="use_dropout", default=False, help="Set this flag when using dropout layers")
+    parser.add_argument("--use-p4", action="store_true", dest="use_p4", default=False, help="Set this flag to read the precomputed constituent four-momenta (p4) written by the preprocessing scripts")
+    parser.add_argument("--data-backend", type=str, action="store", dest="data_backend", default="eager", choices=["eager", "lazy"], help="Load topdata/jetnet fully into RAM (eager) or read contiguous batches on demand (lazy)")
+    parser.add_argument("--cache-dir", type=str, action="store", dest="cache_dir", default="", help="Only for --data-backend lazy- directory for a memory-mapped .npy copy of the data shared by all loader workers")
+    parser.add_argument("--pair-mode", type=str, action="store", dest="pair_mode", default="matmul", choices=["matmul", "index", "packed"], help="Engine used to build and reduce particle pairs: ['matmul', 'index', 'packed']")
     parser.add_argument('--load-json', type=str, action="store", dest="load_json", default="", help='Load settings from file in json format. Command line options override values in file.')
+    parser.add_argument('--prefetch', type=int, action="store", dest="prefetch", default=0, help='Only for jetclass data- number of batches to prepare on a background thread (0 disables prefetching)')
+    parser.add_argument('--shuffle-buffer', type=int, action="store", dest="shuffle_buffer", default=0, help='Only for jetclass data- shuffle through a buffer of this many jets, reading chunks of all files in random order, instead of loading and permuting whole files (0 keeps whole-file shuffling)')
+    parser.add_argument('--sync-every', type=int, action="store", dest="sync_every", default=0, help='Copy the running training metrics to the host every N steps to show them on the progress bar (0 syncs once per epoch)')
+    parser.add_argument('--check-labels', action="store_true", dest="check_labels", default=False, help='Set this flag to check every batch for labels that do not sum to 1 (one host sync per batch); otherwise the check is done once per epoch')
+    parser.add_argument('--amp', type=str, action="store", dest="amp", default="off", choices=["off", "bf16", "fp16"], help='Mixed precision for the forward/backward pass (fp16 uses a GradScaler); pair features and losses stay in fp32')
+    parser.add_argument('--compile', action="store_true", dest="compile", default=False, help='Set this flag to run the model through torch.compile')
+    parser.add_argument('--dist-backend', type=str, action="store", dest="dist_backend", default="gloo", choices=["gloo", "nccl"], help='Backend of the process group when started with torchrun --nproc-per-node N (gloo also runs on CPU-only machines)')
     parser.add_argument('--ndata', type=int, action="store", dest="ndata", default=20, help='Only for jetclass data- number of data files (1 file = 1M jets)')
-    
+    return parser
+
+def parse_args(parser):
+    # parses the command line; options missing from it are taken from the --load-json file if given
     args = parser.parse_args()
     
     if args.load_json:
@@ -116,14 +171,96 @@ if __name__ == "__main__":
             t_args = argparse.Namespace()
             t_args.__dict__.update(json.load(f))
             args = parser.parse_args(namespace=t_args)
-        
+    return args
+
+def data_settings(data_type, skip = ""):
+    """Returns (features, Np, num_classes, skiplabels, label_indices) for a dataset,
+    where skip is the comma-separated list of labels dropped from training (--skip-labels)"""
+    if data_type == 'topdata':
+        features = 3
+        Np = 60
+        num_classes = 2
+        skiplabels = []
+        label_indices = [0,1]
+    elif data_type == 'jetnet':
+        features = 3
+        Np = 30
+        if skip:
+            skiplabels = list(map(int, skip.strip().split(',')))
+        else:
+            skiplabels = []
+        num_classes = 5 - len(skiplabels)
+        label_indices = [i for i in range(5) if i not in skiplabels]
+    elif data_type == 'jetclass':
+        features = 11
+        Np = 60
+        if skip:
+            skiplabels = list(map(int, skip.strip().split(',')))
+        else:
+            skiplabels = []
+        num_classes = 10 - len(skiplabels)
+        label_indices = [i for i in range(10) if i not in skiplabels]
+    else:
+        raise ValueError(f"Unsupported data_type '{data_type}'. Expected one of 'topdata', 'jetnet', or 'jetclass'.")
+    return features, Np, num_classes, skiplabels, label_indices
+
+def make_data(args, selection, world_size = 1, rank = 0, seed = 0):
+    """Returns the training and validation data: DataLoaders for topdata/jetnet and JetClassData for jetclass
+    (see epoch_batches). world_size, rank and seed shard the data between the processes of a distributed run."""
+    if args.data_type in ['topdata', 'jetnet']:
+        train_path = args.data_loc + '/' + args.data_type + '/processed/train.h5'
+        val_path   = args.data_loc + '/' + args.data_type + '/processed/val.h5'
+        if args.data_backend == 'lazy':
+            train_set = LazyPFINDataset(train_path, use_p4 = args.use_p4, cache_dir = args.cache_dir or None, selection = selection)
+            val_set = LazyPFINDataset(val_path, use_p4 = args.use_p4, cache_dir = args.cache_dir or None, selection = selection)
+        else:
+            train_set = PFINDataset(train_path, use_p4 = args.use_p4, selection = selection)
+            val_set = PFINDataset(val_path, use_p4 = args.use_p4, selection = selection)
+        # lazy files are read in contiguous batches, eager tensors are fancy-indexed with random batches
+        contiguous = args.data_backend == 'lazy'
+        train_data = batch_loader(train_set, args.batch_size, shuffle=True, contiguous=contiguous,
+                                  num_replicas=world_size, rank=rank, seed=seed,
+                                  num_workers=1, pin_memory=True, persistent_workers=True)
+        val_data = batch_loader(val_set, args.batch_size, shuffle=True, contiguous=contiguous,
+                                num_replicas=world_size, rank=rank, seed=seed,
+                                num_workers=1, pin_memory=True, persistent_workers=True)
+    else:
+        assert args.ndata != 0, "--ndata should not be 0"
+        # in a distributed run each process reads an equal share of the rows of all files (see Data.set_file_names)
+        train_data = JetClassData(batch_size = args.batch_size, use_p4 = args.use_p4, shuffle_buffer = args.shuffle_buffer,
+                                  selection = selection, cache_dir = args.cache_dir or None, num_replicas = world_size, rank = rank)
+        val_data = JetClassData(batch_size = args.batch_size, use_p4 = args.use_p4, shuffle_buffer = args.shuffle_buffer,
+                                selection = selection, cache_dir = args.cache_dir or None, num_replicas = world_size, rank = rank)
+        train_data.set_file_names(file_names = sorted(glob.glob(os.path.join(args.data_loc, args.data_type, "processed", "train_*.h5")))[0:args.ndata])
+        val_data.set_file_names(file_names = sorted(glob.glob(os.path.join(args.data_loc, args.data_type, "processed", "val_*.h5")))[0:2])
+        # row counts come from the manifest.json next to the files
+        print("Training jets: {}, validation jets: {}{}".format(len(train_data), len(val_data), " (rank 0 of {})".format(world_size) if world_size > 1 else ""))
+    return train_data, val_data
+
+def epoch_batches(data, epoch, prefetch = 0):
+    # batches of one epoch: a new shuffled generator for JetClassData, otherwise the DataLoader
+    # with its sampler set to the epoch, so every epoch draws a new permutation
+    if isinstance(data, JetClassData):
+        return data.generate_data(shuffle=True, prefetch=prefetch)
+    data.sampler.set_epoch(epoch)
+    return data
+
+if __name__ == "__main__":
+    args = parse_args(get_parser())
+
     # seed_everything(42)
-    if not os.path.exists(args.outdir):
+    # with torchrun every process trains on its own shard of the data; rank 0 writes the outputs
+    rank, world_size, local_rank = setup_distributed(args.dist_backend)
+    if rank != 0:
+        wandb = None
+    if rank == 0 and not os.path.exists(args.outdir):
         os.mkdir(args.outdir)
-    if not os.path.exists(args.outdictdir):
+    if rank == 0 and not os.path.exists(args.outdictdir):
         os.mkdir(args.outdictdir)
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = torch.device("cuda", local_rank) if torch.cuda.is_available() else torch.device("cpu")
+    # shared by all processes, so that their samplers draw the same permutation each epoch
+    seed = int(broadcast_from_rank0(np.random.randint(2**31), device=device)[0])
 
         
     extra_name = args.label
@@ -138,9 +275,10 @@ if __name__ == "__main__":
             continue
         model_dict[arg] = getattr(args, arg)
     
-    f_model = open("{}/UQPFIN{}.json".format(args.outdictdir, extra_name), "w")
-    json.dump(model_dict, f_model, indent=3)
-    f_model.close()
+    if rank == 0:
+        f_model = open("{}/UQPFIN{}.json".format(args.outdictdir, extra_name), "w")
+        json.dump(model_dict, f_model, indent=3)
+        f_model.close()
 
 
     epochs = args.epochs
@@ -158,33 +296,7 @@ if __name__ == "__main__":
 
     #Loading training and validation datasets
     
-    if args.data_type == 'topdata':
-        features = 3
-        Np = 60
-        num_classes = 2
-        skiplabels = []
-        label_indices = [0,1]
-    elif args.data_type == 'jetnet':
-        features = 3
-        Np = 30
-        if args.skiplabels:
-            skiplabels = list(map(int, args.skiplabels.strip().split(',')))
-        else:
-            skiplabels = []
-        num_classes = 5 - len(skiplabels)
-        label_indices = [i for i in range(5) if i not in skiplabels]
-    elif args.data_type == 'jetclass':
-        features = 11
-        Np = 60
-        if args.skiplabels:
-            skiplabels = list(map(int, args.skiplabels.strip().split(',')))
-        else:
-            skiplabels = []
-        num_classes = 10 - len(skiplabels)
-        label_indices = [i for i in range(10) if i not in skiplabels]
-    else:
-        raise ValueError(f"Unsupported data_type '{args.data_type}'. Expected one of 'topdata', 'jetnet', or 'jetclass'.")
-    
+    features, Np, num_classes, skiplabels, label_indices = data_settings(args.data_type, args.skiplabels)
 
     model = Model(particle_feats = features,
                   n_consts = Np,
@@ -194,9 +306,11 @@ if __name__ == "__main__":
                   interaction_mode = args.x_mode,
                   use_softmax = bool(args.use_softmax),
                   use_dropout = bool(args.use_dropout),
+                  pair_mode = args.pair_mode,
+                  use_p4 = bool(args.use_p4),
                   Phi_sizes = list(map(int, args.phi_nodes.split(','))),
                   F_sizes   = list(map(int, args.f_nodes.split(',')))).to(device)
-    summary(model, ((1, Np, features), (1,7), (1, 1, Np)))
+    summary(model, ((1, Np, features + 4*int(args.use_p4)), (1,7), (1, 1, Np)))
 
     if args.preload and os.path.exists(args.preload_file):
         model_checkpoint = model.state_dict()
@@ -215,26 +329,15 @@ if __name__ == "__main__":
         model.load_state_dict(model_checkpoint)
 
 
-    if args.data_type in ['topdata', 'jetnet']:
-        train_path = args.data_loc + '/' + args.data_type + '/processed/train.h5'
-        val_path   = args.data_loc + '/' + args.data_type + '/processed/val.h5'
-        train_set = PFINDataset(train_path)
-        val_set = PFINDataset(val_path) 
-        trainloader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, 
-                                 num_workers=1, pin_memory=True, persistent_workers=True)
-        val_loader = DataLoader(val_set, batch_size=args.batch_size, shuffle=True, 
-                                num_workers=1, pin_memory=True, persistent_workers=True)
-    else:
-        assert args.ndata != 0, "--ndata should not be 0"
-        train_DS = JetClassData(batch_size = args.batch_size)
-        val_DS = JetClassData(batch_size = args.batch_size)
-        train_DS.set_file_names(file_names = glob.glob(os.path.join(args.data_loc + '/' + args.data_type, "/processed/train_*.h5"))[0:args.ndata])
-        val_DS.set_file_names(file_names = glob.glob(os.path.join(args.data_loc + '/' + args.data_type, "/processed/val_*.h5"))[0:2])
-
+    # jets outside the kinematic ranges or with skipped labels are dropped by the datasets, before batching
+    selection = JetSelection(args.massrange, args.ptrange, args.etarange, skiplabels)
+    train_data, val_data = make_data(args, selection, world_size, rank, seed)
 
     opt = torch.optim.Adam(model.parameters(),  lr=l_rate, weight_decay=opt_weight_decay)
     if not args.use_softmax and args.data_type == 'jetclass':
         scheduler = torch.optim.lr_scheduler.MultiStepLR(opt, milestones=[epochs//3, 2*epochs//3], gamma=0.1)
+    fwd_model = wrap_model(model, device, args.compile)
+    scaler = torch.amp.GradScaler(device.type, enabled = args.amp == "fp16")
 
     m_logic, (m1, m2) = args.massrange.strip().split(':')[0], list(map(float, args.massrange.strip().split(':')[1].split(',')))
     pt_logic, (pt1, pt2) = args.ptrange.strip().split(':')[0], list(map(float, args.ptrange.strip().split(':')[1].split(',')))
@@ -262,95 +365,62 @@ if __name__ == "__main__":
     restart_count = 0
 
     while epoch < epochs:
-        if args.data_type == 'jetclass':
-            trainloader = train_DS.generate_data(shuffle=True)
-            val_loader = val_DS.generate_data(shuffle=True)
+        # counts epochs across model resets, so every epoch draws a new permutation
+        trainloader = epoch_batches(train_data, restart_count * epochs + epoch, args.prefetch)
+        val_loader = epoch_batches(val_data, restart_count * epochs + epoch, args.prefetch)
+        # all processes run the same number of steps, as every step all-reduces the gradients
+        train_steps = min_across_ranks(len(trainloader), device)
+        val_steps = min_across_ranks(len(val_loader), device)
         print('Epoch ' + str(epoch))
-        l = min(1.0, epoch/10.)
-        if "nominal" in args.klcoef:
-            if 'slope' in args.klcoef:
-                l = min(float(args.klcoef.split('_')[1]), epoch * float(args.klcoef.split('_')[3]))
-            elif '_' in args.klcoef:
-                l = min(float(args.klcoef.split('_')[1]), epoch/10.)
-            else:
-                l = min(1.0, epoch/10.)
+        l, kl_coef, val_kl_coef = kl_schedule(args.klcoef, epoch)
         if "nominal" in args.klcoef:
             print("L = {}".format(l))
-        val_loss_total = 0
-        train_loss_total = 0
-        train_acc_total = 0
-        val_acc_total = 0
-        mse_loss_total = 0
-        kldiv_loss_total = 0
+        # loss sums, correct predictions and label sums stay on the device until the end of the epoch
+        train_metrics = MetricAccumulator(["loss", "mse", "kldiv", "correct", "labels", "jets"], device)
+        val_metrics = MetricAccumulator(["loss", "correct", "labels", "jets"], device)
 
         #train loop
 
         model.train()
         ntrain = 0
-        for x,m,a,y in tqdm(trainloader, disable=args.batchmode):
-            if m_logic == 'AND':
-                keep_masses = (a[:, 1] > min(m1,m2)) & (a[:, 1] < max(m1,m2))
-            else:
-                keep_masses = (a[:, 1] < min(m1,m2)) | (a[:, 1] > max(m1,m2))
-
-            if pt_logic == 'AND':
-                keep_pts = (a[:, 2] > min(pt1,pt2)) & (a[:, 2] < max(pt1,pt2))
-            else:
-                keep_pts = (a[:, 2] < min(pt1,pt2)) | (a[:, 2] > max(pt1,pt2))
-                
-            if eta_logic == 'AND':
-                keep_etas = (a[:, 3] > min(eta1,eta2)) & (a[:, 3] < max(eta1,eta2))
-            else:
-                keep_etas = (a[:, 3] < min(eta1,eta2)) | (a[:, 3] > max(eta1,eta2))
-
-            keep_labels = torch.tensor(np.isin(np.argmax(y.cpu().numpy(), 1), skiplabels, invert=True)).bool()
-            
-            keep = (keep_masses & keep_pts & keep_etas & keep_labels).bool()
-            ntrain += keep.sum().item()
+        pbar = tqdm(itertools.islice(trainloader, train_steps), total=train_steps, disable=args.batchmode or rank != 0)
+        for step, (x,m,a,y) in enumerate(pbar):
+            ntrain += len(y)
             
             opt.zero_grad()
-            x = x[keep].to(device)
-            m = m[keep].to(device)
-            y = y[keep].to(device)
+            x = x.to(device, non_blocking=True)
+            m = m.to(device, non_blocking=True)
+            y = y.to(device, non_blocking=True)
             y = y[:, label_indices]
-            if y.sum().int().item() != keep.sum().int().item():
-                print("The class probabilities don't add up to 1, please check! Numer of events: {}, Sum of probs: {}".format(keep.sum().int().item(), y.sum().int().item()))
+            if args.check_labels and y.sum().int().item() != len(y):
+                print("The class probabilities don't add up to 1, please check! Numer of events: {}, Sum of probs: {}".format(len(y), y.sum().int().item()))
                 sys.exit(1)
                 
-            a = a[keep].to(device)
-            pred = model(x,a,m)
+            a = a.to(device, non_blocking=True)
+            with amp_autocast(device, args.amp):
+                pred = fwd_model(x,a,m)
+            pred = pred.float()
 
             if args.use_softmax:
                 loss = LossCE(y, pred)
-                mse_loss = LossCE(y, pred)
-            elif args.klcoef == "0" or l == 0.:
-                loss = LossMSE(y, pred)
-                mse_loss = LossMSE(y, pred)
-            elif "nominal" in args.klcoef:
-                loss = LossMSE(y, pred) + l * KLDiv(y, pred)
-                mse_loss = LossMSE(y, pred)
+                mse_loss = loss
+                kldiv_loss = KLDiv(y, pred)
             else:
-                loss = LossMSE(y, pred) + float(args.klcoef)*KLDiv(y, pred)
-                mse_loss = LossMSE(y, pred)
-
-            kldiv_loss = KLDiv(y, pred)
-
-            train_loss_total += loss.item()
-            mse_loss_total += mse_loss.item()
-            kldiv_loss_total += kldiv_loss.item()
+                loss, mse_loss, kldiv_loss = edl_loss(y, pred, kl_coef)
 
             with torch.no_grad():
                 if args.use_softmax:
                     probs = pred
                 else:
                     probs = getprobs(pred)
-                acc = accuracy_score(  np.argmax(probs.cpu().numpy(), 1),
-                                       np.argmax(y.cpu().numpy(), 1),
-                                       normalize = False )
-                train_acc_total += acc
+                train_metrics.add(loss = loss, mse = mse_loss, kldiv = kldiv_loss, correct = count_correct(probs, y), labels = y.sum(), jets = len(y))
 
-            loss.backward()
-            opt.step()
+            scaler.scale(loss).backward()
+            scaler.step(opt)
+            scaler.update()
+            if args.sync_every > 0 and (step + 1) % args.sync_every == 0:
+                running = train_metrics.values()
+                pbar.set_postfix(loss = running["loss"] / (step + 1), acc = running["correct"] / ntrain)
 
 
 
@@ -360,66 +430,53 @@ if __name__ == "__main__":
         nval = 0
         
         with torch.no_grad():
-            for x,m,a,y in tqdm(val_loader, disable=args.batchmode):
-                
-                if m_logic == 'AND':
-                    keep_masses = (a[:, 1] > min(m1,m2)) & (a[:, 1] < max(m1,m2))
-                else:
-                    keep_masses = (a[:, 1] < min(m1,m2)) | (a[:, 1] > max(m1,m2))
-
-
-                if pt_logic == 'AND':
-                    keep_pts = (a[:, 2] > min(pt1,pt2)) & (a[:, 2] < max(pt1,pt2))
-                else:
-                    keep_pts = (a[:, 2] < min(pt1,pt2)) | (a[:, 2] > max(pt1,pt2))
-
-
-                if eta_logic == 'AND':
-                    keep_etas = (a[:, 3] > min(eta1,eta2)) & (a[:, 3] < max(eta1,eta2))
-                else:
-                    keep_etas = (a[:, 3] < min(eta1,eta2)) | (a[:, 3] > max(eta1,eta2))
-
-                    
-                keep_labels = torch.tensor(np.isin(np.argmax(y.cpu().numpy(), 1), skiplabels, invert=True)).bool()
-
-                keep = (keep_masses & keep_pts & keep_etas & keep_labels).bool()
-
-        
-                x = x[keep].to(device)
-                m = m[keep].to(device)
-                y = y[keep].to(device)
+            for x,m,a,y in tqdm(itertools.islice(val_loader, val_steps), total=val_steps, disable=args.batchmode or rank != 0):
+                x = x.to(device, non_blocking=True)
+                m = m.to(device, non_blocking=True)
+                y = y.to(device, non_blocking=True)
                 y = y[:, label_indices]
-                a = a[keep].to(device)
-                if y.sum().int().item() != keep.sum().int().item():
-                    print("The class probabilities don't add up to 1, please check! Numer of events: {}, Sum of probs: {}".format(keep.sum().int().item(), y.sum().int().item()))
+                a = a.to(device, non_blocking=True)
+                if args.check_labels and y.sum().int().item() != len(y):
+                    print("The class probabilities don't add up to 1, please check! Numer of events: {}, Sum of probs: {}".format(len(y), y.sum().int().item()))
                     sys.exit(1)
-                pred = model(x,a,m)
+                with amp_autocast(device, args.amp):
+                    pred = fwd_model(x,a,m)
+                pred = pred.float()
 
                 if args.use_softmax:
                     loss = LossCE(y, pred)
-                elif "nominal" in args.klcoef:
-                    loss = LossMSE(y, pred) + l*KLDiv(y, pred)
-                elif args.klcoef == "0":
-                    loss = LossMSE(y, pred)
                 else:
-                    loss = LossMSE(y, pred) + float(args.klcoef)*KLDiv(y,pred)
+                    loss = edl_loss(y, pred, val_kl_coef).loss
 
-                val_loss_total += loss.item()
                 if args.use_softmax:
                     probs = pred
                 else:
                     probs = getprobs(pred)
-                acc =   accuracy_score( np.argmax(probs.cpu().numpy(), 1),
-                                        np.argmax(y.cpu().numpy(), 1),
-                                        normalize = False )
-                val_acc_total += acc
-                nval += keep.sum().item()
-        train_loss_total /= ntrain #len(train_set)
-        val_loss_total /= nval #len(val_set)
-        val_acc_total /= nval #len(val_set)
-        train_acc_total /= ntrain #len(train_set)
-        mse_loss_total /= ntrain #len(train_set)
-        kldiv_loss_total /= ntrain #len(train_set)
+                val_metrics.add(loss = loss, correct = count_correct(probs, y), labels = y.sum(), jets = len(y))
+                nval += len(y)
+        if args.data_type == 'jetclass':
+            # stops the generators (and prefetch threads) of batches left over after train_steps/val_steps
+            trainloader.close()
+            val_loader.close()
+        if args.data_type == 'jetclass' and args.prefetch > 0:
+            print("Prefetch stats (train): ", train_data.prefetch_stats)
+            print("Prefetch stats (val): ", val_data.prefetch_stats)
+        # the only host syncs of the epoch; in a distributed run the sums are over all processes
+        train_metrics.all_reduce()
+        val_metrics.all_reduce()
+        train_metrics = train_metrics.values()
+        val_metrics = val_metrics.values()
+        ntrain, nval = round(train_metrics["jets"]), round(val_metrics["jets"])
+        for name, metrics, n in [("training", train_metrics, ntrain), ("validation", val_metrics, nval)]:
+            if round(metrics["labels"]) != n:
+                print("The class probabilities don't add up to 1 in the {} data, please check! Numer of events: {}, Sum of probs: {}".format(name, n, metrics["labels"]))
+                sys.exit(1)
+        train_loss_total = train_metrics["loss"] / ntrain #len(train_set)
+        val_loss_total = val_metrics["loss"] / nval #len(val_set)
+        val_acc_total = val_metrics["correct"] / nval #len(val_set)
+        train_acc_total = train_metrics["correct"] / ntrain #len(train_set)
+        mse_loss_total = train_metrics["mse"] / ntrain #len(train_set)
+        kldiv_loss_total = train_metrics["kldiv"] / ntrain #len(train_set)
 
         if epoch == epochs - 1:
             print(pred[:20,:].cpu().numpy())
@@ -476,19 +533,25 @@ if __name__ == "__main__":
                 no_change+=1
                 print('Validation Accuracy has not changed much, will stop in ' + str(patience-no_change) + 
                       ' epochs if this continues')
-                if no_change==patience:
-                    print('Stopping training')
-                    break
             else:
                 no_change = 0
+        # the metrics are the same on all processes, but rank 0 decides so that they all leave the loop together
+        stop, = broadcast_from_rank0(early_stopping and no_change == patience, device=device)
+        if stop:
+            print('Stopping training')
+            break
 
         if val_acc_total > best_val_acc:
             no_change=0
             print('Saving best model based on accuracy')
-            torch.save(model.state_dict(), args.outdir + '/UQPFIN_best'+extra_name)
+            if rank == 0:
+                torch.save(model.state_dict(), args.outdir + '/UQPFIN_best'+extra_name)
             best_val_acc = val_acc_total
 
-        if epoch > 2 and (best_val_acc < 0.55):
+        # the best model is reloaded from the file rank 0 saved in an earlier epoch; the all-reduce since then
+        # guarantees the file is complete (the processes are assumed to share the file system)
+        reset, reload = broadcast_from_rank0(epoch > 2 and best_val_acc < 0.55, epoch > 2 and best_val_acc - val_acc_total > 0.1, device=device)
+        if reset:
             print('Validation accuracy is close to 0.5. Resetting the model')
             del model, opt
             model = Model(particle_feats = features,
@@ -497,11 +560,15 @@ if __name__ == "__main__":
                           device = device,
                           PhiI_nodes = args.n_phiI,
                           interaction_mode = args.x_mode,
+                          pair_mode = args.pair_mode,
+                          use_p4 = bool(args.use_p4),
                           Phi_sizes = list(map(int, args.phi_nodes.split(','))),
                           F_sizes   = list(map(int, args.f_nodes.split(',')))).to(device)
             opt = torch.optim.Adam(model.parameters(),  lr=l_rate, weight_decay=opt_weight_decay)
             if not args.use_softmax and args.data_type == 'jetclass':
                 scheduler = torch.optim.lr_scheduler.MultiStepLR(opt, milestones=[epochs//3, 2*epochs//3], gamma=0.1)
+            fwd_model = wrap_model(model, device, args.compile)
+            scaler = torch.amp.GradScaler(device.type, enabled = args.amp == "fp16")
             restart_count += 1
             epoch = 0
             best_val_acc = 0
@@ -512,7 +579,7 @@ if __name__ == "__main__":
             else:
                 print("Model did not improve after 3 restarts! Check!")
                 sys.exit(1)        
-        elif epoch > 2 and best_val_acc - val_acc_total > 0.1:
+        elif reload:
             print('Validation accuracy dropped by more than 10%. Reloading best model')
             model.load_state_dict(torch.load(args.outdir + '/UQPFIN_best'+extra_name, map_location=device))
 
@@ -523,6 +590,9 @@ if __name__ == "__main__":
             scheduler.step()
 
     print('Saving last model')
-    torch.save(model.state_dict(), args.outdir + '/UQPFIN_last'+extra_name)
+    if rank == 0:
+        torch.save(model.state_dict(), args.outdir + '/UQPFIN_last'+extra_name)
     if wandb:
         wandb.finish()
+    if dist.is_initialized():
+        dist.destroy_process_group()
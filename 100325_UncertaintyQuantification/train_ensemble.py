@@ -0,0 +1,248 @@
+import torch
+from tqdm import tqdm
+from PFINDataset import JetSelection
+from UQPFIN import UQPFIN as Model, UQPFINEnsemble, amp_autocast
+from Losses import LossCE, getprobs, edl_loss
+from train import MetricAccumulator, count_correct, kl_schedule, get_parser, parse_args, data_settings, make_data, epoch_batches
+import numpy as np
+from torchinfo import summary
+import os, json, sys, time
+
+# Trains the members of a deep ensemble together: every batch is read once and fed to all members,
+# which are evaluated as one UQPFINEnsemble. Takes the options of train.py plus --members and --stack, and writes
+# for member k the files train.py would write with --label <label>_k, i.e. UQPFIN_best_<label>_k in --outdir
+# and UQPFIN_<label>_k.json in --outdictdir, which evaluate_model.py --type ensemble groups by <label>.
+# The members are trained as by train.py, except that
+#  - they see the same batches in the same order, so they differ only by their initialization,
+#  - a member that is reset for staying close to 0.5 accuracy restarts on its own, while the epoch count,
+#    KL annealing and learning rate schedule continue for the ensemble,
+#  - a member that stops early is frozen while the others keep training.
+
+def member_label(label, k):
+    # label of member k, as passed to train.py with --label
+    return "{}_{}".format(label, k) if label else str(k)
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.add_argument('--members', type=int, action="store", dest="members", default=5, help='Number of ensemble members trained together')
+    parser.add_argument('--first-member', type=int, action="store", dest="first_member", default=0, help='Index of the first member, to add members to an existing ensemble')
+    parser.add_argument('--stack', type=str, action="store", dest="stack", default="loop", choices=["vmap", "loop"], help='Evaluate the members one after the other (loop) or in one torch.func.vmap call over stacked parameters (vmap, slower than loop on CPU so far)')
+    args = parse_args(parser)
+
+    if not os.path.exists(args.outdir):
+        os.mkdir(args.outdir)
+    if not os.path.exists(args.outdictdir):
+        os.mkdir(args.outdictdir)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    members = list(range(args.first_member, args.first_member + args.members))
+    K = len(members)
+    extra_names = []
+    for k in members:
+        extra_name = member_label(args.label, k)
+        if not extra_name.startswith('_'):
+            extra_name = '_' + extra_name
+        extra_names.append(extra_name)
+
+        model_dict = {}
+        for arg in vars(args):
+            if arg == 'load_json':
+                continue
+            model_dict[arg] = getattr(args, arg)
+        model_dict['label'] = member_label(args.label, k)
+
+        f_model = open("{}/UQPFIN{}.json".format(args.outdictdir, extra_name), "w")
+        json.dump(model_dict, f_model, indent=3)
+        f_model.close()
+
+    epochs = args.epochs
+
+    #optimizer parameters
+    l_rate = 1e-3
+    opt_weight_decay = 0
+
+    #Early stopping parameters
+    early_stopping = True
+    min_epoch_early_stopping = args.epochs // 4
+    patience = 5
+    tolerance = 1e-4
+
+    features, Np, num_classes, skiplabels, label_indices = data_settings(args.data_type, args.skiplabels)
+
+    def new_member():
+        return Model(particle_feats = features,
+                     n_consts = Np,
+                     num_classes = num_classes,
+                     device = device,
+                     PhiI_nodes = args.n_phiI,
+                     interaction_mode = args.x_mode,
+                     use_softmax = bool(args.use_softmax),
+                     use_dropout = bool(args.use_dropout),
+                     pair_mode = args.pair_mode,
+                     use_p4 = bool(args.use_p4),
+                     Phi_sizes = list(map(int, args.phi_nodes.split(','))),
+                     F_sizes   = list(map(int, args.f_nodes.split(',')))).to(device)
+
+    model = UQPFINEnsemble([new_member() for k in members], stack = args.stack)
+    summary(model.members[0], ((1, Np, features + 4*int(args.use_p4)), (1,7), (1, 1, Np)))
+    if args.preload:
+        print("--preload is not used for ensembles, the members would all start from the same weights")
+
+    selection = JetSelection(args.massrange, args.ptrange, args.etarange, skiplabels)
+    train_data, val_data = make_data(args, selection)
+
+    # Adam updates every parameter tensor on its own, so one optimizer over all members trains them independently
+    opt = torch.optim.Adam(model.parameters(),  lr=l_rate, weight_decay=opt_weight_decay)
+    if not args.use_softmax and args.data_type == 'jetclass':
+        scheduler = torch.optim.lr_scheduler.MultiStepLR(opt, milestones=[epochs//3, 2*epochs//3], gamma=0.1)
+    fwd_model = torch.compile(model) if args.compile else model
+    scaler = torch.amp.GradScaler(device.type, enabled = args.amp == "fp16")
+
+    print("data type: ", args.data_type)
+    print("skip labels: ", skiplabels)
+    print("classes: ", num_classes)
+    print("members: ", members)
+
+    best_val_acc = np.zeros(K)
+    no_change = np.zeros(K, dtype=int)
+    pre_val_acc = np.zeros(K)
+    member_epochs = np.zeros(K, dtype=int) # epochs since the member was (re)initialized
+    restart_count = np.zeros(K, dtype=int)
+    stopped = np.zeros(K, dtype=bool)
+    epoch = 0
+    start = time.perf_counter()
+
+    while epoch < epochs:
+        trainloader = epoch_batches(train_data, epoch, args.prefetch)
+        val_loader = epoch_batches(val_data, epoch, args.prefetch)
+        print('Epoch ' + str(epoch))
+        l, kl_coef, val_kl_coef = kl_schedule(args.klcoef, epoch)
+        if "nominal" in args.klcoef:
+            print("L = {}".format(l))
+        # one entry per member, kept on the device until the end of the epoch
+        train_metrics = MetricAccumulator(["loss", "correct", "labels", "jets"], device, (K,))
+        val_metrics = MetricAccumulator(["loss", "correct", "labels", "jets"], device, (K,))
+
+        #train loop
+
+        model.train()
+        for x,m,a,y in tqdm(trainloader, disable=args.batchmode):
+            opt.zero_grad()
+            x = x.to(device, non_blocking=True)
+            m = m.to(device, non_blocking=True)
+            y = y.to(device, non_blocking=True)
+            y = y[:, label_indices]
+            a = a.to(device, non_blocking=True)
+            with amp_autocast(device, args.amp):
+                pred = fwd_model(x,a,m) # (K, Nb, C)
+            pred = pred.float()
+
+            if args.use_softmax:
+                losses = torch.stack([LossCE(y, p) for p in pred])
+                probs = pred
+            else:
+                losses = torch.stack([edl_loss(y, p, kl_coef).loss for p in pred])
+                probs = getprobs(pred.reshape(-1, pred.shape[-1])).reshape(pred.shape)
+
+            # each member's parameters only enter its own loss, so the sum gives every member its own gradient
+            scaler.scale(losses.sum()).backward()
+            scaler.step(opt)
+            scaler.update()
+            train_metrics.add(loss = losses, correct = count_correct(probs, y), labels = y.sum(), jets = len(y))
+
+        # Validation loop
+        model.eval()
+
+        with torch.no_grad():
+            for x,m,a,y in tqdm(val_loader, disable=args.batchmode):
+                x = x.to(device, non_blocking=True)
+                m = m.to(device, non_blocking=True)
+                y = y.to(device, non_blocking=True)
+                y = y[:, label_indices]
+                a = a.to(device, non_blocking=True)
+                with amp_autocast(device, args.amp):
+                    pred = fwd_model(x,a,m)
+                pred = pred.float()
+
+                if args.use_softmax:
+                    losses = torch.stack([LossCE(y, p) for p in pred])
+                    probs = pred
+                else:
+                    losses = torch.stack([edl_loss(y, p, val_kl_coef).loss for p in pred])
+                    probs = getprobs(pred.reshape(-1, pred.shape[-1])).reshape(pred.shape)
+                val_metrics.add(loss = losses, correct = count_correct(probs, y), labels = y.sum(), jets = len(y))
+
+        train_metrics = {name: np.array(v) for name, v in train_metrics.values().items()}
+        val_metrics = {name: np.array(v) for name, v in val_metrics.values().items()}
+        ntrain, nval = round(train_metrics["jets"][0]), round(val_metrics["jets"][0])
+        for name, metrics, n in [("training", train_metrics, ntrain), ("validation", val_metrics, nval)]:
+            if round(metrics["labels"][0]) != n:
+                print("The class probabilities don't add up to 1 in the {} data, please check! Numer of events: {}, Sum of probs: {}".format(name, n, metrics["labels"][0]))
+                sys.exit(1)
+        train_loss_total = train_metrics["loss"] / ntrain
+        train_acc_total = train_metrics["correct"] / ntrain
+        val_loss_total = val_metrics["loss"] / nval
+        val_acc_total = val_metrics["correct"] / nval
+
+        for i, k in enumerate(members):
+            if stopped[i]:
+                continue
+            print('Member {}: Best Validation Accuracy: {} \t Current Validation Accuracy: {} \t Current Validation Loss: {}'.format(
+                k, best_val_acc[i], val_acc_total[i], val_loss_total[i]))
+            member_epochs[i] += 1
+
+            # Early stopping after at least  nepochs//4
+            if early_stopping and epoch >= min_epoch_early_stopping:
+                if abs(pre_val_acc[i] - val_acc_total[i]) < tolerance and abs(best_val_acc[i] - val_acc_total[i]) < tolerance:
+                    no_change[i] += 1
+                    print('Member {}: Validation Accuracy has not changed much, will stop in {} epochs if this continues'.format(k, patience - no_change[i]))
+                    if no_change[i] == patience:
+                        print('Stopping training of member {}'.format(k))
+                        # without gradients Adam skips the member's parameters
+                        for p in model.members[i].parameters():
+                            p.requires_grad_(False)
+                        stopped[i] = True
+                        continue
+                else:
+                    no_change[i] = 0
+
+            if val_acc_total[i] > best_val_acc[i]:
+                no_change[i] = 0
+                print('Member {}: Saving best model based on accuracy'.format(k))
+                torch.save(model.members[i].state_dict(), args.outdir + '/UQPFIN_best' + extra_names[i])
+                best_val_acc[i] = val_acc_total[i]
+
+            if member_epochs[i] > 3 and best_val_acc[i] < 0.55:
+                print('Member {}: Validation accuracy is close to 0.5. Resetting the member'.format(k))
+                model.members[i].load_state_dict(new_member().state_dict())
+                for p in model.members[i].parameters():
+                    opt.state.pop(p, None)
+                restart_count[i] += 1
+                member_epochs[i] = 0
+                best_val_acc[i] = 0
+                no_change[i] = 0
+                val_acc_total[i] = 0
+                if restart_count[i] > 3:
+                    print("Member {} did not improve after 3 restarts! Check!".format(k))
+                    sys.exit(1)
+            elif member_epochs[i] > 3 and best_val_acc[i] - val_acc_total[i] > 0.1:
+                print('Member {}: Validation accuracy dropped by more than 10%. Reloading best model'.format(k))
+                model.members[i].load_state_dict(torch.load(args.outdir + '/UQPFIN_best' + extra_names[i], map_location=device))
+
+            pre_val_acc[i] = val_acc_total[i]
+
+        print('Train loss: {} \t Train accuracy: {}'.format(np.round(train_loss_total, 6), np.round(train_acc_total, 4)))
+        epoch += 1
+        if args.klcoef != "0" and not args.use_softmax and args.data_type == 'jetclass':
+            scheduler.step()
+        if stopped.all():
+            print('Stopping training')
+            break
+
+    elapsed = time.perf_counter() - start
+    print('Saving last models')
+    for i in range(K):
+        torch.save(model.members[i].state_dict(), args.outdir + '/UQPFIN_last' + extra_names[i])
+    print("Trained {} members for {} epochs in {:.1f} s ({:.1f} s per epoch); see benchmark.py --test ensemble for the comparison with {} train.py runs".format(
+        K, epoch, elapsed, elapsed / max(epoch, 1), K))